@@ -0,0 +1,334 @@
+"""
+Benchmark de carga de extremo a extremo para la API de autenticación.
+
+Lanza una mezcla configurable de peticiones (registro, login, /auth/me,
+/auth/users) con N clientes concurrentes y mide throughput y latencias
+p50/p95/p99 por endpoint. Puede ejecutarse contra la app ASGI en proceso
+o contra un servidor uvicorn local, y comparar con una línea base guardada.
+
+Uso (desde backend/):
+    python -m benchmarks.loadtest --mix read-heavy --duration 20
+    python -m benchmarks.loadtest --mix login-storm --server --workers 2
+    python -m benchmarks.loadtest --mix read-heavy --save-baseline
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import httpx
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baselines", "loadtest.json")
+SEED_PASSWORD = "benchpass123"
+# /auth/register/batch solo admite administradores y lotes de REGISTER_BATCH_MAX (100 por defecto)
+ADMIN_EMAIL = "bench-admin@example.com"
+SEED_BATCH = 100
+# Por debajo de estas muestras un p95/p99 no dice nada: no se guarda ni se compara
+MIN_SAMPLES = 50
+
+# Pesos de cada operación en cada mezcla
+MIXES = {
+    "read-heavy": {"me": 80, "users": 15, "login": 5},
+    "login-storm": {"login": 85, "me": 15},
+    "register-heavy": {"register": 50, "login": 20, "me": 30},
+    "balanced": {"me": 40, "users": 20, "login": 25, "register": 15},
+}
+
+
+def percentile(sorted_values, pct):
+    """Percentil por rango más cercano sobre una lista ya ordenada"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(pct / 100 * len(sorted_values))))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarize(samples, elapsed):
+    """Resumen por endpoint: peticiones, errores, rps y latencias en ms"""
+    endpoints = {}
+    for name, records in samples.items():
+        latencies = sorted(latency for latency, _ in records)
+        errors = {}
+        for _, status_code in records:
+            if status_code >= 400:
+                errors[str(status_code)] = errors.get(str(status_code), 0) + 1
+        endpoints[name] = {
+            "count": len(records),
+            "errors": sum(errors.values()),
+            "errors_by_status": errors,
+            "rps": round(len(records) / elapsed, 2),
+            "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+            "max_ms": round(latencies[-1] * 1000, 2) if latencies else 0.0,
+        }
+    total = sum(stats["count"] for stats in endpoints.values())
+    return {"total_requests": total, "throughput_rps": round(total / elapsed, 2), "endpoints": endpoints}
+
+
+async def admin_headers(client, email=ADMIN_EMAIL, password=SEED_PASSWORD):
+    """Cabeceras de un administrador (debe estar en ADMIN_EMAILS); se registra si no existe"""
+    await client.post("/auth/register", json={"name": "Bench Admin", "email": email, "password": password})
+    response = await client.post("/auth/login", json={"email": email, "password": password})
+    response.raise_for_status()
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+
+async def seed_users(client, count, headers):
+    """Crear count usuarios con el endpoint de registro por lotes"""
+    run_id = uuid.uuid4().hex[:8]
+    emails = [f"bench-{run_id}-{i}@example.com" for i in range(count)]
+    for start in range(0, count, SEED_BATCH):
+        chunk = emails[start:start + SEED_BATCH]
+        response = await client.post("/auth/register/batch", headers=headers, json=[
+            {"name": f"Bench {email}", "email": email, "password": SEED_PASSWORD} for email in chunk
+        ])
+        response.raise_for_status()
+    return emails
+
+
+async def login_tokens(client, emails):
+    tokens = []
+    for email in emails:
+        response = await client.post("/auth/login", json={"email": email, "password": SEED_PASSWORD})
+        response.raise_for_status()
+        tokens.append(response.json()["access_token"])
+    return tokens
+
+
+async def run_load(client, mix, duration, concurrency, emails, tokens, seed=42):
+    """Bucle cerrado: cada cliente lanza la siguiente petición al terminar la anterior"""
+    weights = MIXES[mix]
+    operations, operation_weights = list(weights), list(weights.values())
+    samples = {name: [] for name in operations}
+    deadline = time.perf_counter() + duration
+
+    async def worker(worker_id):
+        rng = random.Random(seed + worker_id)
+        while time.perf_counter() < deadline:
+            operation = rng.choices(operations, weights=operation_weights)[0]
+            headers = {"Authorization": f"Bearer {rng.choice(tokens)}"}
+            start = time.perf_counter()
+            if operation == "me":
+                response = await client.get("/auth/me", headers=headers)
+            elif operation == "users":
+                response = await client.get("/auth/users", params={"limit": 50}, headers=headers)
+            elif operation == "login":
+                response = await client.post(
+                    "/auth/login", json={"email": rng.choice(emails), "password": SEED_PASSWORD}
+                )
+            else:
+                email = f"bench-new-{uuid.uuid4().hex}@example.com"
+                response = await client.post(
+                    "/auth/register", json={"name": "Bench", "email": email, "password": SEED_PASSWORD}
+                )
+            samples[operation].append((time.perf_counter() - start, response.status_code))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(i) for i in range(concurrency)))
+    return summarize(samples, time.perf_counter() - started)
+
+
+def error_rate(result):
+    """Fracción de peticiones con respuesta 4xx/5xx en toda la ejecución"""
+    errors = sum(stats["errors"] for stats in result["endpoints"].values())
+    return errors / max(1, result["total_requests"])
+
+
+def thin_endpoints(result, min_samples=MIN_SAMPLES):
+    """Endpoints con menos de min_samples peticiones"""
+    return sorted(name for name, stats in result["endpoints"].items() if stats["count"] < min_samples)
+
+
+def compare_with_baseline(result, baseline, tolerance, min_samples=MIN_SAMPLES):
+    """Lista de regresiones respecto a la línea base (vacía si no hay).
+
+    ValueError si la ejecución o la línea base tienen endpoints con pocas muestras.
+    """
+    thin = thin_endpoints(result, min_samples) + [f"{name} (línea base)" for name in thin_endpoints(baseline, min_samples)]
+    if thin:
+        raise ValueError(f"menos de {min_samples} muestras en {', '.join(thin)}")
+    regressions = []
+    if result["throughput_rps"] < baseline["throughput_rps"] * (1 - tolerance):
+        regressions.append(
+            f"throughput {result['throughput_rps']} rps < {baseline['throughput_rps']} rps"
+        )
+    for name, stats in result["endpoints"].items():
+        reference = baseline["endpoints"].get(name)
+        if reference is None:
+            continue
+        error_rate = stats["errors"] / max(1, stats["count"])
+        reference_error_rate = reference["errors"] / max(1, reference["count"])
+        if error_rate > reference_error_rate + 0.05:
+            regressions.append(f"{name} errores {error_rate:.1%} > {reference_error_rate:.1%}")
+        for metric in ("p95_ms", "p99_ms"):
+            if stats[metric] > reference[metric] * (1 + tolerance):
+                regressions.append(f"{name} {metric} {stats[metric]} > {reference[metric]}")
+    return regressions
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(workers, env):
+    """Arrancar `main.py serve` en un puerto libre y esperar a que responda"""
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, "main.py", "serve", "--host", "127.0.0.1", "--port", str(port),
+         "--workers", str(workers), "--log-level", "warning"],
+        env=env,
+        cwd=BACKEND_DIR,
+    )
+    url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            httpx.get(url + "/", timeout=0.5)
+            return process, url
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("El servidor no arrancó")
+
+
+async def benchmark(args):
+    seed_count = max(args.users, args.tokens)
+    if args.server or args.url:
+        process = None
+        url = args.url
+        if args.server:
+            process, url = start_server(args.workers, os.environ.copy())
+        try:
+            async with httpx.AsyncClient(base_url=url, timeout=30) as client:
+                headers = await admin_headers(client, args.admin_email, args.admin_password)
+                emails = await seed_users(client, seed_count, headers)
+                tokens = await login_tokens(client, emails[:args.tokens])
+                return await run_load(client, args.mix, args.duration, args.concurrency, emails, tokens)
+        finally:
+            if process is not None:
+                process.terminate()
+                process.wait()
+
+    import main
+    main.migrate()
+    transport = httpx.ASGITransport(app=main.app)
+    async with main.app.router.lifespan_context(main.app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=30) as client:
+            emails = await seed_users(client, seed_count, await admin_headers(client))
+            tokens = await login_tokens(client, emails[:args.tokens])
+            return await run_load(client, args.mix, args.duration, args.concurrency, emails, tokens)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de carga de la API de autenticación")
+    parser.add_argument("--mix", choices=sorted(MIXES), default="read-heavy")
+    parser.add_argument("--duration", type=float, default=10, help="Segundos de carga")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--users", type=int, default=200, help="Usuarios a crear antes de la carga")
+    parser.add_argument("--tokens", type=int, default=20, help="Usuarios con sesión para las lecturas")
+    parser.add_argument("--server", action="store_true", help="Lanzar un uvicorn local en lugar de ASGI en proceso")
+    parser.add_argument("--workers", type=int, default=1, help="Workers de uvicorn con --server")
+    parser.add_argument("--url", help="Atacar un servidor ya arrancado")
+    parser.add_argument("--admin-email", default=ADMIN_EMAIL, help="Administrador para sembrar usuarios con --url")
+    parser.add_argument("--admin-password", default=SEED_PASSWORD)
+    parser.add_argument("--output", help="Guardar el resultado JSON en este fichero")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Margen antes de marcar una regresión")
+    parser.add_argument("--max-error-rate", type=float, default=0.01,
+                        help="Errores tolerados al guardar una línea base (fracción)")
+    parser.add_argument("--min-samples", type=int, default=MIN_SAMPLES,
+                        help="Peticiones mínimas por endpoint para guardar o comparar una línea base")
+    parser.add_argument("--keep-rate-limits", action="store_true", help="No desactivar el límite de logins")
+    args = parser.parse_args()
+
+    # Base de datos desechable y sin límite de logins: todo el tráfico sale de una IP
+    workdir = tempfile.mkdtemp(prefix="auth-bench-")
+    if not args.url:
+        os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+        os.environ["ADMIN_EMAILS"] = ADMIN_EMAIL
+        # El bucle cerrado nunca tiene más de `concurrency` hashes en vuelo: con una cola
+        # más corta se mediría la velocidad de los 503 del pool de hashing, no la de los logins
+        os.environ.setdefault("HASH_QUEUE_SIZE", str(args.concurrency))
+        # La configuración recomendada para producción con SQLite: con el journal por defecto
+        # las lecturas de /auth/me esperan a las escrituras de los logins y se mide el bloqueo
+        os.environ.setdefault("SQLITE_PROFILE", "production")
+    if not args.keep_rate_limits:
+        os.environ["LOGIN_IP_BURST"] = "0"
+        os.environ["LOGIN_EMAIL_BURST"] = "0"
+        os.environ["REGISTER_BATCH_IP_BURST"] = "0"
+
+    result = asyncio.run(benchmark(args))
+    mode = "url" if args.url else ("server" if args.server else "asgi")
+    result = {
+        "mix": args.mix,
+        "mode": mode,
+        "duration_s": args.duration,
+        "concurrency": args.concurrency,
+        "users": args.users,
+        "config": {
+            "cpus": os.cpu_count(),
+            "sqlite_profile": os.environ.get("SQLITE_PROFILE", "default"),
+            "bcrypt_rounds": os.environ.get("BCRYPT_ROUNDS", "12"),
+        },
+        **result,
+    }
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(result, output, indent=2)
+
+    key = f"{mode}:{args.mix}"
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            baselines = json.load(baseline_file)
+    if args.save_baseline:
+        # Una línea base con errores mide el rechazo de peticiones y vuelve inútil la comparación
+        if error_rate(result) > args.max_error_rate:
+            print(
+                f"No se guarda la línea base: {error_rate(result):.1%} de errores "
+                f"(máximo {args.max_error_rate:.1%})",
+                file=sys.stderr,
+            )
+            sys.exit(1)
+        thin = thin_endpoints(result, args.min_samples)
+        if thin:
+            print(
+                f"No se guarda la línea base: menos de {args.min_samples} muestras en {', '.join(thin)} "
+                "(alarga --duration)",
+                file=sys.stderr,
+            )
+            sys.exit(1)
+        baselines[key] = result
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(baselines, baseline_file, indent=2, sort_keys=True)
+        print(f"Línea base guardada en {args.baseline} ({key})", file=sys.stderr)
+    elif key in baselines:
+        if baselines[key].get("config") != result["config"]:
+            print("Aviso: la línea base se midió con otra configuración", file=sys.stderr)
+        try:
+            regressions = compare_with_baseline(result, baselines[key], args.tolerance, args.min_samples)
+        except ValueError as error:
+            print(f"No se puede comparar con la línea base ({key}): {error}", file=sys.stderr)
+            sys.exit(1)
+        for regression in regressions:
+            print(f"REGRESIÓN: {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+        print(f"Sin regresiones frente a la línea base ({key})", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+"""
+Microbenchmarks de las primitivas calientes de la autenticación.
+
+Mide por separado verify_password, get_password_hash, create_access_token, la
+validación del token de get_current_user (decode_access_token), get_user_by_email
+sobre tablas de 10k y 1M filas y la serialización de UserResponse. Cada caso se
+repite en varias rondas con el GC desactivado y se guardan la mediana, el mínimo
+y la dispersión por operación; el resultado se compara con una línea base y el
+comando sale con código 1 si el mínimo de algún caso empeora más que la
+tolerancia (o que tres veces la dispersión medida, si es mayor).
+
+Las tablas de usuarios se generan una vez con datos deterministas (mismo hash,
+mismas fechas) y se reutilizan entre ejecuciones desde --fixtures-dir.
+
+Uso (desde backend/):
+    python -m benchmarks.micro
+    python -m benchmarks.micro --cases create_access_token,decode_access_token
+    python -m benchmarks.micro --sizes 10000 --save-baseline
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import timeit
+from datetime import datetime, timedelta
+from itertools import cycle
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baselines", "micro.json")
+FIXTURES_DIR = os.path.join(tempfile.gettempdir(), "auth-micro-fixtures")
+PASSWORD = "benchpass123"
+FIXTURE_CREATED_AT = datetime(2024, 1, 1)
+FIXTURE_CHUNK = 50_000
+LOOKUP_SEED = 42
+
+
+def fixture_email(i):
+    return f"user{i:07d}@bench.example"
+
+
+def user_fixture(main, rows, fixtures_dir, hashed_password):
+    """Engine sobre una base de datos con `rows` usuarios; se crea solo la primera vez"""
+    from sqlalchemy import create_engine, insert
+
+    path = os.path.join(fixtures_dir, f"users-{rows}.db")
+    if not os.path.exists(path):
+        os.makedirs(fixtures_dir, exist_ok=True)
+        # Se construye aparte y se renombra al final: una ejecución cortada no deja un fixture a medias
+        partial = path + ".partial"
+        if os.path.exists(partial):
+            os.remove(partial)
+        build_engine = create_engine(f"sqlite:///{partial}")
+        main.migrate(build_engine)
+        with build_engine.begin() as connection:
+            for start in range(0, rows, FIXTURE_CHUNK):
+                connection.execute(insert(main.User), [
+                    {
+                        "name": f"User {i}",
+                        "email": fixture_email(i),
+                        "hashed_password": hashed_password,
+                        "created_at": FIXTURE_CREATED_AT,
+                    }
+                    for i in range(start, min(rows, start + FIXTURE_CHUNK))
+                ])
+        build_engine.dispose()
+        os.replace(partial, path)
+    return create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False})
+
+
+def run_coroutine(coro):
+    """Ejecutar una corrutina que no llega a suspenderse, sin el coste de un event loop"""
+    try:
+        coro.send(None)
+    except StopIteration as stop:
+        return stop.value
+    coro.close()
+    raise RuntimeError("La corrutina se suspendió: el caso no es síncrono")
+
+
+def measure(fn, rounds, min_time):
+    """Mediana, mínimo y dispersión del tiempo por operación (µs) en `rounds` rondas"""
+    fn()
+    number, _ = timeit.Timer(fn).autorange()
+    # autorange apunta a 0,2 s por ronda; se escala para respetar min_time
+    number = max(1, int(number * min_time / 0.2))
+    totals = timeit.Timer(fn).repeat(repeat=rounds, number=number)
+    per_op = [total / number * 1e6 for total in totals]
+    median = statistics.median(per_op)
+    return {
+        "median_us": round(median, 3),
+        "min_us": round(min(per_op), 3),
+        "stdev_pct": round(statistics.stdev(per_op) / median * 100, 1) if len(per_op) > 1 else 0.0,
+        "rounds": rounds,
+        "number": number,
+    }
+
+
+def build_cases(main, sizes, fixtures_dir):
+    """Casos disponibles: nombre -> función sin argumentos que ejecuta una operación"""
+    from sqlalchemy.orm import Session
+
+    hashed = main.get_password_hash(PASSWORD)
+    user = main.UserResponse(id=1, name="User 1", email=fixture_email(1), created_at=FIXTURE_CREATED_AT)
+    token = main.create_access_token(main.access_token_claims(user), timedelta(hours=1))
+    cases = {
+        "verify_password": lambda: main.verify_password(PASSWORD, hashed),
+        "get_password_hash": lambda: main.get_password_hash(PASSWORD),
+        "create_access_token": lambda: main.create_access_token(
+            main.access_token_claims(user), timedelta(minutes=main.ACCESS_TOKEN_EXPIRE_MINUTES)
+        ),
+        # Lo que hace get_current_user cuando el token no está en token_cache
+        "decode_access_token": lambda: run_coroutine(main.decode_access_token(token, token_db)),
+        # Fila ORM -> UserResponse (lo que se cachea), y después el JSON por defecto y el de FAST_JSON
+        "user_response_validate": lambda: main.UserResponse.model_validate(user_row),
+        "user_response_json": lambda: user.model_dump_json(),
+        "user_response_fast_json": lambda: main.user_serializer.dump_json(user),
+    }
+    sessions = []
+    token_db = None
+    for rows in sizes:
+        db = Session(user_fixture(main, rows, fixtures_dir, hashed))
+        sessions.append(db)
+        rng = random.Random(LOOKUP_SEED)
+        emails = [fixture_email(rng.randrange(rows)) for _ in range(1000)]
+        lookups = cycle(emails)
+        cases[f"get_user_by_email[{rows}]"] = lambda db=db, lookups=lookups: main.get_user_by_email(db, next(lookups))
+        if token_db is None:
+            token_db = db
+    if token_db is None:
+        token_db = Session(user_fixture(main, 1, fixtures_dir, hashed))
+        sessions.append(token_db)
+    # La lista de revocaciones se carga antes: el caso mide la ruta en memoria
+    main.revocation_list.sync(token_db)
+    user_row = main.get_user_by_email(token_db, fixture_email(0))
+    return cases, sessions
+
+
+def run_benchmarks(main, names=None, sizes=(10_000, 1_000_000), rounds=7, min_time=0.2, fixtures_dir=FIXTURES_DIR):
+    cases, sessions = build_cases(main, sizes, fixtures_dir)
+    try:
+        unknown = set(names or ()) - set(cases)
+        if unknown:
+            raise ValueError(f"Casos desconocidos: {', '.join(sorted(unknown))}")
+        results = {}
+        for name in names or cases:
+            results[name] = measure(cases[name], rounds, min_time)
+            print(f"{name}: {results[name]['median_us']} µs", file=sys.stderr)
+    finally:
+        for db in sessions:
+            db.close()
+    return {
+        "config": {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "password_schemes": main.PASSWORD_SCHEMES,
+            "bcrypt_rounds": main.BCRYPT_ROUNDS,
+            "jwt_algorithm": main.ALGORITHM,
+            "orjson": main.orjson is not None,
+        },
+        "cases": results,
+    }
+
+
+def allowed_slowdown(stats, reference, tolerance):
+    """Margen de un caso: nunca por debajo de tres veces la dispersión de cualquiera de las dos ejecuciones"""
+    spread = max(stats.get("stdev_pct", 0.0), reference.get("stdev_pct", 0.0)) / 100
+    return max(tolerance, 3 * spread)
+
+
+def compare_with_baseline(result, baseline, tolerance):
+    """Lista de regresiones respecto a la línea base (vacía si no hay)"""
+    regressions = []
+    for name, stats in result["cases"].items():
+        reference = baseline["cases"].get(name)
+        if reference is None:
+            continue
+        # El mínimo es la medida menos afectada por el ruido de la máquina; la mediana, si falta
+        metric = "min_us" if "min_us" in stats and "min_us" in reference else "median_us"
+        if stats[metric] > reference[metric] * (1 + allowed_slowdown(stats, reference, tolerance)):
+            regressions.append(f"{name} {stats[metric]} µs > {reference[metric]} µs ({metric})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks de las primitivas de autenticación")
+    parser.add_argument("--cases", help="Casos separados por comas (por defecto todos)")
+    parser.add_argument("--sizes", default="10000,1000000", help="Filas de las tablas para get_user_by_email")
+    parser.add_argument("--rounds", type=int, default=7)
+    parser.add_argument("--min-time", type=float, default=0.2, help="Segundos mínimos por ronda")
+    parser.add_argument("--bcrypt-rounds", type=int, default=12, help="Coste fijo para que las líneas base sean comparables")
+    parser.add_argument("--fixtures-dir", default=FIXTURES_DIR)
+    parser.add_argument("--output", help="Guardar el resultado JSON en este fichero")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Margen antes de marcar una regresión")
+    args = parser.parse_args()
+
+    # Configuración fija y una base de datos desechable: importar main no toca auth.db
+    workdir = tempfile.mkdtemp(prefix="auth-micro-")
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'micro.db')}"
+    os.environ["BCRYPT_ROUNDS"] = str(args.bcrypt_rounds)
+    os.environ["PASSWORD_SCHEMES"] = "bcrypt"
+    os.environ["JWT_ALGORITHM"] = "HS256"
+    os.environ["STATELESS_TOKENS"] = "false"
+    os.environ["REVOCATION_SYNC_SECONDS"] = "3600"
+    import main as app_main
+
+    names = [name.strip() for name in args.cases.split(",")] if args.cases else None
+    sizes = [int(size) for size in args.sizes.split(",") if size.strip()]
+    result = run_benchmarks(app_main, names, sizes, args.rounds, args.min_time, args.fixtures_dir)
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(result, output, indent=2)
+
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    if args.save_baseline:
+        # Se conservan los casos que esta ejecución no ha medido
+        cases = {**(baseline or {}).get("cases", {}), **result["cases"]}
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, "w") as baseline_file:
+            json.dump({"config": result["config"], "cases": cases}, baseline_file, indent=2, sort_keys=True)
+        print(f"Línea base guardada en {args.baseline}", file=sys.stderr)
+    elif baseline is not None:
+        if baseline["config"] != result["config"]:
+            print("Aviso: la línea base se midió con otra configuración", file=sys.stderr)
+        regressions = compare_with_baseline(result, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESIÓN: {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+        print("Sin regresiones frente a la línea base", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
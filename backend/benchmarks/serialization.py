@@ -0,0 +1,116 @@
+"""
+Benchmark de la serialización de respuestas: camino por defecto frente a FAST_JSON.
+
+Mide en proceso (app ASGI) el tiempo por petición de /auth/me y de una página
+grande de /auth/users con FAST_JSON desactivado y activado, y el coste de
+serializar solo la página (jsonable_encoder + json frente a orjson).
+
+Uso (desde backend/):
+    python -m benchmarks.serialization --users 1000 --requests 200
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import tempfile
+import time
+
+import httpx
+
+from benchmarks.loadtest import ADMIN_EMAIL, SEED_BATCH, admin_headers
+
+PASSWORD = "benchpass123"
+
+
+async def seed(client, count):
+    emails = [f"serial-{i}@example.com" for i in range(count)]
+    headers = await admin_headers(client)
+    for start in range(0, count, SEED_BATCH):
+        response = await client.post("/auth/register/batch", headers=headers, json=[
+            {"name": f"Serial {i}", "email": email, "password": PASSWORD}
+            for i, email in enumerate(emails[start:start + SEED_BATCH], start)
+        ])
+        response.raise_for_status()
+    response = await client.post("/auth/login", json={"email": emails[0], "password": PASSWORD})
+    response.raise_for_status()
+    return response.json()["access_token"]
+
+
+async def time_requests(client, path, headers, requests):
+    """Milisegundos por petición (media y p50) tras unas peticiones de calentamiento"""
+    for _ in range(5):
+        (await client.get(path, headers=headers)).raise_for_status()
+    samples = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        response = await client.get(path, headers=headers)
+        samples.append((time.perf_counter() - start) * 1000)
+        response.raise_for_status()
+    return {"mean_ms": round(statistics.mean(samples), 3), "p50_ms": round(statistics.median(samples), 3)}
+
+
+def time_serializers(main, rows, repeat):
+    """Coste de serializar la página: lo que hace JSONResponse frente a dump_json"""
+    from fastapi.encoders import jsonable_encoder
+
+    def default():
+        return json.dumps(jsonable_encoder(rows), ensure_ascii=False, separators=(",", ":")).encode()
+
+    results = {}
+    for name, serialize in (("default", default), ("fast", lambda: main.dump_json(rows))):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            serialize()
+        results[name] = round((time.perf_counter() - start) / repeat * 1000, 3)
+    return results
+
+
+async def benchmark(args):
+    import main
+    main.migrate()
+    transport = httpx.ASGITransport(app=main.app)
+    async with main.app.router.lifespan_context(main.app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=30) as client:
+            token = await seed(client, args.users)
+            headers = {"Authorization": f"Bearer {token}"}
+            paths = {"me": "/auth/me", "users": f"/auth/users?limit={args.page}"}
+            endpoints = {}
+            for name, path in paths.items():
+                endpoints[name] = {}
+                for mode in ("default", "fast"):
+                    main.FAST_JSON = mode == "fast"
+                    endpoints[name][mode] = await time_requests(client, path, headers, args.requests)
+                default_ms, fast_ms = endpoints[name]["default"]["mean_ms"], endpoints[name]["fast"]["mean_ms"]
+                endpoints[name]["saved_ms"] = round(default_ms - fast_ms, 3)
+                endpoints[name]["saved_pct"] = round((default_ms - fast_ms) / default_ms * 100, 1)
+            rows = [row._asdict() for row in main.list_users(main.SessionLocal(), limit=args.page)]
+    return {
+        "users": args.users,
+        "page": args.page,
+        "orjson": main.orjson is not None,
+        "endpoints": endpoints,
+        "serialize_page_ms": time_serializers(main, rows, args.requests),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de serialización de respuestas")
+    parser.add_argument("--users", type=int, default=1000, help="Usuarios a crear")
+    parser.add_argument("--page", type=int, default=1000, help="Tamaño de página de /auth/users")
+    parser.add_argument("--requests", type=int, default=200, help="Peticiones medidas por modo")
+    args = parser.parse_args()
+
+    # Base de datos desechable; el hashing no se mide, así que se abarata
+    workdir = tempfile.mkdtemp(prefix="auth-serial-")
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'serial.db')}"
+    os.environ["BCRYPT_ROUNDS"] = "4"
+    os.environ["LOGIN_IP_BURST"] = "0"
+    os.environ["LOGIN_EMAIL_BURST"] = "0"
+    os.environ["REGISTER_BATCH_IP_BURST"] = "0"
+    os.environ["ADMIN_EMAILS"] = ADMIN_EMAIL
+    print(json.dumps(asyncio.run(benchmark(args)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
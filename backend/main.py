@@ -1,31 +1,268 @@
-from fastapi import FastAPI, HTTPException, Depends, status
+from fastapi import FastAPI, BackgroundTasks, HTTPException, Depends, Query, Request, Response, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy import Column, Integer, String, DateTime, create_engine
+from fastapi.concurrency import run_in_threadpool as starlette_run_in_threadpool
+from sqlalchemy import (
+    Column, Integer, LargeBinary, String, DateTime, bindparam, create_engine, delete, event, func, insert, inspect,
+    literal_column, or_, select, table, update,
+)
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.orm import sessionmaker, Session
-from pydantic import BaseModel, EmailStr
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
+from pydantic import BaseModel, EmailStr, Field, TypeAdapter
+from pydantic_core import to_json
 from passlib.context import CryptContext
-from jose import JWTError, jwt
+from jose import JWTError, jwk, jwt
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import List, Literal, Optional, Union
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait
+from bisect import bisect_left
+from itertools import islice
+from contextlib import ExitStack, asynccontextmanager, contextmanager, nullcontext
+from contextvars import ContextVar
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+import asyncio
+import csv
+import hashlib
+import heapq
+import io
+import json
+import math
 import os
+import secrets
+import sys
+import threading
+import time
+import uuid
 from dotenv import load_dotenv
 
+try:
+    import orjson
+except ImportError:  # opcional: sin orjson, FAST_JSON serializa con pydantic-core
+    orjson = None
+
 # Cargar variables de entorno
 load_dotenv()
 
 # Configuración
 SECRET_KEY = os.getenv("SECRET_KEY", "tu-clave-secreta-muy-segura-aqui")
-ALGORITHM = "HS256"
+# HS256 firma con SECRET_KEY; RS256/ES256 firman con las claves rotables de JWT_KEYS_DIR
+ALGORITHM = os.getenv("JWT_ALGORITHM", "HS256")
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+# Los refresh tokens renuevan el token de acceso sin volver a verificar la contraseña
+REFRESH_TOKEN_EXPIRE_DAYS = int(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", 14))
+MIN_PASSWORD_LENGTH = 6
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./auth.db")
+# Crear las tablas que falten al arrancar; en producción mejor `python main.py migrate`
+AUTO_MIGRATE = os.getenv("AUTO_MIGRATE", "true").lower() in ("1", "true", "yes")
+
+# Claves de firma asimétricas (ver `python main.py keys generate`)
+JWT_KEYS_DIR = os.getenv("JWT_KEYS_DIR", "./keys")
+JWT_ACTIVE_KID = os.getenv("JWT_ACTIVE_KID")
+JWT_KEYS_RELOAD_SECONDS = int(os.getenv("JWT_KEYS_RELOAD_SECONDS", 60))
+JWKS_MAX_AGE = int(os.getenv("JWKS_MAX_AGE", 300))
+
+# Capa de persistencia asíncrona (AsyncEngine), desactivada por defecto
+DB_ASYNC = os.getenv("DB_ASYNC", "false").lower() in ("1", "true", "yes")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
+
+# Usuarios repartidos por hash del email entre varias bases de datos (URLs separadas
+# por comas); revocaciones, auditoría y demás tablas siguen en DATABASE_URL
+SHARD_URLS = [url.strip() for url in os.getenv("SHARD_URLS", "").split(",") if url.strip()]
+if SHARD_URLS and DB_ASYNC:
+    raise RuntimeError("SHARD_URLS todavía no es compatible con DB_ASYNC")
+
+# Coste del hashing de contraseñas (ajustar con `python main.py calibrate`)
+PASSWORD_SCHEMES = [scheme.strip() for scheme in os.getenv("PASSWORD_SCHEMES", "bcrypt").split(",") if scheme.strip()]
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", 12))
+ARGON2_TIME_COST = int(os.getenv("ARGON2_TIME_COST", 3))
+ARGON2_MEMORY_COST = int(os.getenv("ARGON2_MEMORY_COST", 65536))  # KiB
+ARGON2_PARALLELISM = int(os.getenv("ARGON2_PARALLELISM", 4))
+
+# Pool de hashing: "thread" (bcrypt libera el GIL) o "process"
+HASH_EXECUTOR = os.getenv("HASH_EXECUTOR", "thread")
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", os.cpu_count() or 1))
+# Trabajos que pueden esperar en cola además de los que se están ejecutando
+HASH_QUEUE_SIZE = int(os.getenv("HASH_QUEUE_SIZE", HASH_WORKERS * 4))
+
+# Paginación de /auth/users y tamaño de lote del modo streaming
+USERS_PAGE_SIZE = int(os.getenv("USERS_PAGE_SIZE", 100))
+USERS_MAX_PAGE_SIZE = int(os.getenv("USERS_MAX_PAGE_SIZE", 1000))
+USERS_STREAM_CHUNK = int(os.getenv("USERS_STREAM_CHUNK", 1000))
+
+# Exportación/importación masiva de usuarios (`python main.py users export|import`)
+USERS_IMPORT_CHUNK = int(os.getenv("USERS_IMPORT_CHUNK", 5000))
+
+# Búsqueda de usuarios (/auth/users/search); los trigramas necesitan 3 caracteres
+SEARCH_MIN_LENGTH = 3
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", 20))
+SEARCH_MAX_PAGE_SIZE = int(os.getenv("SEARCH_MAX_PAGE_SIZE", 100))
+
+# /auth/register/batch (solo ADMIN_EMAILS): máximo de usuarios por petición y lotes por minuto y
+# ráfaga por IP; cada usuario es un hash completo, así que un lote multiplica el coste de CPU
+REGISTER_BATCH_MAX = int(os.getenv("REGISTER_BATCH_MAX", 100))
+REGISTER_BATCH_IP_RATE = float(os.getenv("REGISTER_BATCH_IP_RATE", 6))
+REGISTER_BATCH_IP_BURST = int(os.getenv("REGISTER_BATCH_IP_BURST", 3))
+
+# /auth/email-available: consultas por minuto y ráfaga por IP; sin límite serviría
+# para enumerar qué emails tienen cuenta
+EMAIL_CHECK_IP_RATE = float(os.getenv("EMAIL_CHECK_IP_RATE", 30))
+EMAIL_CHECK_IP_BURST = int(os.getenv("EMAIL_CHECK_IP_BURST", 10))
+
+# Control de admisión de /auth/login: intentos por minuto y ráfaga por IP y por email
+LOGIN_IP_RATE = float(os.getenv("LOGIN_IP_RATE", 60))
+LOGIN_IP_BURST = int(os.getenv("LOGIN_IP_BURST", 30))
+LOGIN_EMAIL_RATE = float(os.getenv("LOGIN_EMAIL_RATE", 10))
+LOGIN_EMAIL_BURST = int(os.getenv("LOGIN_EMAIL_BURST", 10))
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", 100000))
+
+# Revocación de tokens: filtro de Bloom en memoria y sincronización con la tabla
+REVOCATION_BLOOM_CAPACITY = int(os.getenv("REVOCATION_BLOOM_CAPACITY", 100000))
+REVOCATION_BLOOM_ERROR_RATE = float(os.getenv("REVOCATION_BLOOM_ERROR_RATE", 0.001))
+REVOCATION_SYNC_SECONDS = int(os.getenv("REVOCATION_SYNC_SECONDS", 30))
+REVOCATION_PURGE_SECONDS = int(os.getenv("REVOCATION_PURGE_SECONDS", 3600))
+
+# Emails registrados: filtro de Bloom en memoria para /auth/email-available y el registro
+EMAIL_BLOOM_CAPACITY = int(os.getenv("EMAIL_BLOOM_CAPACITY", 1000000))
+EMAIL_BLOOM_ERROR_RATE = float(os.getenv("EMAIL_BLOOM_ERROR_RATE", 0.01))
+EMAIL_SYNC_SECONDS = int(os.getenv("EMAIL_SYNC_SECONDS", 30))
+EMAIL_REBUILD_SECONDS = int(os.getenv("EMAIL_REBUILD_SECONDS", 3600))
+
+# Registro de auditoría: buffer en memoria y escritor en segundo plano por lotes
+AUDIT_BUFFER_SIZE = int(os.getenv("AUDIT_BUFFER_SIZE", 10000))
+AUDIT_BATCH_SIZE = int(os.getenv("AUDIT_BATCH_SIZE", 500))
+AUDIT_FLUSH_SECONDS = float(os.getenv("AUDIT_FLUSH_SECONDS", 1.0))
+AUDIT_PAGE_SIZE = int(os.getenv("AUDIT_PAGE_SIZE", 100))
+AUDIT_MAX_PAGE_SIZE = int(os.getenv("AUDIT_MAX_PAGE_SIZE", 1000))
+# Emails que pueden consultar los eventos de todos los usuarios (el resto solo ve los suyos)
+AUDIT_ADMIN_EMAILS = {
+    email.strip() for email in os.getenv("AUDIT_ADMIN_EMAILS", os.getenv("ADMIN_EMAILS", "")).split(",") if email.strip()
+}
+
+# Administradores: acceso a /admin/* (el profiler bajo demanda)
+ADMIN_EMAILS = {email.strip() for email in os.getenv("ADMIN_EMAILS", "").split(",") if email.strip()}
+
+# /stats y /metrics: token Bearer para el scraper (Prometheus); sin él solo los administradores
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+# Profiler de muestreo bajo demanda (/admin/profile)
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", 5))
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", 60))
+PROFILE_MAX_REQUESTS = int(os.getenv("PROFILE_MAX_REQUESTS", 1000))
+
+# Caché de tokens verificados (entradas y segundos de vida, nunca más allá del exp)
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", 10000))
+TOKEN_CACHE_TTL = int(os.getenv("TOKEN_CACHE_TTL", 60))
+
+# Servidor de producción (`python main.py serve`): workers, espera al reiniciar y
+# segundos sin responder al ping del maestro antes de dar un worker por colgado
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1))
+SERVER_GRACEFUL_TIMEOUT = int(os.getenv("SERVER_GRACEFUL_TIMEOUT", 30))
+SERVER_READY_TIMEOUT = int(os.getenv("SERVER_READY_TIMEOUT", 30))
+
+# Tokens autocontenidos: llevan id, nombre y fecha de alta y get_current_user no consulta la base de datos
+STATELESS_TOKENS = os.getenv("STATELESS_TOKENS", "false").lower() in ("1", "true", "yes")
+
+# Serialización rápida de respuestas (orjson y serializadores precompilados)
+FAST_JSON = os.getenv("FAST_JSON", "false").lower() in ("1", "true", "yes")
+
+# Perfil de SQLite: "default" o "production" (WAL, pragmas y pools de lectura/escritura separados)
+SQLITE_PROFILE = os.getenv("SQLITE_PROFILE", "default")
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", 268435456))  # bytes
+SQLITE_CACHE_SIZE = int(os.getenv("SQLITE_CACHE_SIZE", -65536))  # negativo = KiB
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", 5000))
+SQLITE_READ_POOL_SIZE = int(os.getenv("SQLITE_READ_POOL_SIZE", 4))
 
 # Configuración de base de datos
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False} if "sqlite" in DATABASE_URL else {})
+SQLITE_PRODUCTION = DATABASE_URL.startswith("sqlite") and SQLITE_PROFILE == "production"
+
+def apply_sqlite_pragmas(dbapi_connection, connection_record, read_only: bool = False):
+    """Pragmas del perfil production, aplicados a cada conexión nueva"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    cursor.execute(f"PRAGMA cache_size={SQLITE_CACHE_SIZE}")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    if read_only:
+        cursor.execute("PRAGMA query_only=ON")
+    cursor.close()
+
+def apply_sqlite_read_pragmas(dbapi_connection, connection_record):
+    apply_sqlite_pragmas(dbapi_connection, connection_record, read_only=True)
+
+read_engine = None
+ReadSessionLocal = None
+if SQLITE_PRODUCTION:
+    # Un único escritor: las escrituras esperan turno en el pool en vez de
+    # fallar con "database is locked"; los lectores no se bloquean gracias a WAL
+    sqlite_connect_args = {"check_same_thread": False, "timeout": SQLITE_BUSY_TIMEOUT_MS / 1000}
+    engine = create_engine(
+        DATABASE_URL,
+        connect_args=sqlite_connect_args,
+        pool_size=1,
+        max_overflow=0,
+        pool_timeout=DB_POOL_TIMEOUT,
+    )
+    read_engine = create_engine(
+        DATABASE_URL,
+        connect_args=sqlite_connect_args,
+        pool_size=SQLITE_READ_POOL_SIZE,
+        max_overflow=0,
+        pool_timeout=DB_POOL_TIMEOUT,
+    )
+    event.listen(engine, "connect", apply_sqlite_pragmas)
+    event.listen(read_engine, "connect", apply_sqlite_read_pragmas)
+    ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
+else:
+    engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False} if "sqlite" in DATABASE_URL else {})
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+    "postgres": "postgresql+asyncpg",
+    "mysql": "mysql+aiomysql",
+}
+
+def get_async_database_url(url: str) -> str:
+    """Traducir una URL de base de datos a su driver asíncrono equivalente"""
+    scheme, sep, rest = url.partition("://")
+    if not sep:
+        return url
+    dialect, _, driver = scheme.partition("+")
+    if driver in ("aiosqlite", "asyncpg", "aiomysql"):
+        return url
+    return f"{ASYNC_DRIVERS.get(dialect, scheme)}://{rest}"
+
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL", get_async_database_url(DATABASE_URL))
+
+async_engine = None
+AsyncSessionLocal = None
+if DB_ASYNC:
+    # aiosqlite usa NullPool (una conexión por sesión), que no admite los parámetros de tamaño de pool
+    pool_options = {}
+    if not ASYNC_DATABASE_URL.startswith("sqlite"):
+        pool_options = {"pool_size": DB_POOL_SIZE, "max_overflow": DB_MAX_OVERFLOW, "pool_timeout": DB_POOL_TIMEOUT}
+    async_engine = create_async_engine(
+        ASYNC_DATABASE_URL,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=True,
+        **pool_options,
+    )
+    AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+    if SQLITE_PRODUCTION:
+        event.listen(async_engine.sync_engine, "connect", apply_sqlite_pragmas)
+
 # Modelo de base de datos
 class User(Base):
     __tablename__ = "users"
@@ -35,9 +272,94 @@ class User(Base):
     email = Column(String, unique=True, index=True)
     hashed_password = Column(String)
     created_at = Column(DateTime, default=datetime.utcnow)
+    # Se incrementa en cada UPDATE del ORM; con el id forma el ETag de /auth/me
+    version = Column(Integer, nullable=False, default=1, server_default="1")
+
+    __mapper_args__ = {"version_id_col": version}
+
+# Columnas públicas: nunca se carga hashed_password para listar usuarios
+USER_PUBLIC_COLUMNS = (User.id, User.name, User.email, User.created_at)
+
+# Índice de búsqueda por subcadena: FTS5 con trigramas en SQLite (tabla de
+# contenido externo sincronizada por triggers) y pg_trgm en PostgreSQL
+SQLITE_SEARCH_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5("
+    "name, email, content='users', content_rowid='id', tokenize='trigram')",
+    "CREATE TRIGGER IF NOT EXISTS users_fts_ai AFTER INSERT ON users BEGIN "
+    "INSERT INTO users_fts(rowid, name, email) VALUES (new.id, new.name, new.email); END",
+    "CREATE TRIGGER IF NOT EXISTS users_fts_ad AFTER DELETE ON users BEGIN "
+    "INSERT INTO users_fts(users_fts, rowid, name, email) VALUES ('delete', old.id, old.name, old.email); END",
+    "CREATE TRIGGER IF NOT EXISTS users_fts_au AFTER UPDATE OF name, email ON users BEGIN "
+    "INSERT INTO users_fts(users_fts, rowid, name, email) VALUES ('delete', old.id, old.name, old.email); "
+    "INSERT INTO users_fts(rowid, name, email) VALUES (new.id, new.name, new.email); END",
+)
+POSTGRES_SEARCH_DDL = (
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS ix_users_name_trgm ON users USING gin (name gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_users_email_trgm ON users USING gin (email gin_trgm_ops)",
+)
+users_fts = table("users_fts")
+
+def create_search_index(connection):
+    """Crear el índice de búsqueda del dialecto; idempotente"""
+    dialect = connection.dialect.name
+    if dialect == "sqlite":
+        exists = connection.exec_driver_sql("SELECT 1 FROM sqlite_master WHERE name = 'users_fts'").first()
+        for statement in SQLITE_SEARCH_DDL:
+            connection.exec_driver_sql(statement)
+        if not exists:
+            # Indexar los usuarios que ya hubiera antes de crear el índice
+            connection.exec_driver_sql("INSERT INTO users_fts(users_fts) VALUES ('rebuild')")
+    elif dialect == "postgresql":
+        for statement in POSTGRES_SEARCH_DDL:
+            connection.exec_driver_sql(statement)
+
+@event.listens_for(User.__table__, "after_create")
+def _create_search_index(target, connection, **kw):
+    create_search_index(connection)
+
+class TableVersion(Base):
+    """Contador de cambios por tabla: ETag de los listados sin leer las filas"""
+    __tablename__ = "table_versions"
 
-# Crear tablas
-Base.metadata.create_all(bind=engine)
+    name = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+@event.listens_for(TableVersion.__table__, "after_create")
+def _seed_table_versions(target, connection, **kw):
+    connection.execute(insert(target), [{"name": User.__tablename__, "version": 0}])
+
+def bump_table_version(name: str):
+    """UPDATE del contador; se ejecuta en la misma transacción que modifica la tabla"""
+    return update(TableVersion).where(TableVersion.name == name).values(version=TableVersion.version + 1)
+
+class RevokedToken(Base):
+    __tablename__ = "revoked_tokens"
+
+    jti = Column(String, primary_key=True)
+    expires_at = Column(DateTime, index=True)
+    revoked_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+class RefreshToken(Base):
+    """Refresh token opaco: solo se guarda su SHA-256. Los de una familia salen del mismo login"""
+    __tablename__ = "refresh_tokens"
+
+    id = Column(Integer, primary_key=True)
+    token_hash = Column(LargeBinary(32), unique=True, nullable=False)
+    family = Column(String(32), index=True, nullable=False)
+    email = Column(String, index=True, nullable=False)
+    expires_at = Column(DateTime, index=True, nullable=False)
+    used_at = Column(DateTime, nullable=True)
+
+class AuditEvent(Base):
+    __tablename__ = "audit_events"
+
+    id = Column(Integer, primary_key=True)
+    event = Column(String, index=True)  # login, login_failed, register, logout, delete, refresh_reuse
+    email = Column(String, index=True)
+    user_id = Column(Integer, nullable=True)
+    ip = Column(String, nullable=True)
+    created_at = Column(DateTime, index=True)
 
 # Esquemas Pydantic
 class UserBase(BaseModel):
@@ -54,6 +376,7 @@ class UserLogin(BaseModel):
 class UserResponse(UserBase):
     id: int
     created_at: datetime
+    version: int = Field(1, exclude=True)
 
     class Config:
         from_attributes = True
@@ -62,16 +385,1179 @@ class Token(BaseModel):
     access_token: str
     token_type: str
     user: UserResponse
+    refresh_token: Optional[str] = None
+
+class RefreshRequest(BaseModel):
+    refresh_token: str
+
+class BatchRegisterResult(BaseModel):
+    email: str
+    status: Literal["created", "duplicate", "invalid"]
+    detail: Optional[str] = None
+    user: Optional[UserResponse] = None
+
+class AuditEventResponse(BaseModel):
+    id: int
+    event: str
+    email: str
+    user_id: Optional[int] = None
+    ip: Optional[str] = None
+    created_at: datetime
+
+    class Config:
+        from_attributes = True
+
+class ProfileRequest(BaseModel):
+    requests: int = Field(10, ge=1, le=PROFILE_MAX_REQUESTS)
+    endpoint: Optional[str] = Field(None, description='"POST /auth/login" o solo la ruta')
+    header: Optional[str] = Field(None, description="Solo peticiones que traigan esta cabecera")
+    interval_ms: float = Field(PROFILE_INTERVAL_MS, ge=1, le=1000)
+    max_seconds: int = Field(PROFILE_MAX_SECONDS, ge=1, le=3600)
+
+# Serializadores precompilados para el modo FAST_JSON: los handlers devuelven
+# los bytes ya generados y FastAPI no vuelve a validar la respuesta
+user_serializer = TypeAdapter(UserResponse)
+token_serializer = TypeAdapter(Token)
+batch_serializer = TypeAdapter(List[BatchRegisterResult])
+
+def dump_json(content) -> bytes:
+    """JSON de dicts/listas con datetime, con orjson si está instalado"""
+    if orjson is not None:
+        return orjson.dumps(content)
+    return to_json(content)
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse que acepta bytes ya serializados y usa orjson para el resto"""
+
+    def render(self, content) -> bytes:
+        if isinstance(content, bytes):
+            return content
+        return dump_json(content)
 
 # Configuración de seguridad
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+def build_crypt_context() -> CryptContext:
+    """CryptContext con el coste configurado; el primer esquema es el que se usa al hashear"""
+    settings = {"bcrypt__rounds": BCRYPT_ROUNDS}
+    if "argon2" in PASSWORD_SCHEMES:
+        settings.update(
+            argon2__time_cost=ARGON2_TIME_COST,
+            argon2__memory_cost=ARGON2_MEMORY_COST,
+            argon2__parallelism=ARGON2_PARALLELISM,
+        )
+    return CryptContext(schemes=PASSWORD_SCHEMES, deprecated="auto", **settings)
+
+pwd_context = build_crypt_context()
 security = HTTPBearer()
+optional_security = HTTPBearer(auto_error=False)
+
+class HashQueueFull(Exception):
+    """El pool de hashing está saturado"""
+
+def load_hash_backends():
+    """Cargar los backends de hashing (passlib los prueba en el primer uso)"""
+    for scheme in PASSWORD_SCHEMES:
+        pwd_context.handler(scheme).get_backend()
+
+class PasswordHasher:
+    """Pool acotado que ejecuta bcrypt fuera del event loop"""
+
+    def __init__(self, kind: str, workers: int, queue_size: int):
+        self.kind = kind
+        self.workers = workers
+        self.queue_size = queue_size
+        self.in_flight = 0
+        self.peak = 0
+        self.completed = 0
+        self.rejected = 0
+        self._executor = None
+
+    def _get_executor(self):
+        # El pool se crea con el primer trabajo para no lanzar procesos al importar
+        if self._executor is None:
+            if self.kind == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="hash")
+        return self._executor
+
+    async def run(self, func, *args):
+        """Ejecutar func en el pool o rechazar con HashQueueFull si la cola está llena"""
+        if self.in_flight >= self.workers + self.queue_size:
+            self.rejected += 1
+            raise HashQueueFull()
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+        try:
+            loop = asyncio.get_running_loop()
+            # Los procesos no se pueden muestrear desde aquí (y el envoltorio no se serializa)
+            if self.kind != "process":
+                func = profiled(func)
+            return await loop.run_in_executor(self._get_executor(), func, *args)
+        finally:
+            self.in_flight -= 1
+            self.completed += 1
+
+    async def map(self, func, items: list) -> list:
+        """Ejecutar func sobre cada elemento en paralelo sin superar los workers del pool"""
+        results = []
+        step = max(1, self.workers)
+        for start in range(0, len(items), step):
+            chunk = items[start:start + step]
+            results.extend(await asyncio.gather(*(self.run(func, item) for item in chunk)))
+        return results
+
+    def warm_up(self):
+        """Crear el pool y, con procesos, cargar el backend en cada uno antes del primer login"""
+        executor = self._get_executor()
+        if self.kind == "process":
+            for future in [executor.submit(load_hash_backends) for _ in range(self.workers)]:
+                future.result()
+
+    def stats(self) -> dict:
+        return {
+            "executor": self.kind,
+            "workers": self.workers,
+            "queue_size": self.queue_size,
+            "in_flight": self.in_flight,
+            "queue_depth": max(0, self.in_flight - self.workers),
+            "peak_in_flight": self.peak,
+            "completed": self.completed,
+            "rejected": self.rejected,
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+password_hasher = PasswordHasher(HASH_EXECUTOR, HASH_WORKERS, HASH_QUEUE_SIZE)
+
+class HashTimings:
+    """Tiempos de verificación de contraseñas agrupados por esquema"""
+
+    def __init__(self):
+        self._stats = {}  # esquema -> [verificaciones, segundos totales, máximo]
+        self._lock = threading.Lock()
+
+    def record(self, scheme: str, seconds: float):
+        with self._lock:
+            entry = self._stats.setdefault(scheme, [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] = max(entry[2], seconds)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                scheme: {
+                    "count": count,
+                    "avg_ms": round(total / count * 1000, 2),
+                    "max_ms": round(maximum * 1000, 2),
+                }
+                for scheme, (count, total, maximum) in self._stats.items()
+            }
+
+verify_timings = HashTimings()
+
+class TokenCache:
+    """Caché LRU+TTL de tokens ya verificados con la instantánea del usuario"""
+
+    def __init__(self, maxsize: int, ttl: int):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # token -> (caduca_en, usuario, jti)
+        self._by_user = {}  # id de usuario -> tokens en caché
+        self._lock = threading.Lock()
+
+    def get(self, token: str):
+        """(usuario, jti) del token en caché, o None"""
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is not None and entry[0] <= time.time():
+                self._discard(token)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(token)
+            self.hits += 1
+            return entry[1], entry[2]
+
+    def set(self, token: str, user: UserResponse, exp: float, jti: Optional[str] = None):
+        expires_at = min(time.time() + self.ttl, exp)
+        if self.maxsize <= 0 or expires_at <= time.time():
+            return
+        with self._lock:
+            self._discard(token)
+            self._entries[token] = (expires_at, user, jti)
+            self._by_user.setdefault(user.id, set()).add(token)
+            while len(self._entries) > self.maxsize:
+                oldest = next(iter(self._entries))
+                self._discard(oldest)
+                self.evictions += 1
+
+    def invalidate(self, token: str):
+        with self._lock:
+            self._discard(token)
+
+    def invalidate_user(self, user_id: int):
+        with self._lock:
+            for token in list(self._by_user.get(user_id, ())):
+                self._discard(token)
+
+    def _discard(self, token: str):
+        entry = self._entries.pop(token, None)
+        if entry is not None:
+            tokens = self._by_user.get(entry[1].id)
+            if tokens is not None:
+                tokens.discard(token)
+                if not tokens:
+                    del self._by_user[entry[1].id]
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+# Los logouts y bajas hechos en otro worker solo llegan aquí al sincronizar las revocaciones:
+# la TTL no pasa de ese intervalo para no alargar la vida de un token de un usuario borrado
+token_cache = TokenCache(TOKEN_CACHE_SIZE, min(TOKEN_CACHE_TTL, REVOCATION_SYNC_SECONDS))
+
+class TokenBucketLimiter:
+    """Token buckets por clave en un OrderedDict acotado que expulsa la clave menos reciente"""
+
+    def __init__(self, rate_per_minute: float, burst: int, max_keys: int):
+        self.rate = rate_per_minute / 60.0
+        self.burst = burst
+        self.max_keys = max_keys
+        self.allowed = 0
+        self.rejected = 0
+        self.evictions = 0
+        self._buckets = OrderedDict()  # clave -> (tokens, última actualización)
+        self._lock = threading.Lock()
+
+    def hit(self, key: str) -> float:
+        """Consumir un intento: 0 si se admite, o segundos hasta que vuelva a haber uno"""
+        if self.burst <= 0:
+            return 0.0  # Límite desactivado
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.pop(key, (float(self.burst), now))
+            tokens = min(float(self.burst), tokens + (now - last) * self.rate)
+            if tokens >= 1:
+                tokens -= 1
+                retry_after = 0.0
+                self.allowed += 1
+            else:
+                retry_after = (1 - tokens) / self.rate if self.rate > 0 else 60.0
+                self.rejected += 1
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+                self.evictions += 1
+        return retry_after
+
+    def reset(self):
+        with self._lock:
+            self._buckets.clear()
+
+    def stats(self) -> dict:
+        return {
+            "keys": len(self._buckets),
+            "allowed": self.allowed,
+            "rejected": self.rejected,
+            "evictions": self.evictions,
+        }
+
+login_ip_limiter = TokenBucketLimiter(LOGIN_IP_RATE, LOGIN_IP_BURST, RATE_LIMIT_MAX_KEYS)
+login_email_limiter = TokenBucketLimiter(LOGIN_EMAIL_RATE, LOGIN_EMAIL_BURST, RATE_LIMIT_MAX_KEYS)
+register_batch_limiter = TokenBucketLimiter(REGISTER_BATCH_IP_RATE, REGISTER_BATCH_IP_BURST, RATE_LIMIT_MAX_KEYS)
+email_check_limiter = TokenBucketLimiter(EMAIL_CHECK_IP_RATE, EMAIL_CHECK_IP_BURST, RATE_LIMIT_MAX_KEYS)
+
+class BloomFilter:
+    """Filtro de Bloom sobre un bytearray: puede dar falsos positivos, nunca falsos negativos"""
+
+    def __init__(self, capacity: int, error_rate: float):
+        capacity = max(1, capacity)
+        self.size = max(64, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key: str):
+        # Doble hashing: k posiciones a partir de un único digest
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key: str):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+class RevocationList:
+    """Tokens revocados: filtro de Bloom en memoria delante de la tabla revoked_tokens"""
+
+    def __init__(self, capacity: int, error_rate: float, sync_seconds: int, purge_seconds: int):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.sync_seconds = sync_seconds
+        self.purge_seconds = purge_seconds
+        self.entries = 0
+        self.lookups = 0
+        self.bloom_negatives = 0
+        self.false_positives = 0
+        self._bloom = BloomFilter(capacity, error_rate)
+        self._last_revoked_at = None
+        self._synced_at = None
+        self._purged_at = None
+        # Una sola sincronización a la vez; las revocaciones locales durante una reconstrucción
+        # se guardan aquí para añadirlas también al filtro nuevo
+        self._sync_lock = threading.Lock()
+        self._revoked_during_rebuild = None
+
+    def needs_sync(self) -> bool:
+        return self._synced_at is None or time.monotonic() - self._synced_at >= self.sync_seconds
+
+    def might_be_revoked(self, jti: str) -> bool:
+        """Comprobación en memoria; False es definitivo y no necesita E/S"""
+        self.lookups += 1
+        if jti in self._bloom:
+            return True
+        self.bloom_negatives += 1
+        return False
+
+    def sync(self, db: Session):
+        """Cargar revocaciones nuevas (de este u otros workers) y purgar las caducadas"""
+        # Si ya hay una sincronización en curso la petición sigue con el filtro actual;
+        # solo la primera espera, porque antes de ella el filtro está vacío
+        if not self._sync_lock.acquire(blocking=self._synced_at is None):
+            return
+        try:
+            if self.needs_sync():
+                self._sync(db)
+        finally:
+            self._sync_lock.release()
+
+    def _sync(self, db: Session):
+        now = time.monotonic()
+        if self._purged_at is None or now - self._purged_at >= self.purge_seconds:
+            db.execute(delete(RevokedToken).where(RevokedToken.expires_at < datetime.utcnow()))
+            # De paso, los refresh tokens caducados (usados o no)
+            db.execute(delete(RefreshToken).where(RefreshToken.expires_at < datetime.utcnow()))
+            db.commit()
+            self._revoked_during_rebuild = []
+            rows = db.execute(select(RevokedToken.jti, RevokedToken.revoked_at)).all()
+            # Reconstruir sin las caducadas, con margen si la tabla ha crecido
+            bloom = BloomFilter(max(self.capacity, 2 * len(rows)), self.error_rate)
+            for row in rows:
+                bloom.add(row.jti)
+            self._bloom = bloom
+            revoked_locally, self._revoked_during_rebuild = self._revoked_during_rebuild, None
+            for jti in revoked_locally:
+                bloom.add(jti)
+            self.entries = len(rows) + len(revoked_locally)
+            self._purged_at = now
+            # La marca sale de la misma instantánea que el filtro instalado, nunca de una anterior
+            self._last_revoked_at = max((row.revoked_at for row in rows), default=None)
+        else:
+            query = select(RevokedToken.jti, RevokedToken.revoked_at)
+            if self._last_revoked_at is not None:
+                query = query.where(RevokedToken.revoked_at >= self._last_revoked_at)
+            rows = db.execute(query).all()
+            for row in rows:
+                if row.jti not in self._bloom:
+                    self._bloom.add(row.jti)
+                    self.entries += 1
+            if rows:
+                latest = max(row.revoked_at for row in rows)
+                self._last_revoked_at = max(self._last_revoked_at or latest, latest)
+        self._synced_at = now
+
+    def is_revoked(self, db: Session, jti: str) -> bool:
+        """Consulta exacta en la tabla para los positivos del filtro"""
+        revoked = db.get(RevokedToken, jti) is not None
+        if not revoked:
+            self.false_positives += 1
+        return revoked
+
+    def revoke(self, db: Session, jti: str, expires_at: datetime):
+        db.merge(RevokedToken(jti=jti, expires_at=expires_at, revoked_at=datetime.utcnow()))
+        db.commit()
+        # Primero la lista de la reconstrucción en curso y después el filtro: si la lista ya
+        # no existe, el filtro nuevo ya está instalado y basta con añadirlo a self._bloom
+        revoked_locally = self._revoked_during_rebuild
+        if revoked_locally is not None:
+            revoked_locally.append(jti)
+        self._bloom.add(jti)
+        self.entries += 1
+
+    def stats(self) -> dict:
+        return {
+            "entries": self.entries,
+            "bloom_bits": self._bloom.size,
+            "bloom_hashes": self._bloom.hashes,
+            "lookups": self.lookups,
+            "bloom_negatives": self.bloom_negatives,
+            "false_positives": self.false_positives,
+        }
+
+revocation_list = RevocationList(
+    REVOCATION_BLOOM_CAPACITY, REVOCATION_BLOOM_ERROR_RATE, REVOCATION_SYNC_SECONDS, REVOCATION_PURGE_SECONDS
+)
+
+class EmailRegistry:
+    """Emails registrados: filtro de Bloom en memoria delante del índice users.email"""
+
+    def __init__(self, capacity: int, error_rate: float, sync_seconds: int, rebuild_seconds: int):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.sync_seconds = sync_seconds
+        self.rebuild_seconds = rebuild_seconds
+        self.entries = 0
+        self.removed = 0
+        self.lookups = 0
+        self.bloom_negatives = 0
+        self.false_positives = 0
+        self._bloom = BloomFilter(capacity, error_rate)
+        self._last_ids = {}
+        self._synced_at = None
+        self._rebuilt_at = None
+        self._sync_lock = threading.Lock()
+        self._syncer = None
+
+    def needs_sync(self) -> bool:
+        return self._synced_at is None or time.monotonic() - self._synced_at >= self.sync_seconds
+
+    def _fetch(self, db: Session) -> list:
+        """Filas (id, email) posteriores al último id visto, una lista por shard"""
+        def fetch(read_db: Session, index: int = 0):
+            query = select(User.id, User.email)
+            if self._last_ids.get(index) is not None:
+                query = query.where(User.id > self._last_ids[index])
+            return read_db.execute(query).all()
+        if shard_router is None:
+            with reading(db) as read_db:
+                return [fetch(read_db)]
+        return shard_router.gather(fetch)
+
+    def might_exist(self, email: str) -> bool:
+        """Comprobación en memoria; False es definitivo y no necesita E/S"""
+        self.lookups += 1
+        if email in self._bloom:
+            return True
+        self.bloom_negatives += 1
+        return False
+
+    def loaded(self) -> bool:
+        return self._synced_at is not None
+
+    def sync(self, db: Session):
+        """Añadir los usuarios creados por otros workers y reconstruir sin los borrados"""
+        # Una sola sincronización a la vez; solo la carga inicial espera a la que esté en curso
+        if not self._sync_lock.acquire(blocking=not self.loaded()):
+            return
+        try:
+            if self.needs_sync():
+                self._sync(db)
+        finally:
+            self._sync_lock.release()
+
+    def _sync(self, db: Session):
+        now = time.monotonic()
+        # Un filtro de Bloom no admite borrados: se reconstruye si hay muchos o ha pasado rebuild_seconds
+        stale = self.removed > self.entries // 10
+        if self._rebuilt_at is None or stale or now - self._rebuilt_at >= self.rebuild_seconds:
+            self._last_ids = {}
+            shards = self._fetch(db)
+            total = sum(len(rows) for rows in shards)
+            bloom = BloomFilter(max(self.capacity, 2 * total), self.error_rate)
+            for rows in shards:
+                for row in rows:
+                    bloom.add(row.email)
+            self._bloom = bloom
+            self.entries = total
+            self.removed = 0
+            self._rebuilt_at = now
+        else:
+            shards = self._fetch(db)
+            for rows in shards:
+                for row in rows:
+                    if row.email not in self._bloom:
+                        self._bloom.add(row.email)
+                        self.entries += 1
+        for index, rows in enumerate(shards):
+            if rows:
+                latest = max(row.id for row in rows)
+                self._last_ids[index] = max(self._last_ids.get(index) or latest, latest)
+        self._synced_at = now
+
+    def sync_from(self, bind):
+        with Session(bind) as db:
+            self.sync(db)
+
+    async def _run(self, bind):
+        while True:
+            await asyncio.sleep(self.sync_seconds)
+            try:
+                await run_in_threadpool(self.sync_from, bind)
+            except Exception:
+                # Se reintenta en el siguiente ciclo; mientras tanto se sigue con el filtro actual
+                pass
+
+    def start(self, bind):
+        """Sincronizar y reconstruir en segundo plano: las peticiones solo leen el filtro"""
+        self._syncer = asyncio.create_task(self._run(bind))
+
+    async def stop(self):
+        if self._syncer is not None:
+            self._syncer.cancel()
+            try:
+                await self._syncer
+            except asyncio.CancelledError:
+                pass
+            self._syncer = None
+
+    def exists(self, db: Session, email: str) -> bool:
+        """Consulta exacta en la tabla para los positivos del filtro"""
+        with users_session(db, email=email) as users_db, reading(users_db) as read_db:
+            found = read_db.scalar(select(User.id).where(User.email == email)) is not None
+        if not found:
+            self.false_positives += 1
+        return found
+
+    def add(self, email: str):
+        self._bloom.add(email)
+        self.entries += 1
+
+    def remove(self, email: str):
+        # El bit queda puesto (falso positivo resuelto por exists) hasta la próxima reconstrucción
+        self.removed += 1
+
+    def stats(self) -> dict:
+        return {
+            "entries": self.entries,
+            "removed": self.removed,
+            "bloom_bits": self._bloom.size,
+            "bloom_hashes": self._bloom.hashes,
+            "lookups": self.lookups,
+            "bloom_negatives": self.bloom_negatives,
+            "false_positives": self.false_positives,
+        }
+
+email_registry = EmailRegistry(EMAIL_BLOOM_CAPACITY, EMAIL_BLOOM_ERROR_RATE, EMAIL_SYNC_SECONDS, EMAIL_REBUILD_SECONDS)
+
+class AuditLog:
+    """Eventos de auditoría: ring buffer acotado en memoria y escritor que inserta por lotes"""
+
+    def __init__(self, capacity: int, batch_size: int, flush_seconds: float):
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.recorded = 0
+        self.written = 0
+        self.dropped = 0
+        self.flushes = 0
+        self.write_errors = 0
+        # Con el buffer lleno, deque descarta el evento más antiguo
+        self._events = deque(maxlen=capacity)
+        self._writer = None
+        self._wakeup = None
+
+    def record(self, event: str, email: str, user_id: Optional[int] = None, ip: Optional[str] = None):
+        """Encolar un evento sin E/S; el handler no espera a la base de datos"""
+        if len(self._events) == self.capacity:
+            self.dropped += 1
+        self._events.append({
+            "event": event, "email": email, "user_id": user_id, "ip": ip, "created_at": datetime.utcnow(),
+        })
+        self.recorded += 1
+        if self._wakeup is not None and len(self._events) >= self.batch_size:
+            self._wakeup.set()
+
+    def _drain(self, limit: int) -> list:
+        batch = []
+        while self._events and len(batch) < limit:
+            batch.append(self._events.popleft())
+        return batch
+
+    def flush(self, bind):
+        """Escribir todo lo pendiente: un INSERT de varias filas y un commit por lote"""
+        while self._events:
+            batch = self._drain(self.batch_size)
+            try:
+                with bind.begin() as connection:
+                    connection.execute(insert(AuditEvent), batch)
+            except Exception:
+                # Se descarta el lote: el registro no debe tumbar ni bloquear el servidor
+                self.write_errors += 1
+                self.dropped += len(batch)
+                continue
+            self.written += len(batch)
+            self.flushes += 1
+
+    async def _run(self, bind):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if self._events:
+                await run_in_threadpool(self.flush, bind)
+
+    def start(self, bind):
+        self._wakeup = asyncio.Event()
+        self._writer = asyncio.create_task(self._run(bind))
+
+    async def stop(self, bind):
+        """Parar el escritor y volcar lo que quede en el buffer"""
+        if self._writer is not None:
+            self._writer.cancel()
+            try:
+                await self._writer
+            except asyncio.CancelledError:
+                pass
+            self._writer = None
+            self._wakeup = None
+        await run_in_threadpool(self.flush, bind)
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": len(self._events),
+            "capacity": self.capacity,
+            "recorded": self.recorded,
+            "written": self.written,
+            "dropped": self.dropped,
+            "flushes": self.flushes,
+            "write_errors": self.write_errors,
+        }
+
+audit_log = AuditLog(AUDIT_BUFFER_SIZE, AUDIT_BATCH_SIZE, AUDIT_FLUSH_SECONDS)
+
+class KeyRing:
+    """Claves de firma por kid leídas de JWT_KEYS_DIR, con rotación y JWKS precalculado"""
+
+    def __init__(self, algorithm: str, keys_dir: str, active_kid: Optional[str], reload_seconds: int, publish_seconds: int):
+        self.algorithm = algorithm
+        self.keys_dir = keys_dir
+        self.configured_kid = active_kid
+        self.reload_seconds = reload_seconds
+        # Una clave nueva no firma hasta que su JWKS ha tenido tiempo de propagarse
+        self.publish_seconds = publish_seconds
+        self.active_kid = None
+        self.signing_keys = {}  # kid -> clave privada (jose)
+        self.verification_keys = {}  # kid -> clave pública (jose)
+        self.jwks_body = b'{"keys": []}'
+        self._published = []  # (mtime, kid) de las claves privadas, de la más antigua a la más nueva
+        self._fingerprint = None
+        self._checked_at = None
+
+    def _scan(self):
+        if not os.path.isdir(self.keys_dir):
+            return []
+        return sorted(
+            (entry.stat().st_mtime, entry.name, entry.path)
+            for entry in os.scandir(self.keys_dir)
+            if entry.name.endswith(".pem")
+        )
+
+    def maybe_reload(self):
+        """Recargar si han cambiado los ficheros y elegir la clave activa (cada reload_seconds)"""
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < self.reload_seconds:
+            return
+        self._checked_at = now
+        files = self._scan()
+        if files != self._fingerprint:
+            self._load(files)
+            self._fingerprint = files
+        # Aunque no cambien los ficheros, una clave nueva pasa a firmar al cumplir publish_seconds
+        self.active_kid = self._choose_active()
+
+    def _choose_active(self) -> Optional[str]:
+        if self.configured_kid is not None or not self._published:
+            return self.configured_kid
+        ready = [kid for mtime, kid in self._published if time.time() - mtime >= self.publish_seconds]
+        return ready[-1] if ready else self._published[0][1]
+
+    def _load(self, files):
+        signing_keys, verification_keys, published = {}, {}, []
+        # <kid>.pem contiene la clave privada; <kid>.pub.pem solo verifica (clave retirada)
+        for mtime, name, path in files:
+            kid = name[: -len(".pub.pem")] if name.endswith(".pub.pem") else name[: -len(".pem")]
+            with open(path) as key_file:
+                key = jwk.construct(key_file.read(), self.algorithm)
+            public_key = key if key.is_public() else key.public_key()
+            if not name.endswith(".pub.pem"):
+                signing_keys[kid] = key
+                published.append((mtime, kid))
+            verification_keys[kid] = public_key
+
+        jwks = {"keys": [
+            {**public_key.to_dict(), "kid": kid, "use": "sig", "alg": self.algorithm}
+            for kid, public_key in verification_keys.items()
+        ]}
+        self.signing_keys = signing_keys
+        self.verification_keys = verification_keys
+        self._published = published
+        self.jwks_body = json.dumps(jwks).encode()
+
+    def signing_key(self):
+        self.maybe_reload()
+        if self.active_kid not in self.signing_keys:
+            raise RuntimeError(
+                f"No hay clave de firma {self.algorithm} en {self.keys_dir}; ejecuta `python main.py keys generate`"
+            )
+        return self.active_kid, self.signing_keys[self.active_kid]
+
+    def verification_key(self, kid: Optional[str]):
+        self.maybe_reload()
+        return self.verification_keys.get(kid)
+
+key_ring = KeyRing(ALGORITHM, JWT_KEYS_DIR, JWT_ACTIVE_KID, JWT_KEYS_RELOAD_SECONDS, JWKS_MAX_AGE)
+
+def generate_signing_key(keys_dir: str, algorithm: str) -> str:
+    """Crear una clave privada nueva en keys_dir y devolver su kid"""
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import ec, rsa
+    if algorithm.startswith("ES"):
+        curves = {"ES256": ec.SECP256R1(), "ES384": ec.SECP384R1(), "ES512": ec.SECP521R1()}
+        private_key = ec.generate_private_key(curves[algorithm])
+    elif algorithm.startswith(("RS", "PS")):
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    else:
+        raise ValueError(f"Algoritmo no asimétrico: {algorithm}")
+    kid = datetime.utcnow().strftime("%Y%m%d%H%M%S") + "-" + uuid.uuid4().hex[:8]
+    os.makedirs(keys_dir, exist_ok=True)
+    path = os.path.join(keys_dir, f"{kid}.pem")
+    with open(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), "wb") as key_file:
+        key_file.write(private_key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        ))
+    return kid
+
+# Métricas por petición y por fase (hash, jwt, db; "app" es el resto: validación,
+# serialización y framework)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50)
+
+class Histogram:
+    """Histograma con buckets fijos por combinación de etiquetas"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.series = {}  # etiquetas -> [cuenta por bucket..., cuenta +Inf, suma]
+        self._lock = threading.Lock()
+
+    def observe(self, labels: tuple, value: float):
+        with self._lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[bisect_left(self.buckets, value)] += 1
+            series[-1] += value
+
+    def render(self, name: str, label_names: tuple) -> List[str]:
+        lines = [f"# TYPE {name} histogram"]
+        with self._lock:
+            items = [(labels, list(series)) for labels, series in self.series.items()]
+        for labels, series in items:
+            base = ",".join(f'{key}="{value}"' for key, value in zip(label_names, labels))
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{base},le="{bound}"}} {cumulative}')
+            cumulative += series[len(self.buckets)]
+            lines.append(f'{name}_bucket{{{base},le="+Inf"}} {cumulative}')
+            lines.append(f"{name}_sum{{{base}}} {series[-1]}")
+            lines.append(f"{name}_count{{{base}}} {cumulative}")
+        return lines
+
+class RequestTimings:
+    """Tiempo acumulado por fase y consultas SQL de la petición en curso"""
+    __slots__ = ("phases", "queries")
+
+    def __init__(self):
+        self.phases = {}
+        self.queries = 0
+
+    def add(self, phase: str, seconds: float):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+current_timings: ContextVar[Optional[RequestTimings]] = ContextVar("current_timings", default=None)
+request_latency = Histogram(LATENCY_BUCKETS)
+request_queries = Histogram(QUERY_COUNT_BUCKETS)
+request_counts = {}  # (endpoint, código) -> peticiones
+
+@contextmanager
+def timed_phase(phase: str):
+    """Sumar el tiempo del bloque a la fase indicada de la petición en curso"""
+    timings = current_timings.get()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(phase, time.perf_counter() - start)
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if current_timings.get() is not None:
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    timings = current_timings.get()
+    starts = conn.info.get("query_start")
+    if timings is None or not starts:
+        return
+    timings.add("db", time.perf_counter() - starts.pop())
+    timings.queries += 1
+
+class MetricsMiddleware:
+    """Middleware ASGI que registra latencia total, por fase y consultas por endpoint"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        timings = RequestTimings()
+        token = current_timings.set(timings)
+        status_code = 500
+        start = time.perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            current_timings.reset(token)
+            route = scope.get("route")
+            endpoint = f"{scope['method']} {route.path}" if route is not None else "unmatched"
+            request_latency.observe((endpoint, "total"), elapsed)
+            for phase, seconds in timings.phases.items():
+                request_latency.observe((endpoint, phase), seconds)
+            request_latency.observe((endpoint, "app"), max(0.0, elapsed - sum(timings.phases.values())))
+            request_queries.observe((endpoint,), timings.queries)
+            key = (endpoint, status_code)
+            request_counts[key] = request_counts.get(key, 0) + 1
+
+# Profiler estadístico: un hilo toma las pilas (sys._current_frames) de los hilos que
+# están trabajando para alguna petición seleccionada: el event loop mientras ejecuta
+# su tarea y los hilos del threadpool y del pool de hashing mientras ejecutan trabajo
+# suyo. Sin sesión activa el middleware solo comprueba un atributo, así que el coste
+# con el profiler apagado es despreciable. La sesión es local al proceso: con varios
+# workers solo se perfilan las peticiones del worker que recibió POST /admin/profile
+IDLE_FRAME_FILES = ("selectors.py", "threading.py", "queue.py", "thread.py")
+
+class ProfileSession:
+    """Peticiones a perfilar y pilas agregadas (pila -> muestras)"""
+
+    def __init__(self, requests: int, endpoint: Optional[str], header: Optional[str], interval: float, max_seconds: int):
+        self.requests = requests
+        self.endpoint = endpoint
+        self.header = header.lower() if header else None
+        self.interval = interval
+        self.started_at = time.time()
+        self.deadline = time.monotonic() + max_seconds
+        self.remaining = requests
+        self.in_flight = 0
+        self.matched = 0
+        self.samples = 0
+        self.stacks = {}
+        self.finished = threading.Event()
+        # Tareas de las peticiones seleccionadas (event loop) e hilos que ejecutan trabajo suyo
+        self.loop = None
+        self.loop_thread = None
+        self.tasks = set()
+        self.threads = set()
+
+    def matches(self, scope) -> bool:
+        if self.remaining <= 0:
+            return False
+        if self.endpoint is not None:
+            method, _, path = self.endpoint.rpartition(" ")
+            if path != scope["path"] or (method and method.upper() != scope["method"]):
+                return False
+        if self.header is not None:
+            name = self.header.encode("latin-1")
+            if not any(key == name for key, _ in scope["headers"]):
+                return False
+        return True
+
+    def status(self) -> dict:
+        return {
+            "active": not self.finished.is_set(),
+            "worker": os.getpid(),
+            "started_at": datetime.utcfromtimestamp(self.started_at).isoformat(),
+            "requests": self.requests,
+            "endpoint": self.endpoint,
+            "header": self.header,
+            "interval_ms": self.interval * 1000,
+            "matched": self.matched,
+            "samples": self.samples,
+            "stacks": len(self.stacks),
+        }
+
+def collapse_frame(frame) -> tuple:
+    """Pila de la raíz a la hoja como tupla de "función (fichero:línea)"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return tuple(reversed(names))
+
+class SamplingProfiler:
+    """Sesiones de profiling bajo demanda: las próximas N peticiones, por endpoint o por cabecera"""
+
+    def __init__(self):
+        self.session = None
+        self.last = None
+        self._lock = threading.Lock()
+
+    def start(self, requests: int, endpoint: Optional[str], header: Optional[str], interval: float, max_seconds: int):
+        with self._lock:
+            if self.session is not None:
+                return None
+            session = self.session = self.last = ProfileSession(requests, endpoint, header, interval, max_seconds)
+        threading.Thread(target=self._sample, args=(session,), name="profiler", daemon=True).start()
+        return session
+
+    def stop(self):
+        with self._lock:
+            session, self.session = self.session, None
+        if session is not None:
+            session.finished.set()
+        return session
+
+    def enter(self, scope) -> Optional[ProfileSession]:
+        """Seleccionar la petición si encaja en la sesión activa"""
+        with self._lock:
+            session = self.session
+            if session is None or not session.matches(scope):
+                return None
+            session.remaining -= 1
+            session.matched += 1
+            session.in_flight += 1
+            return session
+
+    def exit(self, session: ProfileSession):
+        with self._lock:
+            session.in_flight -= 1
+            done = session.remaining <= 0 and session.in_flight == 0
+        if done and self.session is session:
+            self.stop()
+
+    def _sampled_threads(self, session: ProfileSession) -> set:
+        """Hilos que en este momento trabajan para alguna petición seleccionada"""
+        threads = set(session.threads)
+        # El event loop solo cuenta mientras ejecuta la tarea de una petición seleccionada
+        if session.loop is not None and asyncio.current_task(session.loop) in session.tasks:
+            threads.add(session.loop_thread)
+        return threads
+
+    def _sample(self, session: ProfileSession):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        while not session.finished.wait(session.interval):
+            if time.monotonic() > session.deadline:
+                if self.session is session:
+                    self.stop()
+                break
+            if not session.in_flight:
+                continue
+            threads = self._sampled_threads(session)
+            if not threads:
+                continue
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id not in threads or os.path.basename(frame.f_code.co_filename) in IDLE_FRAME_FILES:
+                    continue
+                if thread_id not in names:
+                    names = {thread.ident: thread.name for thread in threading.enumerate()}
+                stack = (names.get(thread_id, str(thread_id)),) + collapse_frame(frame)
+                session.stacks[stack] = session.stacks.get(stack, 0) + 1
+                session.samples += 1
+
+    def collapsed(self, session: ProfileSession) -> str:
+        """Formato de pilas colapsadas (flamegraph.pl, inferno, speedscope)"""
+        stacks = sorted(dict(session.stacks).items(), key=lambda item: -item[1])
+        return "".join(f"{';'.join(stack)} {count}\n" for stack, count in stacks)
+
+    def speedscope(self, session: ProfileSession) -> dict:
+        """Perfil "sampled" del formato de speedscope"""
+        frames, index, samples, weights = [], {}, [], []
+        for stack, count in dict(session.stacks).items():
+            indices = []
+            for name in stack:
+                if name not in index:
+                    index[name] = len(frames)
+                    frames.append({"name": name})
+                indices.append(index[name])
+            samples.append(indices)
+            weights.append(count * session.interval)
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "exporter": "auth-api",
+            "name": f"auth-api {datetime.utcfromtimestamp(session.started_at).isoformat()}",
+            "activeProfileIndex": 0,
+            "shared": {"frames": frames},
+            "profiles": [{
+                "type": "sampled",
+                "name": session.endpoint or "requests",
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": sum(weights),
+                "samples": samples,
+                "weights": weights,
+            }],
+        }
+
+sampling_profiler = SamplingProfiler()
+profiled_session: ContextVar[Optional[ProfileSession]] = ContextVar("profiled_session", default=None)
+
+def profiled(fn):
+    """Envolver fn para que el profiler muestree el hilo que la ejecute si la petición está seleccionada"""
+    session = profiled_session.get()
+    if session is None:
+        return fn
+
+    def run(*args, **kwargs):
+        thread_id = threading.get_ident()
+        session.threads.add(thread_id)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            session.threads.discard(thread_id)
+    return run
+
+async def run_in_threadpool(fn, *args, **kwargs):
+    """run_in_threadpool de Starlette, visible para el profiler en las peticiones seleccionadas"""
+    return await starlette_run_in_threadpool(profiled(fn), *args, **kwargs)
+
+class ProfilingMiddleware:
+    """Middleware ASGI que marca las peticiones seleccionadas por la sesión de profiling"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if sampling_profiler.session is None or scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        session = sampling_profiler.enter(scope)
+        if session is None:
+            await self.app(scope, receive, send)
+            return
+        task = asyncio.current_task()
+        session.loop = asyncio.get_running_loop()
+        session.loop_thread = threading.get_ident()
+        session.tasks.add(task)
+        token = profiled_session.set(session)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            profiled_session.reset(token)
+            session.tasks.discard(task)
+            sampling_profiler.exit(session)
+
+def pool_stats(engine_) -> dict:
+    pool = engine_.pool
+    return {
+        name: getattr(pool, name)()
+        for name in ("size", "checkedin", "checkedout", "overflow")
+        if callable(getattr(pool, name, None))
+    }
+
+def check_login_rate(client_ip: str, email: str):
+    """Rechazar con 429 antes de tocar la base de datos o bcrypt"""
+    retry_after = login_ip_limiter.hit(client_ip) or login_email_limiter.hit(email.lower())
+    if retry_after:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Demasiados intentos de inicio de sesión, inténtalo más tarde",
+            headers={"Retry-After": str(math.ceil(retry_after))},
+        )
+
+def add_missing_columns(connection):
+    """Añadir a tablas ya existentes las columnas nuevas del modelo"""
+    columns = {column["name"] for column in inspect(connection).get_columns(User.__tablename__)}
+    if "version" not in columns:
+        connection.exec_driver_sql("ALTER TABLE users ADD COLUMN version INTEGER NOT NULL DEFAULT 1")
+
+def migrate(bind: Optional[Engine] = None):
+    """Crear las tablas, columnas e índices de búsqueda que falten (`python main.py migrate`)"""
+    binds = [bind or engine]
+    if bind is None and shard_router is not None:
+        binds += shard_router.engines
+    for bind in binds:
+        Base.metadata.create_all(bind=bind)
+        with bind.begin() as connection:
+            add_missing_columns(connection)
+            create_search_index(connection)
+
+def warm_up():
+    """Trabajo de arranque fuera del import: backend de hashing, pools, revocaciones y emails"""
+    load_hash_backends()
+    password_hasher.warm_up()
+    with SessionLocal() as db:
+        revocation_list.sync(db)
+        email_registry.sync(db)
+    if read_engine is not None:
+        connections = [read_engine.connect() for _ in range(SQLITE_READ_POOL_SIZE)]
+        for connection in connections:
+            connection.close()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Nada toca la base de datos al importar: los workers nuevos arrancan sin E/S
+    if AUTO_MIGRATE:
+        await run_in_threadpool(migrate)
+    await run_in_threadpool(warm_up)
+    if async_engine is not None:
+        async with async_engine.connect():
+            pass
+    audit_log.start(engine)
+    email_registry.start(engine)
+    yield
+    await email_registry.stop()
+    await audit_log.stop(engine)
+    password_hasher.shutdown()
+    if async_engine is not None:
+        await async_engine.dispose()
+    if read_engine is not None:
+        read_engine.dispose()
+    if shard_router is not None:
+        shard_router.dispose()
 
 # Inicializar FastAPI
 app = FastAPI(
     title="Sistema de Autenticación",
     description="API de autenticación con JWT",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=FastJSONResponse if FAST_JSON else JSONResponse
 )
 
 # Configurar CORS
@@ -81,16 +1567,32 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Next-Cursor", "X-Next-Offset"],
 )
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(ProfilingMiddleware)
 
 # Dependencias
-def get_db():
+async def get_db():
+    # En modo asíncrono se entrega una AsyncSession; si no, la Session síncrona
+    if AsyncSessionLocal is not None:
+        async with AsyncSessionLocal() as db:
+            yield db
+        return
     db = SessionLocal()
     try:
         yield db
     finally:
         db.close()
 
+DbSession = Union[Session, AsyncSession]
+
+async def run_db(db: DbSession, fn, *args):
+    """Ejecutar una función síncrona de acceso a datos con cualquier tipo de sesión"""
+    if isinstance(db, AsyncSession):
+        return await db.run_sync(fn, *args)
+    return await run_in_threadpool(fn, db, *args)
+
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     """Verificar contraseña"""
     return pwd_context.verify(plain_password, hashed_password)
@@ -99,6 +1601,25 @@ def get_password_hash(password: str) -> str:
     """Obtener hash de contraseña"""
     return pwd_context.hash(password)
 
+def verify_password_timed(plain_password: str, hashed_password: str):
+    """Verificar contraseña devolviendo también el tiempo empleado"""
+    start = time.perf_counter()
+    verified = verify_password(plain_password, hashed_password)
+    return verified, time.perf_counter() - start
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    """Verificar contraseña en el pool de hashing"""
+    # El tiempo se mide en el worker para que también funcione con un pool de procesos
+    with timed_phase("hash"):
+        verified, elapsed = await password_hasher.run(verify_password_timed, plain_password, hashed_password)
+    verify_timings.record(pwd_context.identify(hashed_password) or "unknown", elapsed)
+    return verified
+
+async def get_password_hash_async(password: str) -> str:
+    """Obtener hash de contraseña en el pool de hashing"""
+    with timed_phase("hash"):
+        return await password_hasher.run(get_password_hash, password)
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     """Crear token JWT"""
     to_encode = data.copy()
@@ -107,58 +1628,698 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     else:
         expire = datetime.utcnow() + timedelta(minutes=15)
     to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    # Identificador único para poder revocar el token
+    to_encode.setdefault("jti", uuid.uuid4().hex)
+    with timed_phase("jwt"):
+        if ALGORITHM.startswith("HS"):
+            return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+        kid, key = key_ring.signing_key()
+        encoded_jwt = jwt.encode(to_encode, key, algorithm=ALGORITHM, headers={"kid": kid})
     return encoded_jwt
 
+def access_token_claims(user) -> dict:
+    """Claims del token de acceso; en modo STATELESS_TOKENS incluyen los datos públicos del usuario"""
+    claims = {"sub": user.email}
+    if STATELESS_TOKENS:
+        claims.update({
+            "id": user.id,
+            "name": user.name,
+            "created_at": user.created_at.isoformat() if user.created_at else None,
+            "ver": user.version,
+        })
+    return claims
+
+def user_from_claims(payload: dict) -> UserResponse:
+    """Usuario reconstruido desde los claims de un token autocontenido, sin validar de nuevo"""
+    created_at = payload.get("created_at")
+    return UserResponse.model_construct(
+        id=payload["id"],
+        name=payload["name"],
+        email=payload["sub"],
+        created_at=datetime.fromisoformat(created_at) if created_at else None,
+        version=payload.get("ver", 1),
+    )
+
+def read_bind(db: Session):
+    """Engine para lecturas: el pool de solo lectura si db usa el escritor de producción"""
+    bind = db.get_bind()
+    if read_engine is not None and bind is engine:
+        return read_engine
+    return bind
+
+@contextmanager
+def reading(db: Session):
+    """Sesión para lecturas: no ocupa la conexión del único escritor"""
+    if ReadSessionLocal is None or db.get_bind() is not engine:
+        yield db
+        return
+    read_db = ReadSessionLocal()
+    try:
+        yield read_db
+    finally:
+        read_db.close()
+
+# Modo con shards: cada shard reserva un rango de ids (índice << SHARD_ID_BITS), así
+# los ids son únicos globalmente, dicen en qué shard está el usuario y el orden por id
+# sigue sirviendo para la paginación por clave al mezclar los shards
+SHARD_ID_BITS = 40
+
+def normalize_email(email: str) -> str:
+    return email.strip().lower()
+
+def next_user_id(base: int):
+    """Subconsulta con el siguiente id libre del rango del shard, atómica en el propio INSERT"""
+    in_range = User.id.between(base, base + (1 << SHARD_ID_BITS) - 1)
+    return select(func.coalesce(func.max(User.id), base) + 1).where(in_range).scalar_subquery()
+
+class ShardRouter:
+    """Bases de datos de usuarios: el shard de un email sale de un hash de su forma normalizada"""
+
+    def __init__(self, urls: List[str]):
+        # Los ids se reservan con MAX(id)+1 dentro del INSERT: solo es seguro con el único
+        # escritor de SQLite; en PostgreSQL dos altas simultáneas obtendrían el mismo id
+        unsupported = [url for url in urls if not url.startswith("sqlite")]
+        if unsupported:
+            raise RuntimeError(f"Los shards solo admiten SQLite: {', '.join(unsupported)}")
+        self.urls = urls
+        self.engines = []
+        for url in urls:
+            shard_engine = create_engine(url, connect_args={"check_same_thread": False})
+            if SQLITE_PROFILE == "production":
+                event.listen(shard_engine, "connect", apply_sqlite_pragmas)
+            self.engines.append(shard_engine)
+        self.sessions = [
+            sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=shard_engine)
+            for shard_engine in self.engines
+        ]
+        self._executor = ThreadPoolExecutor(max_workers=len(urls), thread_name_prefix="shard")
+
+    def __len__(self) -> int:
+        return len(self.engines)
+
+    def index_for_email(self, email: str) -> int:
+        digest = hashlib.blake2b(normalize_email(email).encode(), digest_size=8).digest()
+        return int.from_bytes(digest, "little") % len(self.engines)
+
+    def index_for_id(self, user_id: int) -> int:
+        return min(user_id >> SHARD_ID_BITS, len(self.engines) - 1)
+
+    def id_base(self, index: int) -> int:
+        return index << SHARD_ID_BITS
+
+    def session(self, email: Optional[str] = None, user_id: Optional[int] = None) -> Session:
+        index = self.index_for_email(email) if email is not None else self.index_for_id(user_id)
+        return self.sessions[index]()
+
+    def group(self, items, key) -> dict:
+        """Repartir items por shard según el email que devuelve key(item)"""
+        groups = {}
+        for item in items:
+            groups.setdefault(self.index_for_email(key(item)), []).append(item)
+        return groups
+
+    def gather(self, fn, indexes=None) -> list:
+        """Ejecutar fn(session, índice) en paralelo en los shards indicados (todos por defecto)"""
+        indexes = range(len(self.engines)) if indexes is None else list(indexes)
+
+        def run(index):
+            with self.sessions[index]() as shard_db:
+                return fn(shard_db, index)
+        return list(self._executor.map(run, indexes))
+
+    def gather_atomic(self, fn, indexes) -> list:
+        """Como gather, pero fn no confirma: se hace commit en todos los shards solo si ninguno falló"""
+        sessions = {index: self.sessions[index]() for index in indexes}
+        try:
+            futures = [self._executor.submit(fn, shard_db, index) for index, shard_db in sessions.items()]
+            wait(futures)
+            # result() relanza el primer error; el finally deshace lo que no se confirmó
+            results = [future.result() for future in futures]
+            for shard_db in sessions.values():
+                shard_db.commit()
+            return results
+        finally:
+            for shard_db in sessions.values():
+                shard_db.close()
+
+    def dispose(self):
+        for shard_engine in self.engines:
+            shard_engine.dispose()
+
+shard_router = ShardRouter(SHARD_URLS) if SHARD_URLS else None
+
+@contextmanager
+def users_session(db: Session, email: Optional[str] = None, user_id: Optional[int] = None):
+    """Sesión de la base de datos donde vive el usuario: db o la de su shard"""
+    if shard_router is None:
+        yield db
+        return
+    with shard_router.session(email=email, user_id=user_id) as shard_db:
+        yield shard_db
+
+def scatter(db: Session, fn) -> list:
+    """fn(session) sobre cada base de datos de usuarios (solo db si no hay shards)"""
+    if shard_router is None:
+        with reading(db) as read_db:
+            return [fn(read_db)]
+    return shard_router.gather(lambda shard_db, index: fn(shard_db))
+
 def get_user_by_email(db: Session, email: str):
     """Obtener usuario por email"""
-    return db.query(User).filter(User.email == email).first()
+    with users_session(db, email=email) as users_db, reading(users_db) as read_db:
+        return read_db.query(User).filter(User.email == email).first()
 
-def create_user(db: Session, user: UserCreate):
+def create_user(db: Session, user: UserCreate, hashed_password: Optional[str] = None):
     """Crear nuevo usuario"""
-    hashed_password = get_password_hash(user.password)
+    if hashed_password is None:
+        hashed_password = get_password_hash(user.password)
     db_user = User(
         name=user.name,
         email=user.email,
         hashed_password=hashed_password
     )
-    db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    with users_session(db, email=user.email) as users_db:
+        if shard_router is not None:
+            db_user.id = next_user_id(shard_router.id_base(shard_router.index_for_email(user.email)))
+        users_db.add(db_user)
+        users_db.execute(bump_table_version(User.__tablename__))
+        users_db.commit()
+        users_db.refresh(db_user)
+    email_registry.add(db_user.email)
     return db_user
 
-def authenticate_user(db: Session, email: str, password: str):
+def authenticate_user(db: Session, email: str, password: str, background_tasks: Optional[BackgroundTasks] = None):
     """Autenticar usuario"""
     user = get_user_by_email(db, email)
     if not user:
         return False
     if not verify_password(password, user.hashed_password):
         return False
+    if pwd_context.needs_update(user.hashed_password):
+        # Como en authenticate_user_async: el rehash va tras la respuesta si hay BackgroundTasks
+        if background_tasks is not None:
+            background_tasks.add_task(rehash_password, db.get_bind(), user.id, password)
+        else:
+            rehash_password(db.get_bind(), user.id, password)
     return user
 
-async def get_current_user(
-    credentials: HTTPAuthorizationCredentials = Depends(security),
-    db: Session = Depends(get_db)
+def update_password_hash(bind, user_id: int, hashed_password: str):
+    """Guardar un nuevo hash de contraseña con una sesión propia"""
+    if shard_router is not None:
+        bind = shard_router.engines[shard_router.index_for_id(user_id)]
+    with Session(bind) as session:
+        session.execute(update(User).where(User.id == user_id).values(hashed_password=hashed_password))
+        session.commit()
+
+def rehash_password(bind, user_id: int, password: str):
+    """Recalcular un hash con el coste actual y guardarlo sin tocar la sesión de la petición"""
+    update_password_hash(bind, user_id, get_password_hash(password))
+
+def get_existing_emails(db: Session, emails: List[str]) -> set:
+    """Emails ya registrados de la lista, en una sola consulta IN"""
+    if not emails:
+        return set()
+    if shard_router is None:
+        with reading(db) as read_db:
+            return set(read_db.scalars(select(User.email).where(User.email.in_(emails))))
+    by_shard = shard_router.group(emails, lambda email: email)
+    found = shard_router.gather(
+        lambda shard_db, index: shard_db.scalars(select(User.email).where(User.email.in_(by_shard[index]))).all(),
+        by_shard,
+    )
+    return {email for shard_emails in found for email in shard_emails}
+
+def create_users_bulk(db: Session, rows: List[dict]):
+    """Insertar varios usuarios en una sola transacción con un INSERT múltiple"""
+    if not rows:
+        return []
+    if shard_router is not None:
+        return create_users_bulk_sharded(rows)
+    created = db.execute(insert(User).returning(*USER_PUBLIC_COLUMNS), rows).all()
+    db.execute(bump_table_version(User.__tablename__))
+    db.commit()
+    for row in created:
+        email_registry.add(row.email)
+    return created
+
+def create_users_bulk_sharded(rows: List[dict]):
+    """Un INSERT múltiple por shard, en paralelo; si algún shard choca con un email, no se confirma ninguno"""
+    by_shard = shard_router.group(rows, lambda row: row["email"])
+
+    def insert_shard(shard_db: Session, index: int):
+        # executemany sin RETURNING: la subconsulta del id se evalúa fila a fila
+        shard_db.execute(insert(User).values(id=next_user_id(shard_router.id_base(index))), by_shard[index])
+        shard_db.execute(bump_table_version(User.__tablename__))
+        emails = [row["email"] for row in by_shard[index]]
+        return shard_db.execute(select(*USER_PUBLIC_COLUMNS).where(User.email.in_(emails))).all()
+
+    created = [row for shard_rows in shard_router.gather_atomic(insert_shard, by_shard) for row in shard_rows]
+    for row in created:
+        email_registry.add(row.email)
+    return created
+
+def delete_user_by_id(db: Session, user_id: int) -> bool:
+    """Eliminar usuario por id"""
+    with users_session(db, user_id=user_id) as users_db:
+        db_user = users_db.get(User, user_id)
+        if db_user is None:
+            return False
+        users_db.delete(db_user)
+        users_db.execute(bump_table_version(User.__tablename__))
+        users_db.commit()
+    email_registry.remove(db_user.email)
+    return True
+
+def users_page_query(cursor: Optional[int] = None, limit: Optional[int] = None):
+    """Consulta paginada por clave (id) con solo las columnas públicas"""
+    query = select(*USER_PUBLIC_COLUMNS).order_by(User.id)
+    if cursor is not None:
+        query = query.where(User.id > cursor)
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+def list_users(db: Session, cursor: Optional[int] = None, limit: int = USERS_PAGE_SIZE):
+    """Obtener una página de usuarios a partir del cursor"""
+    # Con shards cada uno devuelve su página y se mezclan por id (los rangos no se solapan)
+    pages = scatter(db, lambda read_db: read_db.execute(users_page_query(cursor, limit)).all())
+    if len(pages) == 1:
+        return pages[0]
+    return list(heapq.merge(*pages, key=lambda row: row.id))[:limit]
+
+def search_users_query(dialect: str, q: str, limit: int, offset: int = 0):
+    """Búsqueda por subcadena en nombre y email, ordenada por relevancia"""
+    query = select(*USER_PUBLIC_COLUMNS)
+    if dialect == "sqlite":
+        # Frase entre comillas: los trigramas casan cualquier subcadena literal
+        phrase = '"' + q.replace('"', '""') + '"'
+        query = (
+            query.select_from(users_fts.join(User.__table__, User.id == literal_column("users_fts.rowid")))
+            .where(literal_column("users_fts").op("MATCH")(phrase))
+            .order_by(func.bm25(literal_column("users_fts")), User.id)
+        )
+    else:
+        pattern = "%" + q.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        query = query.where(or_(User.name.ilike(pattern, escape="\\"), User.email.ilike(pattern, escape="\\")))
+        if dialect == "postgresql":
+            similarity = func.greatest(func.similarity(User.name, q), func.similarity(User.email, q))
+            query = query.order_by(similarity.desc(), User.id)
+        else:
+            query = query.order_by(User.id)
+    return query.limit(limit).offset(offset)
+
+def search_users(db: Session, q: str, limit: int = SEARCH_PAGE_SIZE, offset: int = 0):
+    """Obtener una página de resultados de búsqueda"""
+    if shard_router is None:
+        with reading(db) as read_db:
+            dialect = read_db.get_bind().dialect.name
+            return read_db.execute(search_users_query(dialect, q, limit, offset)).all()
+    # Con shards la relevancia no es comparable entre bases: se intercalan los
+    # resultados por posición dentro de cada shard, así que el orden es aproximado
+    pages = scatter(db, lambda read_db: read_db.execute(
+        search_users_query(read_db.get_bind().dialect.name, q, offset + limit)
+    ).all())
+    ranked = sorted(
+        ((position, row.id, row) for page in pages for position, row in enumerate(page)),
+        key=lambda item: item[:2],
+    )
+    return [row for _, _, row in ranked[offset:offset + limit]]
+
+def get_table_version(db: Session, name: str) -> int:
+    """Contador de cambios de la tabla (0 si aún no se ha modificado)"""
+    if name == User.__tablename__:
+        # Con shards la versión de users es la suma de sus contadores
+        return sum(scatter(db, lambda read_db: read_db.scalar(
+            select(TableVersion.version).where(TableVersion.name == name)
+        ) or 0))
+    with reading(db) as read_db:
+        return read_db.scalar(select(TableVersion.version).where(TableVersion.name == name)) or 0
+
+def audit_page_query(
+    cursor: Optional[int] = None, limit: int = AUDIT_PAGE_SIZE, email: Optional[str] = None, event: Optional[str] = None
 ):
-    """Obtener usuario actual del token"""
-    credentials_exception = HTTPException(
+    """Eventos de auditoría del más reciente al más antiguo, paginados por id"""
+    query = select(AuditEvent).order_by(AuditEvent.id.desc()).limit(limit)
+    if cursor is not None:
+        query = query.where(AuditEvent.id < cursor)
+    if email is not None:
+        query = query.where(AuditEvent.email == email)
+    if event is not None:
+        query = query.where(AuditEvent.event == event)
+    return query
+
+def list_audit_events(db: Session, *args):
+    """Obtener una página de eventos de auditoría"""
+    with reading(db) as read_db:
+        return list(read_db.scalars(audit_page_query(*args)))
+
+def user_row_to_ndjson(row) -> str:
+    return json.dumps({
+        "id": row.id,
+        "name": row.name,
+        "email": row.email,
+        "created_at": row.created_at.isoformat() if row.created_at else None,
+    }) + "\n"
+
+def iter_users_ndjson(bind, cursor: Optional[int] = None):
+    """Exportar usuarios como NDJSON con un cursor de servidor y memoria constante"""
+    if shard_router is not None:
+        # Un cursor por shard, mezclados por id sin materializar ninguno
+        for row in iter_users_rows(cursor):
+            yield user_row_to_ndjson(row)
+        return
+    query = users_page_query(cursor).execution_options(yield_per=USERS_STREAM_CHUNK)
+    with bind.connect() as conn:
+        for partition in conn.execute(query).partitions():
+            yield "".join(user_row_to_ndjson(row) for row in partition)
+
+def iter_users_rows(cursor: Optional[int] = None, columns=USER_PUBLIC_COLUMNS):
+    """Recorrer los usuarios de todos los shards en orden de id"""
+    query = select(*columns).order_by(User.id).execution_options(yield_per=USERS_STREAM_CHUNK)
+    if cursor is not None:
+        query = query.where(User.id > cursor)
+    with ExitStack() as stack:
+        streams = [stack.enter_context(engine.connect()).execute(query) for engine in shard_router.engines]
+        yield from heapq.merge(*streams, key=lambda row: row.id)
+
+async def aiter_users_ndjson(bind, cursor: Optional[int] = None):
+    """Versión asíncrona de iter_users_ndjson sobre un AsyncEngine"""
+    query = users_page_query(cursor).execution_options(yield_per=USERS_STREAM_CHUNK)
+    async with bind.connect() as conn:
+        result = await conn.stream(query)
+        async for partition in result.partitions():
+            yield "".join(user_row_to_ndjson(row) for row in partition)
+
+# Versiones asíncronas: usan la AsyncSession directamente o, con una Session
+# síncrona (p. ej. la de los tests), ejecutan la versión síncrona en el threadpool
+async def get_user_by_email_async(db: DbSession, email: str):
+    """Obtener usuario por email sin bloquear el event loop"""
+    if isinstance(db, AsyncSession):
+        result = await db.execute(select(User).where(User.email == email))
+        return result.scalars().first()
+    return await run_in_threadpool(get_user_by_email, db, email)
+
+async def create_user_async(db: DbSession, user: UserCreate, hashed_password: Optional[str] = None):
+    """Crear nuevo usuario sin bloquear el event loop"""
+    if hashed_password is None:
+        hashed_password = await get_password_hash_async(user.password)
+    if not isinstance(db, AsyncSession):
+        return await run_in_threadpool(create_user, db, user, hashed_password)
+    db_user = User(
+        name=user.name,
+        email=user.email,
+        hashed_password=hashed_password
+    )
+    db.add(db_user)
+    await db.execute(bump_table_version(User.__tablename__))
+    await db.commit()
+    await db.refresh(db_user)
+    email_registry.add(db_user.email)
+    return db_user
+
+async def get_existing_emails_async(db: DbSession, emails: List[str]) -> set:
+    """Emails ya registrados de la lista sin bloquear el event loop"""
+    if not isinstance(db, AsyncSession):
+        return await run_in_threadpool(get_existing_emails, db, emails)
+    if not emails:
+        return set()
+    return set(await db.scalars(select(User.email).where(User.email.in_(emails))))
+
+async def create_users_bulk_async(db: DbSession, rows: List[dict]):
+    """Insertar varios usuarios en una transacción sin bloquear el event loop"""
+    if not isinstance(db, AsyncSession):
+        return await run_in_threadpool(create_users_bulk, db, rows)
+    if not rows:
+        return []
+    created = (await db.execute(insert(User).returning(*USER_PUBLIC_COLUMNS), rows)).all()
+    await db.execute(bump_table_version(User.__tablename__))
+    await db.commit()
+    for row in created:
+        email_registry.add(row.email)
+    return created
+
+async def delete_user_by_id_async(db: DbSession, user_id: int) -> bool:
+    """Eliminar usuario por id sin bloquear el event loop"""
+    if not isinstance(db, AsyncSession):
+        return await run_in_threadpool(delete_user_by_id, db, user_id)
+    db_user = await db.get(User, user_id)
+    if db_user is None:
+        return False
+    await db.delete(db_user)
+    await db.execute(bump_table_version(User.__tablename__))
+    await db.commit()
+    email_registry.remove(db_user.email)
+    return True
+
+async def list_users_async(db: DbSession, cursor: Optional[int] = None, limit: int = USERS_PAGE_SIZE):
+    """Obtener una página de usuarios sin bloquear el event loop"""
+    if not isinstance(db, AsyncSession):
+        return await run_in_threadpool(list_users, db, cursor, limit)
+    result = await db.execute(users_page_query(cursor, limit))
+    return result.all()
+
+async def search_users_async(db: DbSession, q: str, limit: int = SEARCH_PAGE_SIZE, offset: int = 0):
+    """Buscar usuarios sin bloquear el event loop"""
+    if not isinstance(db, AsyncSession):
+        return await run_in_threadpool(search_users, db, q, limit, offset)
+    result = await db.execute(search_users_query(db.bind.dialect.name, q, limit, offset))
+    return result.all()
+
+async def get_table_version_async(db: DbSession, name: str) -> int:
+    """Contador de cambios de la tabla sin bloquear el event loop"""
+    if not isinstance(db, AsyncSession):
+        return await run_in_threadpool(get_table_version, db, name)
+    return await db.scalar(select(TableVersion.version).where(TableVersion.name == name)) or 0
+
+async def list_audit_events_async(
+    db: DbSession, cursor: Optional[int] = None, limit: int = AUDIT_PAGE_SIZE,
+    email: Optional[str] = None, event: Optional[str] = None
+):
+    """Obtener una página de eventos de auditoría sin bloquear el event loop"""
+    if not isinstance(db, AsyncSession):
+        return await run_in_threadpool(list_audit_events, db, cursor, limit, email, event)
+    return list(await db.scalars(audit_page_query(cursor, limit, email, event)))
+
+async def rehash_password_async(bind, user_id: int, password: str):
+    """Recalcular un hash con el coste actual fuera del camino de la petición"""
+    try:
+        hashed_password = await get_password_hash_async(password)
+    except HashQueueFull:
+        return  # Se reintentará en el próximo login
+    if isinstance(bind, AsyncEngine):
+        async with AsyncSession(bind) as session:
+            await session.execute(update(User).where(User.id == user_id).values(hashed_password=hashed_password))
+            await session.commit()
+    else:
+        await run_in_threadpool(update_password_hash, bind, user_id, hashed_password)
+
+async def authenticate_user_async(
+    db: DbSession, email: str, password: str, background_tasks: Optional[BackgroundTasks] = None
+):
+    """Autenticar usuario sin bloquear el event loop con bcrypt"""
+    user = await get_user_by_email_async(db, email)
+    if not user:
+        return False
+    if not await verify_password_async(password, user.hashed_password):
+        return False
+    if pwd_context.needs_update(user.hashed_password):
+        # El rehash se hace tras enviar la respuesta si hay BackgroundTasks disponibles
+        bind = db.bind if isinstance(db, AsyncSession) else db.get_bind()
+        if background_tasks is not None:
+            background_tasks.add_task(rehash_password_async, bind, user.id, password)
+        else:
+            await rehash_password_async(bind, user.id, password)
+    return user
+
+async def is_token_revoked_async(db: DbSession, jti: str) -> bool:
+    """Comprobar revocación; el caso habitual (no revocado) se resuelve en memoria"""
+    if revocation_list.needs_sync():
+        await run_db(db, revocation_list.sync)
+    if not revocation_list.might_be_revoked(jti):
+        return False
+    return await run_db(db, revocation_list.is_revoked, jti)
+
+async def is_email_registered_async(db: DbSession, email: str) -> bool:
+    """Comprobar si un email está registrado; el caso habitual (libre) se resuelve en memoria"""
+    # Solo la carga inicial puede hacerse aquí (si el lifespan no la hizo); la sincronización
+    # periódica y las reconstrucciones van en la tarea de fondo de email_registry
+    if not email_registry.loaded():
+        await run_db(db, email_registry.sync)
+    if not email_registry.might_exist(email):
+        return False
+    return await run_db(db, email_registry.exists, email)
+
+async def revoke_token_async(db: DbSession, payload: dict):
+    """Revocar un token hasta su expiración"""
+    jti = payload.get("jti")
+    if jti:
+        await run_db(db, revocation_list.revoke, jti, datetime.utcfromtimestamp(payload["exp"]))
+
+def hash_refresh_token(token: str) -> bytes:
+    # 256 bits aleatorios no se pueden adivinar: basta un digest rápido, no bcrypt
+    return hashlib.sha256(token.encode()).digest()
+
+def issue_refresh_token(db: Session, email: str, family: Optional[str] = None) -> str:
+    """Crear un refresh token (una familia nueva por login) y guardar solo su hash"""
+    token = secrets.token_urlsafe(32)
+    db.add(RefreshToken(
+        token_hash=hash_refresh_token(token),
+        family=family or uuid.uuid4().hex,
+        email=email,
+        expires_at=datetime.utcnow() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS),
+    ))
+    db.commit()
+    return token
+
+def rotate_refresh_token(db: Session, token: str):
+    """Canjear un refresh token por el siguiente de su familia.
+
+    Devuelve (email, token nuevo); (email, None) si el token ya se había canjeado,
+    en cuyo caso se revoca toda la familia; None si no existe o ha caducado.
+    """
+    now = datetime.utcnow()
+    row = db.execute(
+        select(RefreshToken.id, RefreshToken.family, RefreshToken.email, RefreshToken.expires_at)
+        .where(RefreshToken.token_hash == hash_refresh_token(token))
+    ).first()
+    if row is None or row.expires_at < now:
+        return None
+    # Solo gana el primer canje: el UPDATE condicional no deja pasar a dos a la vez
+    claimed = db.execute(
+        update(RefreshToken).where(RefreshToken.id == row.id, RefreshToken.used_at.is_(None)).values(used_at=now)
+    ).rowcount
+    if not claimed:
+        # Un token ya canjeado que vuelve a aparecer está en manos de otro: se corta la sesión entera
+        db.execute(delete(RefreshToken).where(RefreshToken.family == row.family))
+        db.commit()
+        return row.email, None
+    return row.email, issue_refresh_token(db, row.email, row.family)
+
+def revoke_refresh_family(db: Session, token: str):
+    """Revocar la sesión (familia) a la que pertenece un refresh token"""
+    family = select(RefreshToken.family).where(RefreshToken.token_hash == hash_refresh_token(token))
+    db.execute(delete(RefreshToken).where(RefreshToken.family.in_(family.scalar_subquery())))
+    db.commit()
+
+def revoke_user_refresh_tokens(db: Session, email: str):
+    db.execute(delete(RefreshToken).where(RefreshToken.email == email))
+    db.commit()
+
+def is_duplicate_email(error: IntegrityError) -> bool:
+    """Si la violación es la del índice único de users.email (y no otra, como la clave primaria)"""
+    message = str(error.orig)
+    return "users.email" in message or "ix_users_email" in message
+
+def credentials_error() -> HTTPException:
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="No se pudieron validar las credenciales",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    
+
+async def decode_access_token(token: str, db: DbSession) -> dict:
+    """Validar firma, expiración y revocación de un token y devolver sus claims"""
     try:
-        payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
-        email: str = payload.get("sub")
-        if email is None:
-            raise credentials_exception
+        if ALGORITHM.startswith("HS"):
+            key = SECRET_KEY
+        else:
+            # La clave de verificación se elige por el kid de la cabecera
+            key = key_ring.verification_key(jwt.get_unverified_header(token).get("kid"))
+            if key is None:
+                raise credentials_error()
+        with timed_phase("jwt"):
+            payload = jwt.decode(token, key, algorithms=[ALGORITHM])
     except JWTError:
-        raise credentials_exception
-    
-    user = get_user_by_email(db, email=email)
+        raise credentials_error()
+    if payload.get("sub") is None:
+        raise credentials_error()
+    jti = payload.get("jti")
+    if jti and await is_token_revoked_async(db, jti):
+        raise credentials_error()
+    return payload
+
+async def get_current_user(
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+    db: DbSession = Depends(get_db)
+):
+    """Obtener usuario actual del token"""
+    token = credentials.credentials
+    cached = token_cache.get(token)
+    if cached is not None:
+        cached_user, jti = cached
+        # Otro worker pudo revocarlo: la comprobación se resuelve casi siempre en memoria
+        if not jti or not await is_token_revoked_async(db, jti):
+            return cached_user
+        token_cache.invalidate(token)
+        raise credentials_error()
+
+    payload = await decode_access_token(token, db)
+    if STATELESS_TOKENS and "id" in payload:
+        snapshot = user_from_claims(payload)
+    else:
+        snapshot = await load_user_snapshot(db, payload)
+    token_cache.set(token, snapshot, payload["exp"], payload.get("jti"))
+    return snapshot
+
+async def load_user_snapshot(db: DbSession, payload: dict) -> UserResponse:
+    """Leer de la base de datos el usuario del token; 401 si ya no existe"""
+    user = await get_user_by_email_async(db, email=payload["sub"])
     if user is None:
-        raise credentials_exception
-    return user
+        raise credentials_error()
+    # Se guarda una instantánea desacoplada de la sesión para poder reutilizarla
+    return UserResponse.model_validate(user)
+
+async def get_current_db_user(
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+    db: DbSession = Depends(get_db)
+):
+    """Usuario actual comprobado en la base de datos, para endpoints que modifican datos"""
+    if not STATELESS_TOKENS:
+        return await get_current_user(credentials, db)
+    payload = await decode_access_token(credentials.credentials, db)
+    return await load_user_snapshot(db, payload)
+
+async def get_admin_user(current_user: UserResponse = Depends(get_current_db_user)):
+    """Usuario actual si está en ADMIN_EMAILS; 403 si no"""
+    if current_user.email not in ADMIN_EMAILS:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Requiere permisos de administrador"
+        )
+    return current_user
+
+async def require_metrics_access(
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security),
+    db: DbSession = Depends(get_db)
+):
+    """Acceso a las métricas internas: METRICS_TOKEN o un token de administrador"""
+    if credentials is None:
+        raise credentials_error()
+    if METRICS_TOKEN and secrets.compare_digest(credentials.credentials.encode(), METRICS_TOKEN.encode()):
+        return
+    await get_admin_user(await get_current_db_user(credentials, db))
+
+def client_ip(request: Request) -> str:
+    return request.client.host if request.client else "unknown"
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """If-None-Match con la comparación débil que usa GET (RFC 9110)"""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in header.split(","))
+
+def user_etag(user: UserResponse) -> str:
+    """ETag de /auth/me. SQLite (y MAX(id)+1 en los shards) reutiliza el id de una cuenta
+    borrada y la nueva empieza otra vez en la versión 1: email y fecha de alta lo distinguen"""
+    key = f"{user.id}:{user.email}:{user.created_at.isoformat()}:{user.version}"
+    return f'"{hashlib.sha256(key.encode()).hexdigest()[:20]}"'
+
+def not_modified(etag: str) -> Response:
+    """304 sin cuerpo: no se consulta ni se serializa nada más"""
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag, "Cache-Control": "private, no-cache"})
 
 # Rutas de la API
 
@@ -167,65 +2328,382 @@ async def root():
     """Endpoint de prueba"""
     return {"message": "API de Autenticación funcionando correctamente"}
 
+@app.get("/.well-known/jwks.json")
+async def jwks():
+    """Claves públicas para verificar los tokens en otros servicios"""
+    if not ALGORITHM.startswith("HS"):
+        key_ring.maybe_reload()
+    return Response(
+        content=key_ring.jwks_body,
+        media_type="application/json",
+        headers={"Cache-Control": f"public, max-age={JWKS_MAX_AGE}"},
+    )
+
+@app.get("/stats", dependencies=[Depends(require_metrics_access)])
+async def get_stats():
+    """Métricas internas del servidor"""
+    return {
+        "hashing": password_hasher.stats(),
+        "verify_timings": verify_timings.stats(),
+        "token_cache": token_cache.stats(),
+        "login_limiter": {"ip": login_ip_limiter.stats(), "email": login_email_limiter.stats()},
+        "register_batch_limiter": register_batch_limiter.stats(),
+        "email_check_limiter": email_check_limiter.stats(),
+        "revocation": revocation_list.stats(),
+        "email_registry": email_registry.stats(),
+        "audit": audit_log.stats(),
+    }
+
+@app.get("/metrics", response_class=PlainTextResponse, dependencies=[Depends(require_metrics_access)])
+async def metrics():
+    """Métricas en formato de texto de Prometheus"""
+    lines = request_latency.render("auth_request_duration_seconds", ("endpoint", "phase"))
+    lines += request_queries.render("auth_db_queries_per_request", ("endpoint",))
+    lines.append("# TYPE auth_requests_total counter")
+    for (endpoint, status_code), count in list(request_counts.items()):
+        lines.append(f'auth_requests_total{{endpoint="{endpoint}",status="{status_code}"}} {count}')
+
+    gauges = {f"auth_db_pool_{name}": value for name, value in pool_stats(engine).items()}
+    if read_engine is not None:
+        gauges.update({f"auth_db_read_pool_{name}": value for name, value in pool_stats(read_engine).items()})
+    if async_engine is not None:
+        gauges.update({f"auth_async_db_pool_{name}": value for name, value in pool_stats(async_engine.sync_engine).items()})
+    hashing = password_hasher.stats()
+    gauges.update({
+        "auth_hash_in_flight": hashing["in_flight"],
+        "auth_hash_queue_depth": hashing["queue_depth"],
+        "auth_hash_rejected_total": hashing["rejected"],
+        "auth_token_cache_hits_total": token_cache.hits,
+        "auth_token_cache_misses_total": token_cache.misses,
+        "auth_token_cache_size": token_cache.stats()["size"],
+        "auth_login_rejected_total": login_ip_limiter.rejected + login_email_limiter.rejected,
+        "auth_revocation_entries": revocation_list.entries,
+        "auth_email_registry_entries": email_registry.entries,
+        "auth_email_lookups_total": email_registry.lookups,
+        "auth_email_bloom_negatives_total": email_registry.bloom_negatives,
+        "auth_audit_queue_depth": audit_log.stats()["queue_depth"],
+        "auth_audit_written_total": audit_log.written,
+        "auth_audit_dropped_total": audit_log.dropped,
+    })
+    for name, value in gauges.items():
+        kind = "counter" if name.endswith("_total") else "gauge"
+        lines.append(f"# TYPE {name} {kind}")
+        lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+@app.get("/auth/email-available")
+async def email_available(request: Request, email: EmailStr = Query(...), db: DbSession = Depends(get_db)):
+    """Comprobar si un email está libre antes de enviar el registro"""
+    retry_after = email_check_limiter.hit(client_ip(request))
+    if retry_after:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Demasiadas comprobaciones de email, inténtalo más tarde",
+            headers={"Retry-After": str(math.ceil(retry_after))},
+        )
+    return {"email": email, "available": not await is_email_registered_async(db, email)}
+
 @app.post("/auth/register", response_model=UserResponse)
-async def register(user: UserCreate, db: Session = Depends(get_db)):
+async def register(user: UserCreate, request: Request, db: DbSession = Depends(get_db)):
     """Registrar nuevo usuario"""
-    # Verificar si el usuario ya existe
-    db_user = get_user_by_email(db, email=user.email)
-    if db_user:
+    # Verificar si el usuario ya existe (sin consulta si el filtro de emails no lo conoce)
+    if await is_email_registered_async(db, user.email):
         raise HTTPException(
             status_code=400,
             detail="El email ya está registrado"
         )
     
     # Validar contraseña
-    if len(user.password) < 6:
+    if len(user.password) < MIN_PASSWORD_LENGTH:
         raise HTTPException(
             status_code=400,
             detail="La contraseña debe tener al menos 6 caracteres"
         )
     
     # Crear usuario
-    return create_user(db=db, user=user)
+    hashed_password = await get_password_hash_async(user.password)
+    try:
+        db_user = await create_user_async(db=db, user=user, hashed_password=hashed_password)
+    except IntegrityError as error:
+        # Registrado por otro worker después de la última sincronización del filtro
+        if isinstance(db, AsyncSession):
+            await db.rollback()
+        else:
+            await run_in_threadpool(db.rollback)
+        if not is_duplicate_email(error):
+            raise
+        raise HTTPException(
+            status_code=400,
+            detail="El email ya está registrado"
+        )
+    audit_log.record("register", db_user.email, db_user.id, client_ip(request))
+    if FAST_JSON:
+        return FastJSONResponse(user_serializer.dump_json(UserResponse.model_validate(db_user)))
+    return db_user
 
-@app.post("/auth/login", response_model=Token)
-async def login(user_login: UserLogin, db: Session = Depends(get_db)):
-    """Iniciar sesión"""
-    user = authenticate_user(db, user_login.email, user_login.password)
-    if not user:
+@app.post("/auth/register/batch", response_model=List[BatchRegisterResult])
+async def register_batch(
+    users: List[UserCreate],
+    request: Request,
+    db: DbSession = Depends(get_db),
+    admin: UserResponse = Depends(get_admin_user)
+):
+    """Registrar varios usuarios con un hash en paralelo y un único INSERT (solo administradores)"""
+    retry_after = register_batch_limiter.hit(client_ip(request))
+    if retry_after:
         raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Email o contraseña incorrectos",
-            headers={"WWW-Authenticate": "Bearer"},
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Demasiados lotes de registro, inténtalo más tarde",
+            headers={"Retry-After": str(math.ceil(retry_after))},
         )
-    
+    if len(users) > REGISTER_BATCH_MAX:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Máximo {REGISTER_BATCH_MAX} usuarios por lote"
+        )
+
+    results: List[Optional[BatchRegisterResult]] = [None] * len(users)
+    pending = []
+    seen = set()
+    for index, user in enumerate(users):
+        if len(user.password) < MIN_PASSWORD_LENGTH:
+            results[index] = BatchRegisterResult(
+                email=user.email, status="invalid",
+                detail=f"La contraseña debe tener al menos {MIN_PASSWORD_LENGTH} caracteres"
+            )
+        elif user.email in seen:
+            results[index] = BatchRegisterResult(email=user.email, status="duplicate", detail="Email repetido en el lote")
+        else:
+            seen.add(user.email)
+            pending.append((index, user))
+
+    # Solo se consultan los emails que el filtro no descarta
+    if not email_registry.loaded():
+        await run_db(db, email_registry.sync)
+    candidates = [user.email for _, user in pending if email_registry.might_exist(user.email)]
+    existing = await get_existing_emails_async(db, candidates)
+    to_create = []
+    for index, user in pending:
+        if user.email in existing:
+            results[index] = BatchRegisterResult(email=user.email, status="duplicate", detail="El email ya está registrado")
+        else:
+            to_create.append((index, user))
+
+    hashes = await password_hasher.map(get_password_hash, [user.password for _, user in to_create])
+    rows = [
+        {"name": user.name, "email": user.email, "hashed_password": hashed_password}
+        for (_, user), hashed_password in zip(to_create, hashes)
+    ]
+    try:
+        created = await create_users_bulk_async(db, rows)
+    except IntegrityError as error:
+        # Otro registro concurrente ocupó alguno de los emails entre la comprobación y el INSERT
+        if isinstance(db, AsyncSession):
+            await db.rollback()
+        else:
+            await run_in_threadpool(db.rollback)
+        if not is_duplicate_email(error):
+            raise
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Algún email se registró durante el lote, vuelve a intentarlo"
+        )
+
+    ip = client_ip(request)
+    for row in created:
+        audit_log.record("register", row.email, row.id, ip)
+    created_by_email = {row.email: row for row in created}
+    for index, user in to_create:
+        row = created_by_email[user.email]
+        results[index] = BatchRegisterResult(
+            email=user.email, status="created", user=UserResponse.model_validate(row._asdict())
+        )
+    if FAST_JSON:
+        return FastJSONResponse(batch_serializer.dump_json(results))
+    return results
+
+def token_response(user, refresh_token: str):
+    """Respuesta de login y refresh: token de acceso nuevo, usuario y refresh token"""
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
-        data={"sub": user.email}, expires_delta=access_token_expires
+        data=access_token_claims(user), expires_delta=access_token_expires
     )
-    
+    if FAST_JSON:
+        token = Token.model_construct(
+            access_token=access_token, token_type="bearer", user=UserResponse.model_validate(user),
+            refresh_token=refresh_token,
+        )
+        return FastJSONResponse(token_serializer.dump_json(token))
     return {
         "access_token": access_token,
         "token_type": "bearer",
-        "user": user
+        "user": user,
+        "refresh_token": refresh_token,
     }
 
+@app.post("/auth/login", response_model=Token)
+async def login(
+    user_login: UserLogin,
+    request: Request,
+    background_tasks: BackgroundTasks,
+    db: DbSession = Depends(get_db)
+):
+    """Iniciar sesión"""
+    ip = client_ip(request)
+    check_login_rate(ip, user_login.email)
+    user = await authenticate_user_async(db, user_login.email, user_login.password, background_tasks)
+    if not user:
+        audit_log.record("login_failed", user_login.email, ip=ip)
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Email o contraseña incorrectos",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+    if not isinstance(db, AsyncSession) and user in db:
+        # El commit del refresh token expira los objetos de la sesión: desligado, el usuario
+        # conserva sus campos y no se recarga con una consulta bloqueante desde el event loop
+        db.expunge(user)
+    refresh_token = await run_db(db, issue_refresh_token, user.email)
+    audit_log.record("login", user.email, user.id, ip)
+    return token_response(user, refresh_token)
+
+@app.post("/auth/refresh", response_model=Token)
+async def refresh(body: RefreshRequest, request: Request, db: DbSession = Depends(get_db)):
+    """Renovar el token de acceso sin contraseña; el refresh token se rota en cada uso"""
+    rotated = await run_db(db, rotate_refresh_token, body.refresh_token)
+    if rotated is None:
+        raise credentials_error()
+    email, refresh_token = rotated
+    if refresh_token is None:
+        audit_log.record("refresh_reuse", email, ip=client_ip(request))
+        raise credentials_error()
+    user = await get_user_by_email_async(db, email)
+    if user is None:
+        raise credentials_error()
+    return token_response(user, refresh_token)
+
+@app.post("/auth/logout")
+async def logout(
+    request: Request,
+    body: Optional[RefreshRequest] = None,
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+    db: DbSession = Depends(get_db),
+    current_user: UserResponse = Depends(get_current_user)
+):
+    """Cerrar sesión revocando el token actual (y su refresh token, si se envía)"""
+    payload = await decode_access_token(credentials.credentials, db)
+    await revoke_token_async(db, payload)
+    if body is not None:
+        await run_db(db, revoke_refresh_family, body.refresh_token)
+    token_cache.invalidate(credentials.credentials)
+    audit_log.record("logout", current_user.email, current_user.id, client_ip(request))
+    return {"message": "Sesión cerrada correctamente"}
+
 @app.get("/auth/me", response_model=UserResponse)
-async def read_users_me(current_user: User = Depends(get_current_user)):
-    """Obtener información del usuario actual"""
+async def read_users_me(
+    request: Request,
+    response: Response,
+    current_user: UserResponse = Depends(get_current_user)
+):
+    """Obtener información del usuario actual (admite If-None-Match)"""
+    etag = user_etag(current_user)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "private, no-cache"
+    if FAST_JSON:
+        # current_user ya es un UserResponse validado (y cacheado)
+        return FastJSONResponse(user_serializer.dump_json(current_user), headers=dict(response.headers))
     return current_user
 
 @app.get("/auth/users")
-async def get_users(db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    """Obtener todos los usuarios (requiere autenticación)"""
-    users = db.query(User).all()
-    return [{"id": user.id, "name": user.name, "email": user.email, "created_at": user.created_at} for user in users]
+async def get_users(
+    request: Request,
+    response: Response,
+    cursor: Optional[int] = Query(None, description="Devolver usuarios con id mayor que este"),
+    limit: int = Query(USERS_PAGE_SIZE, ge=1, le=USERS_MAX_PAGE_SIZE),
+    stream: bool = Query(False, description="Exportar todos los usuarios como NDJSON"),
+    db: DbSession = Depends(get_db),
+    current_user: UserResponse = Depends(get_current_user)
+):
+    """Obtener usuarios paginados por id (requiere autenticación, admite If-None-Match)"""
+    # El contador se lee antes que las filas: si cambian entre medias, el ETag solo puede quedarse viejo
+    etag = f'"users-{await get_table_version_async(db, User.__tablename__)}"'
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "private, no-cache"
+    if stream:
+        # La exportación usa su propia conexión para no depender de la vida de la sesión
+        if isinstance(db, AsyncSession):
+            body = aiter_users_ndjson(db.bind, cursor)
+        else:
+            body = iter_users_ndjson(read_bind(db), cursor)
+        return StreamingResponse(body, media_type="application/x-ndjson", headers=dict(response.headers))
+
+    # Se pide una fila de más para saber si hay página siguiente
+    rows = await list_users_async(db, cursor=cursor, limit=limit + 1)
+    if len(rows) > limit:
+        rows = rows[:limit]
+        response.headers["X-Next-Cursor"] = str(rows[-1].id)
+    users = [row._asdict() for row in rows]
+    if FAST_JSON:
+        # Devolver una Response propia ignora las cabeceras de `response`: se copian
+        return FastJSONResponse(dump_json(users), headers=dict(response.headers))
+    return users
+
+@app.get("/auth/users/search")
+async def search_users_endpoint(
+    response: Response,
+    q: str = Query(..., min_length=SEARCH_MIN_LENGTH, description="Parte del nombre o del email"),
+    limit: int = Query(SEARCH_PAGE_SIZE, ge=1, le=SEARCH_MAX_PAGE_SIZE),
+    offset: int = Query(0, ge=0),
+    db: DbSession = Depends(get_db),
+    current_user: UserResponse = Depends(get_current_user)
+):
+    """Buscar usuarios por nombre o email, por relevancia (requiere autenticación)"""
+    rows = await search_users_async(db, q, limit=limit + 1, offset=offset)
+    if len(rows) > limit:
+        rows = rows[:limit]
+        response.headers["X-Next-Offset"] = str(offset + limit)
+    users = [row._asdict() for row in rows]
+    if FAST_JSON:
+        return FastJSONResponse(dump_json(users), headers=dict(response.headers))
+    return users
+
+@app.get("/auth/audit", response_model=List[AuditEventResponse])
+async def get_audit_events(
+    response: Response,
+    cursor: Optional[int] = Query(None, description="Devolver eventos con id menor que este"),
+    limit: int = Query(AUDIT_PAGE_SIZE, ge=1, le=AUDIT_MAX_PAGE_SIZE),
+    email: Optional[str] = Query(None),
+    event: Optional[str] = Query(None, description="login, login_failed, register, logout o delete"),
+    db: DbSession = Depends(get_db),
+    current_user: UserResponse = Depends(get_current_user)
+):
+    """Eventos de auditoría, del más reciente al más antiguo (requiere autenticación)"""
+    if current_user.email not in AUDIT_ADMIN_EMAILS:
+        if email is not None and email != current_user.email:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="No tienes permisos para ver los eventos de otros usuarios"
+            )
+        email = current_user.email
+    # Los eventos aún en el buffer aparecen tras el siguiente volcado (AUDIT_FLUSH_SECONDS)
+    events = await list_audit_events_async(db, cursor, limit + 1, email, event)
+    if len(events) > limit:
+        events = events[:limit]
+        response.headers["X-Next-Cursor"] = str(events[-1].id)
+    return events
 
 @app.delete("/auth/users/{user_id}")
 async def delete_user(
     user_id: int, 
-    db: Session = Depends(get_db), 
-    current_user: User = Depends(get_current_user)
+    request: Request,
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+    db: DbSession = Depends(get_db), 
+    current_user: UserResponse = Depends(get_current_db_user)
 ):
     """Eliminar usuario (solo puede eliminar su propio usuario)"""
     if current_user.id != user_id:
@@ -234,19 +2712,424 @@ async def delete_user(
             detail="No tienes permisos para eliminar este usuario"
         )
     
-    db.delete(current_user)
-    db.commit()
+    if not await delete_user_by_id_async(db, user_id):
+        raise HTTPException(status_code=404, detail="Usuario no encontrado")
+    token_cache.invalidate_user(user_id)
+    await revoke_token_async(db, await decode_access_token(credentials.credentials, db))
+    await run_db(db, revoke_user_refresh_tokens, current_user.email)
+    audit_log.record("delete", current_user.email, user_id, client_ip(request))
     return {"message": "Usuario eliminado correctamente"}
 
+@app.post("/admin/profile")
+async def start_profile(profile: ProfileRequest, admin: UserResponse = Depends(get_admin_user)):
+    """Perfilar las próximas peticiones que encajen (solo administradores)"""
+    session = sampling_profiler.start(
+        profile.requests, profile.endpoint, profile.header, profile.interval_ms / 1000, profile.max_seconds
+    )
+    if session is None:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Ya hay una sesión de profiling activa"
+        )
+    return session.status()
+
+@app.get("/admin/profile")
+async def get_profile(
+    format: Literal["status", "collapsed", "speedscope"] = Query("status"),
+    admin: UserResponse = Depends(get_admin_user)
+):
+    """Estado o resultado de la sesión de profiling actual o de la última"""
+    session = sampling_profiler.last
+    if session is None:
+        raise HTTPException(status_code=404, detail="No hay ninguna sesión de profiling")
+    if format == "collapsed":
+        return PlainTextResponse(sampling_profiler.collapsed(session))
+    if format == "speedscope":
+        return JSONResponse(sampling_profiler.speedscope(session))
+    return session.status()
+
+@app.delete("/admin/profile")
+async def stop_profile(admin: UserResponse = Depends(get_admin_user)):
+    """Terminar la sesión de profiling activa"""
+    session = sampling_profiler.stop()
+    if session is None:
+        raise HTTPException(status_code=404, detail="No hay ninguna sesión de profiling activa")
+    return session.status()
+
 # Manejo de errores
+@app.exception_handler(HashQueueFull)
+async def hash_queue_full_handler(request, exc):
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "Servidor ocupado, inténtalo de nuevo en unos segundos"},
+        headers={"Retry-After": "1"},
+    )
+
 @app.exception_handler(404)
 async def not_found_handler(request, exc):
-    return {"detail": "Recurso no encontrado"}
+    # Se conserva el detalle de los HTTPException(404) de los handlers; las rutas inexistentes traen "Not Found"
+    detail = getattr(exc, "detail", None)
+    if not detail or detail == "Not Found":
+        detail = "Recurso no encontrado"
+    return JSONResponse(status_code=status.HTTP_404_NOT_FOUND, content={"detail": detail})
 
 @app.exception_handler(500)
 async def internal_error_handler(request, exc):
-    return {"detail": "Error interno del servidor"}
+    return JSONResponse(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, content={"detail": "Error interno del servidor"})
 
-if __name__ == "__main__":
+# Calibración del coste de hashing
+def measure_verify(handler, password: str = "calibración", repeat: int = 3) -> float:
+    """Mejor tiempo (segundos) de verificar un hash generado por handler"""
+    hashed_password = handler.hash(password)
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        handler.verify(password, hashed_password)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def calibrate_bcrypt(target_ms: float, min_rounds: int = 10, max_rounds: int = 16):
+    """Mayor número de rondas de bcrypt cuya verificación no supera target_ms"""
+    from passlib.hash import bcrypt
+    chosen = min_rounds
+    timings = {}
+    for rounds in range(min_rounds, max_rounds + 1):
+        timings[rounds] = measure_verify(bcrypt.using(rounds=rounds)) * 1000
+        if timings[rounds] > target_ms:
+            break
+        chosen = rounds
+    return chosen, timings
+
+def calibrate_argon2(target_ms: float, memory_cost: int = ARGON2_MEMORY_COST, max_time_cost: int = 10):
+    """Mayor time_cost de argon2 (con memory_cost fijo) que no supera target_ms"""
+    from passlib.hash import argon2
+    chosen = 1
+    timings = {}
+    for time_cost in range(1, max_time_cost + 1):
+        handler = argon2.using(time_cost=time_cost, memory_cost=memory_cost, parallelism=ARGON2_PARALLELISM)
+        timings[time_cost] = measure_verify(handler) * 1000
+        if timings[time_cost] > target_ms:
+            break
+        chosen = time_cost
+    return chosen, timings
+
+def run_calibration(target_ms: float, with_argon2: bool = False):
+    """Medir este servidor e imprimir la configuración recomendada para .env"""
+    rounds, timings = calibrate_bcrypt(target_ms)
+    for value, elapsed in timings.items():
+        print(f"bcrypt rounds={value}: {elapsed:.1f} ms")
+    if timings[rounds] > target_ms:
+        print(f"Aviso: este servidor supera {target_ms:.0f} ms incluso con el mínimo de {rounds} rondas")
+    print("\n# Configuración recomendada")
+    print(f"BCRYPT_ROUNDS={rounds}")
+    if with_argon2:
+        try:
+            time_cost, timings = calibrate_argon2(target_ms)
+        except Exception as e:
+            print(f"# argon2 no disponible ({e}); instala argon2-cffi")
+            return
+        for value, elapsed in timings.items():
+            print(f"# argon2 time_cost={value}: {elapsed:.1f} ms")
+        print("PASSWORD_SCHEMES=argon2,bcrypt")
+        print(f"ARGON2_TIME_COST={time_cost}")
+        print(f"ARGON2_MEMORY_COST={ARGON2_MEMORY_COST}")
+        print(f"ARGON2_PARALLELISM={ARGON2_PARALLELISM}")
+
+# Exportación e importación masiva: mismo formato en los dos sentidos y con los
+# hashes tal cual, para mover usuarios entre entornos sin volver a calcularlos
+EXPORT_FIELDS = ("name", "email", "hashed_password", "created_at")
+
+EXPORT_COLUMNS = (User.id, User.name, User.email, User.hashed_password, User.created_at)
+
+def export_record(row) -> tuple:
+    return (row.name, row.email, row.hashed_password, row.created_at.isoformat() if row.created_at else None)
+
+def iter_users_partitions(bind, columns):
+    """Bloques de filas en orden de id, de bind o mezclando todos los shards"""
+    if shard_router is not None:
+        rows = iter_users_rows(columns=columns)
+        while partition := list(islice(rows, USERS_STREAM_CHUNK)):
+            yield partition
+        return
+    query = select(*columns).order_by(User.id).execution_options(yield_per=USERS_STREAM_CHUNK)
+    with bind.connect() as conn:
+        yield from conn.execute(query).partitions()
+
+def iter_users_export(bind, fmt: str = "ndjson"):
+    """Exportar usuarios con su hash en NDJSON o CSV, por bloques y en memoria constante"""
+    if fmt == "csv":
+        yield ",".join(EXPORT_FIELDS) + "\r\n"
+    for partition in iter_users_partitions(bind, EXPORT_COLUMNS):
+        rows = [export_record(row) for row in partition]
+        if fmt == "csv":
+            buffer = io.StringIO()
+            csv.writer(buffer).writerows(rows)
+            yield buffer.getvalue()
+        else:
+            yield "".join(json.dumps(dict(zip(EXPORT_FIELDS, row))) + "\n" for row in rows)
+
+def read_users_import(lines, fmt: str = "ndjson"):
+    """Filas (dict) de un fichero de exportación, leídas de forma perezosa"""
+    if fmt == "csv":
+        yield from csv.DictReader(lines)
+        return
+    for line in lines:
+        if line.strip():
+            yield json.loads(line)
+
+def import_users_chunk(connection, rows: List[dict], on_conflict: str = "skip", id_base: Optional[int] = None) -> tuple:
+    """Insertar un bloque con un único executemany; los emails ya registrados se saltan o actualizan"""
+    emails = [row["email"] for row in rows]
+    existing = set(connection.scalars(select(User.email).where(User.email.in_(emails))))
+    new_rows = [row for row in rows if row["email"] not in existing]
+    if new_rows:
+        # ON CONFLICT cubre los emails registrados entre la consulta y el INSERT
+        if connection.dialect.name == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+            statement = dialect_insert(User).on_conflict_do_nothing(index_elements=[User.email])
+        elif connection.dialect.name == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+            statement = dialect_insert(User).on_conflict_do_nothing(index_elements=[User.email])
+        else:
+            statement = insert(User)
+        if id_base is not None:
+            statement = statement.values(id=next_user_id(id_base))
+        connection.execute(statement, new_rows)
+    updates = []
+    if on_conflict == "update":
+        updates = [
+            {"match_email": row["email"], "new_name": row["name"], "new_hash": row["hashed_password"]}
+            for row in rows if row["email"] in existing
+        ]
+    if updates:
+        connection.execute(
+            update(User.__table__).where(User.email == bindparam("match_email"))
+            .values(name=bindparam("new_name"), hashed_password=bindparam("new_hash"), version=User.version + 1),
+            updates,
+        )
+    connection.execute(bump_table_version(User.__tablename__))
+    return len(new_rows), len(updates), len(rows) - len(new_rows) - len(updates)
+
+def import_users(
+    bind, records, chunk_size: int = USERS_IMPORT_CHUNK, on_conflict: str = "skip", progress=None, router=None
+) -> dict:
+    """Importar usuarios conservando su hash: un executemany y un commit por bloque (y por shard)"""
+    counts = {"inserted": 0, "updated": 0, "skipped": 0, "invalid": 0}
+    start = reported = time.perf_counter()
+    chunk, seen = {}, 0
+
+    def import_chunk(rows: List[dict]) -> list:
+        if router is None:
+            with bind.begin() as connection:
+                return [import_users_chunk(connection, rows, on_conflict)]
+        by_shard = router.group(rows, lambda row: row["email"])
+
+        def import_shard(shard_db: Session, index: int):
+            result = import_users_chunk(shard_db.connection(), by_shard[index], on_conflict, router.id_base(index))
+            shard_db.commit()
+            return result
+        return router.gather(import_shard, by_shard)
+
+    def flush(last: bool = False):
+        nonlocal reported
+        if chunk:
+            for inserted, updated, skipped in import_chunk(list(chunk.values())):
+                counts["inserted"] += inserted
+                counts["updated"] += updated
+                counts["skipped"] += skipped
+            chunk.clear()
+        now = time.perf_counter()
+        # Como mucho un aviso de progreso por segundo, más el final
+        if progress is not None and (last or now - reported >= 1):
+            reported = now
+            progress(seen, seen / (now - start) if now > start else 0.0, counts)
+
+    for record in records:
+        seen += 1
+        email = (record.get("email") or "").strip()
+        hashed_password = record.get("hashed_password") or ""
+        # Solo se aceptan hashes que el servidor sabe verificar (bcrypt, argon2...)
+        if "@" not in email or not pwd_context.identify(hashed_password, required=False):
+            counts["invalid"] += 1
+            continue
+        if email in chunk:
+            counts["skipped"] += 1
+            continue
+        created_at = record.get("created_at")
+        chunk[email] = {
+            "name": record.get("name") or "",
+            "email": email,
+            "hashed_password": hashed_password,
+            "created_at": datetime.fromisoformat(created_at) if created_at else datetime.utcnow(),
+        }
+        if len(chunk) >= chunk_size:
+            flush()
+    flush(last=True)
+    counts["seconds"] = round(time.perf_counter() - start, 3)
+    return counts
+
+def reshard(urls: List[str], progress=None) -> dict:
+    """Copiar los usuarios actuales (de los shards o de DATABASE_URL) a un nuevo juego de shards"""
+    target = ShardRouter(urls)
+    try:
+        for shard_engine in target.engines:
+            migrate(shard_engine)
+        records = (
+            dict(zip(EXPORT_FIELDS, export_record(row)))
+            for partition in iter_users_partitions(engine, EXPORT_COLUMNS)
+            for row in partition
+        )
+        # Los ids se reasignan en el rango de cada shard nuevo; on_conflict=update
+        # permite repetir la copia para recoger los cambios hechos mientras tanto
+        counts = import_users(engine, records, USERS_IMPORT_CHUNK, "update", progress, router=target)
+        counts["deleted"] = prune_deleted_users(target)
+        return counts
+    finally:
+        target.dispose()
+
+def prune_deleted_users(target: ShardRouter) -> int:
+    """Borrar de los shards de destino los usuarios que ya no existen en el origen"""
+    deleted = 0
+    with SessionLocal() as source_db:
+        for index in range(len(target)):
+            with target.sessions[index]() as shard_db:
+                last_id = 0
+                while True:
+                    rows = shard_db.execute(
+                        select(User.id, User.email).where(User.id > last_id).order_by(User.id).limit(USERS_IMPORT_CHUNK)
+                    ).all()
+                    if not rows:
+                        break
+                    last_id = rows[-1].id
+                    emails = [row.email for row in rows]
+                    # get_existing_emails consulta el origen: los shards actuales o DATABASE_URL
+                    gone = set(emails) - get_existing_emails(source_db, emails)
+                    if gone:
+                        shard_db.execute(delete(User).where(User.email.in_(gone)))
+                        shard_db.execute(bump_table_version(User.__tablename__))
+                        shard_db.commit()
+                        deleted += len(gone)
+    return deleted
+
+def shard_status() -> List[dict]:
+    """Usuarios por shard (o en DATABASE_URL si no hay shards)"""
+    engines = shard_router.engines if shard_router is not None else [engine]
+    status_rows = []
+    for index, shard_engine in enumerate(engines):
+        with shard_engine.connect() as conn:
+            users = conn.scalar(select(func.count()).select_from(User.__table__))
+        status_rows.append({"shard": index, "url": str(shard_engine.url), "users": users})
+    return status_rows
+
+def print_import_progress(rows: int, rate: float, counts: dict):
+    print(
+        f"{rows} filas leídas ({rate:.0f} filas/s): {counts['inserted']} insertadas, "
+        f"{counts['updated']} actualizadas, {counts['skipped']} omitidas",
+        file=sys.stderr,
+    )
+
+def serve(host: str, port: int, workers: int, reload: bool = False, log_level: str = "info"):
+    """Arrancar uvicorn: migración única en el maestro y workers que calientan en el lifespan"""
+    import inspect
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
+
+    if reload:
+        uvicorn.run("main:app", host=host, port=port, reload=True, log_level=log_level)
+        return
+    # Migrar una sola vez aquí y no en cada worker; los hijos heredan el entorno
+    migrate()
+    engine.dispose()
+    os.environ["AUTO_MIGRATE"] = "false"
+    # loop/http "auto" eligen uvloop y httptools si están instalados. Con varios
+    # workers, SIGHUP los reemplaza uno a uno: el viejo acaba sus peticiones y el
+    # nuevo acepta conexiones cuando su lifespan (calentamiento incluido) termina;
+    # mientras tanto las conexiones esperan en la cola del socket compartido
+    options = {}
+    # El ping del maestro a los workers solo es configurable desde uvicorn 0.37
+    if "timeout_worker_healthcheck" in inspect.signature(uvicorn.Config).parameters:
+        options["timeout_worker_healthcheck"] = SERVER_READY_TIMEOUT
+    uvicorn.run(
+        "main:app",
+        host=host,
+        port=port,
+        workers=max(1, workers),
+        loop="auto",
+        http="auto",
+        proxy_headers=True,
+        log_level=log_level,
+        timeout_graceful_shutdown=SERVER_GRACEFUL_TIMEOUT,
+        **options,
+    )
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Sistema de Autenticación")
+    subparsers = parser.add_subparsers(dest="command")
+    calibrate_parser = subparsers.add_parser("calibrate", help="Elegir el coste de hashing para este servidor")
+    calibrate_parser.add_argument("--target-ms", type=float, default=250, help="Latencia objetivo de una verificación")
+    calibrate_parser.add_argument("--argon2", action="store_true", help="Calibrar también argon2")
+    serve_parser = subparsers.add_parser("serve", help="Arrancar el servidor (comando por defecto)")
+    serve_parser.add_argument("--host", default="0.0.0.0")
+    serve_parser.add_argument("--port", type=int, default=8000)
+    serve_parser.add_argument("--workers", type=int, default=WEB_CONCURRENCY, help="Por defecto WEB_CONCURRENCY o un worker por CPU")
+    serve_parser.add_argument("--reload", action="store_true", help="Modo desarrollo: un proceso que se recarga al cambiar el código")
+    serve_parser.add_argument("--log-level", default="info")
+    subparsers.add_parser("migrate", help="Crear las tablas que falten en DATABASE_URL")
+    keys_parser = subparsers.add_parser("keys", help="Gestionar las claves de firma de JWT")
+    keys_parser.add_argument("action", choices=["generate", "list"])
+    users_parser = subparsers.add_parser("users", help="Exportar o importar usuarios con sus hashes")
+    users_parser.add_argument("action", choices=["export", "import"])
+    users_parser.add_argument("file", nargs="?", default="-", help="Fichero de salida o entrada (- para stdout/stdin)")
+    users_parser.add_argument("--format", choices=["ndjson", "csv"], help="Por defecto, según la extensión del fichero")
+    users_parser.add_argument("--chunk-size", type=int, default=USERS_IMPORT_CHUNK, help="Filas por INSERT y commit")
+    users_parser.add_argument("--on-conflict", choices=["skip", "update"], default="skip", help="Emails ya registrados")
+    shards_parser = subparsers.add_parser("shards", help="Estado de los shards de usuarios o repartirlos de nuevo")
+    shards_parser.add_argument("action", choices=["status", "reshard"])
+    shards_parser.add_argument("--to", help="URLs de los shards de destino separadas por comas (reshard)")
+    args = parser.parse_args()
+
+    if args.command == "calibrate":
+        run_calibration(args.target_ms, args.argon2)
+    elif args.command == "migrate":
+        migrate()
+        print(f"Esquema al día en {DATABASE_URL}")
+    elif args.command == "keys" and args.action == "generate":
+        kid = generate_signing_key(JWT_KEYS_DIR, ALGORITHM)
+        print(f"Clave {kid} creada en {JWT_KEYS_DIR}; firmará cuando lleve {JWKS_MAX_AGE} s publicada")
+    elif args.command == "keys":
+        key_ring.maybe_reload()
+        for kid in key_ring.verification_keys:
+            role = "activa" if kid == key_ring.active_kid else ("firma" if kid in key_ring.signing_keys else "solo verificación")
+            print(f"{kid}\t{role}")
+    elif args.command == "users":
+        fmt = args.format or ("csv" if args.file.endswith(".csv") else "ndjson")
+        migrate()
+        if args.action == "export":
+            output = nullcontext(sys.stdout) if args.file == "-" else open(args.file, "w", newline="", encoding="utf-8")
+            with output as out:
+                for chunk in iter_users_export(engine, fmt):
+                    out.write(chunk)
+        else:
+            source = nullcontext(sys.stdin) if args.file == "-" else open(args.file, newline="", encoding="utf-8")
+            with source as lines:
+                counts = import_users(
+                    engine, read_users_import(lines, fmt), args.chunk_size, args.on_conflict, print_import_progress,
+                    router=shard_router,
+                )
+            print(json.dumps(counts))
+    elif args.command == "shards":
+        migrate()
+        if args.action == "status":
+            for row in shard_status():
+                print(f"{row['shard']}\t{row['users']}\t{row['url']}")
+        elif not args.to:
+            parser.error("reshard necesita --to url1,url2,...")
+        else:
+            urls = [url.strip() for url in args.to.split(",") if url.strip()]
+            print(json.dumps(reshard(urls, print_import_progress)))
+            print("Copia terminada: apunta SHARD_URLS a los nuevos shards y reinicia los workers", file=sys.stderr)
+    elif args.command == "serve":
+        serve(args.host, args.port, args.workers, args.reload, args.log_level)
+    else:
+        serve("0.0.0.0", 8000, WEB_CONCURRENCY)
\ No newline at end of file
@@ -2,6 +2,8 @@ class AuthApp {
     constructor() {
         this.apiUrl = 'http://localhost:8000'; // URL del backend
         this.token = localStorage.getItem('token');
+        this.refreshToken = localStorage.getItem('refreshToken');
+        this.refreshing = null;
         this.init();
     }
 
@@ -29,6 +31,11 @@ class AuthApp {
             this.handleRegister(e);
         });
 
+        // Avisar de un email ya registrado antes de enviar el formulario
+        document.getElementById('registerEmail').addEventListener('blur', (e) => {
+            this.checkEmailAvailable(e.target);
+        });
+
         // Logout
         document.getElementById('logoutBtn').addEventListener('click', () => {
             this.handleLogout();
@@ -82,9 +89,9 @@ class AuthApp {
             const result = await response.json();
 
             if (response.ok) {
-                localStorage.setItem('token', result.access_token);
+                this.storeTokens(result);
                 localStorage.setItem('user', JSON.stringify(result.user));
-                this.token = result.access_token;
+                localStorage.removeItem('userEtag');
 
                 this.showAlert('loginAlert', 'Inicio de sesión exitoso', 'success');
                 setTimeout(() => {
@@ -101,6 +108,27 @@ class AuthApp {
         }
     }
 
+    async checkEmailAvailable(input) {
+        if (!input.value || !input.checkValidity()) {
+            return;
+        }
+
+        try {
+            const email = encodeURIComponent(input.value);
+            const response = await fetch(`${this.apiUrl}/auth/email-available?email=${email}`);
+            if (!response.ok) {
+                return;
+            }
+
+            const result = await response.json();
+            if (!result.available) {
+                this.showAlert('registerAlert', 'El email ya está registrado', 'error');
+            }
+        } catch (error) {
+            // El registro vuelve a comprobarlo; un fallo aquí no bloquea el formulario
+        }
+    }
+
     async handleRegister(e) {
         e.preventDefault();
         const btn = document.getElementById('registerBtn');
@@ -151,12 +179,71 @@ class AuthApp {
     }
 
     handleLogout() {
+        if (this.token) {
+            // Revocar el token y su refresh token en el servidor; la sesión local se cierra igualmente
+            fetch(`${this.apiUrl}/auth/logout`, {
+                method: 'POST',
+                headers: {
+                    'Authorization': `Bearer ${this.token}`,
+                    'Content-Type': 'application/json'
+                },
+                body: this.refreshToken ? JSON.stringify({ refresh_token: this.refreshToken }) : undefined
+            }).catch(() => {});
+        }
         localStorage.removeItem('token');
+        localStorage.removeItem('refreshToken');
         localStorage.removeItem('user');
+        localStorage.removeItem('userEtag');
         this.token = null;
+        this.refreshToken = null;
         this.showForm('login');
     }
 
+    storeTokens(result) {
+        localStorage.setItem('token', result.access_token);
+        localStorage.setItem('refreshToken', result.refresh_token);
+        this.token = result.access_token;
+        this.refreshToken = result.refresh_token;
+    }
+
+    refreshSession() {
+        // Una sola renovación a la vez: cada refresh token solo se puede canjear una vez
+        if (!this.refreshing) {
+            this.refreshing = fetch(`${this.apiUrl}/auth/refresh`, {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json'
+                },
+                body: JSON.stringify({ refresh_token: this.refreshToken })
+            })
+                .then(async (response) => {
+                    if (!response.ok) {
+                        return false;
+                    }
+                    this.storeTokens(await response.json());
+                    return true;
+                })
+                .catch(() => false)
+                .finally(() => {
+                    this.refreshing = null;
+                });
+        }
+        return this.refreshing;
+    }
+
+    async authFetch(url, options = {}) {
+        // Con el token de acceso caducado se renueva en silencio y se repite la petición
+        const request = () => fetch(url, {
+            ...options,
+            headers: { ...options.headers, 'Authorization': `Bearer ${this.token}` }
+        });
+        const response = await request();
+        if (response.status === 401 && this.refreshToken && await this.refreshSession()) {
+            return request();
+        }
+        return response;
+    }
+
     checkAuth() {
         if (this.token) {
             this.verifyToken();
@@ -165,13 +252,24 @@ class AuthApp {
 
     async verifyToken() {
         try {
-            const response = await fetch(`${this.apiUrl}/auth/me`, {
-                headers: {
-                    'Authorization': `Bearer ${this.token}`
-                }
-            });
+            const headers = {};
+            // Con el ETag guardado el servidor responde 304 sin cuerpo si el usuario no ha cambiado
+            const etag = localStorage.getItem('userEtag');
+            if (etag && localStorage.getItem('user')) {
+                headers['If-None-Match'] = etag;
+            }
 
-            if (response.ok) {
+            const response = await this.authFetch(`${this.apiUrl}/auth/me`, { headers });
+
+            if (response.status === 304) {
+                this.showDashboard();
+                this.loadUserData();
+            } else if (response.ok) {
+                localStorage.setItem('user', JSON.stringify(await response.json()));
+                const newEtag = response.headers.get('ETag');
+                if (newEtag) {
+                    localStorage.setItem('userEtag', newEtag);
+                }
                 this.showDashboard();
                 this.loadUserData();
             } else {
@@ -4,8 +4,18 @@ import asyncio
 from fastapi.testclient import TestClient
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
-from main import app, get_db, Base, User
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from main import app, get_db, Base, User, password_hasher, token_cache
+from main import (
+    UserCreate, get_password_hash, get_async_database_url, pwd_context, calibrate_bcrypt,
+    TokenBucketLimiter, login_ip_limiter, login_email_limiter, register_batch_limiter, email_check_limiter,
+    BloomFilter, EmailRegistry, revocation_list, SECRET_KEY, ALGORITHM,
+    KeyRing, generate_signing_key,
+    get_user_by_email_async, create_user_async, authenticate_user_async, delete_user_by_id_async,
+)
 import json
+import time
+import uuid
 
 # Base de datos en memoria para tests
 SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
@@ -27,6 +37,22 @@ app.dependency_overrides[get_db] = override_get_db
 client = TestClient(app)
 
 # Fixtures
+@pytest.fixture(autouse=True)
+def reset_login_limiters():
+    """Cada test empieza con los límites de login vacíos"""
+    login_ip_limiter.reset()
+    login_email_limiter.reset()
+    register_batch_limiter.reset()
+    email_check_limiter.reset()
+
+METRICS_HEADERS = {"Authorization": "Bearer test-metrics-token"}
+
+@pytest.fixture(autouse=True)
+def metrics_token(monkeypatch):
+    """/stats y /metrics con el token del scraper de los tests"""
+    import main
+    monkeypatch.setattr(main, "METRICS_TOKEN", "test-metrics-token")
+
 @pytest.fixture
 def test_user_data():
     return {
@@ -171,6 +197,1389 @@ class TestAuth:
         response = client.get("/auth/users")
         assert response.status_code == 403
 
+def unique_email(prefix="user"):
+    """Email único para que los tests no dependan del estado de test.db"""
+    return f"{prefix}-{uuid.uuid4().hex[:10]}@example.com"
+
+class TestPasswordHasher:
+
+    def test_stats_exposes_hash_queue(self):
+        """Test de métricas del pool de hashing"""
+        response = client.get("/stats", headers=METRICS_HEADERS)
+        assert response.status_code == 200
+        hashing = response.json()["hashing"]
+        assert hashing["workers"] >= 1
+        assert "queue_depth" in hashing
+        assert "rejected" in hashing
+
+    def test_register_rejected_when_pool_saturated(self, monkeypatch):
+        """Test de backpressure: 503 cuando el pool de hashing está lleno"""
+        monkeypatch.setattr(password_hasher, "workers", 0)
+        monkeypatch.setattr(password_hasher, "queue_size", 0)
+        user_data = {"name": "Busy", "email": unique_email("busy"), "password": "testpass123"}
+        response = client.post("/auth/register", json=user_data)
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "1"
+
+def register_and_login(prefix="user", password="testpass123"):
+    """Registrar un usuario nuevo y devolver (datos, token)"""
+    user_data = {"name": f"User {prefix}", "email": unique_email(prefix), "password": password}
+    client.post("/auth/register", json=user_data)
+    login_response = client.post("/auth/login", json={"email": user_data["email"], "password": password})
+    return user_data, login_response.json()["access_token"]
+
+class TestTokenCache:
+
+    def test_repeated_me_hits_cache(self):
+        """Test de que /auth/me reutiliza el token ya verificado"""
+        _, token = register_and_login("cache")
+        headers = {"Authorization": f"Bearer {token}"}
+        client.get("/auth/me", headers=headers)
+        hits_before = token_cache.hits
+        response = client.get("/auth/me", headers=headers)
+        assert response.status_code == 200
+        assert token_cache.hits == hits_before + 1
+        assert "token_cache" in client.get("/stats", headers=METRICS_HEADERS).json()
+
+    def test_delete_user_invalidates_cache(self):
+        """Test de que eliminar el usuario invalida su token en caché"""
+        _, token = register_and_login("deleted")
+        headers = {"Authorization": f"Bearer {token}"}
+        user_id = client.get("/auth/me", headers=headers).json()["id"]
+        response = client.delete(f"/auth/users/{user_id}", headers=headers)
+        assert response.status_code == 200
+        response = client.get("/auth/me", headers=headers)
+        assert response.status_code == 401
+
+    def test_revocation_from_another_worker_beats_cache(self):
+        """Test de que un token en caché revocado en otro worker deja de valer al sincronizar"""
+        from datetime import datetime, timedelta
+        from jose import jwt as jose_jwt
+        from main import RevokedToken
+        _, token = register_and_login("cache-revoked")
+        headers = {"Authorization": f"Bearer {token}"}
+        assert client.get("/auth/me", headers=headers).status_code == 200
+        # El logout de otro worker solo escribe en la tabla; esta caché no se entera
+        jti = jose_jwt.get_unverified_claims(token)["jti"]
+        with TestingSessionLocal() as db:
+            db.add(RevokedToken(jti=jti, expires_at=datetime.utcnow() + timedelta(hours=1), revoked_at=datetime.utcnow()))
+            db.commit()
+        revocation_list._synced_at = None
+        assert client.get("/auth/me", headers=headers).status_code == 401
+
+class TestAsyncDatabase:
+
+    def test_async_database_url(self):
+        """Test de traducción de URLs al driver asíncrono"""
+        assert get_async_database_url("sqlite:///./auth.db") == "sqlite+aiosqlite:///./auth.db"
+        assert get_async_database_url("postgresql://u:p@db/auth") == "postgresql+asyncpg://u:p@db/auth"
+        assert get_async_database_url("postgresql+psycopg2://u:p@db/auth") == "postgresql+asyncpg://u:p@db/auth"
+        assert get_async_database_url("postgresql+asyncpg://u:p@db/auth") == "postgresql+asyncpg://u:p@db/auth"
+
+    def test_async_session_helpers(self):
+        """Test de las versiones asíncronas con una AsyncSession real"""
+        email = unique_email("async")
+
+        async def scenario():
+            async_engine = create_async_engine("sqlite+aiosqlite:///./test.db")
+            try:
+                async with AsyncSession(async_engine, expire_on_commit=False) as session:
+                    user = UserCreate(name="Async User", email=email, password="testpass123")
+                    created = await create_user_async(session, user, hashed_password=get_password_hash("testpass123"))
+                    found = await get_user_by_email_async(session, email)
+                    authenticated = await authenticate_user_async(session, email, "testpass123")
+                    rejected = await authenticate_user_async(session, email, "wrongpassword")
+                    deleted = await delete_user_by_id_async(session, created.id)
+                    return created, found, authenticated, rejected, deleted
+            finally:
+                await async_engine.dispose()
+
+        created, found, authenticated, rejected, deleted = asyncio.run(scenario())
+        assert found.id == created.id
+        assert authenticated.id == created.id
+        assert rejected is False
+        assert deleted is True
+
+    def test_configured_async_mode_on_aiosqlite(self, tmp_path):
+        """Test de DB_ASYNC=true con la URL SQLite: importar main y registrar, entrar y consultar /auth/me"""
+        import os
+        import subprocess
+        import sys
+        from benchmarks.loadtest import BACKEND_DIR
+        script = (
+            "from fastapi.testclient import TestClient\n"
+            "import main\n"
+            "assert main.AsyncSessionLocal is not None\n"
+            "user = {'name': 'Async', 'email': 'async-mode@example.com', 'password': 'secret123'}\n"
+            "with TestClient(main.app) as client:\n"
+            "    assert client.post('/auth/register', json=user).status_code == 200\n"
+            "    login = client.post('/auth/login', json={'email': user['email'], 'password': user['password']})\n"
+            "    assert login.status_code == 200\n"
+            "    token = login.json()['access_token']\n"
+            "    me = client.get('/auth/me', headers={'Authorization': f'Bearer {token}'})\n"
+            "    assert me.json()['email'] == user['email']\n"
+        )
+        env = dict(os.environ, DB_ASYNC="true", DATABASE_URL=f"sqlite:///{tmp_path / 'async.db'}", BCRYPT_ROUNDS="4")
+        result = subprocess.run([sys.executable, "-c", script], cwd=BACKEND_DIR, env=env,
+                                capture_output=True, text=True, timeout=120)
+        assert result.returncode == 0, result.stderr
+
+class TestUsersPagination:
+
+    def test_keyset_pagination(self):
+        """Test de paginación por cursor en /auth/users"""
+        _, token = register_and_login("page")
+        register_and_login("page")
+        register_and_login("page")
+        headers = {"Authorization": f"Bearer {token}"}
+
+        first = client.get("/auth/users", params={"limit": 2}, headers=headers)
+        assert first.status_code == 200
+        assert len(first.json()) == 2
+        assert "hashed_password" not in first.json()[0]
+        cursor = first.headers["X-Next-Cursor"]
+        assert cursor == str(first.json()[-1]["id"])
+
+        second = client.get("/auth/users", params={"limit": 2, "cursor": cursor}, headers=headers)
+        assert second.status_code == 200
+        assert all(user["id"] > int(cursor) for user in second.json())
+
+    def test_stream_ndjson(self):
+        """Test de exportación NDJSON de /auth/users"""
+        _, token = register_and_login("stream")
+        headers = {"Authorization": f"Bearer {token}"}
+        response = client.get("/auth/users", params={"stream": True}, headers=headers)
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("application/x-ndjson")
+        users = [json.loads(line) for line in response.text.splitlines()]
+        assert len(users) >= 1
+        assert set(users[0]) == {"id", "name", "email", "created_at"}
+        assert [user["id"] for user in users] == sorted(user["id"] for user in users)
+
+@pytest.fixture
+def batch_admin_headers(monkeypatch):
+    """Cabeceras de un administrador, necesarias para /auth/register/batch"""
+    import main
+    user, token = register_and_login("batch-admin")
+    monkeypatch.setattr(main, "ADMIN_EMAILS", {user["email"]})
+    return {"Authorization": f"Bearer {token}"}
+
+class TestBatchRegister:
+
+    def test_register_batch(self, test_user_data, batch_admin_headers):
+        """Test de registro por lotes con resultado por elemento"""
+        client.post("/auth/register", json=test_user_data)
+        new_email = unique_email("batch")
+        batch = [
+            {"name": "Batch One", "email": new_email, "password": "testpass123"},
+            {"name": "Batch Two", "email": unique_email("batch"), "password": "testpass123"},
+            {"name": "Repeated", "email": new_email, "password": "testpass123"},
+            {"name": "Existing", "email": test_user_data["email"], "password": "testpass123"},
+            {"name": "Short", "email": unique_email("batch"), "password": "123"},
+        ]
+        response = client.post("/auth/register/batch", json=batch, headers=batch_admin_headers)
+        assert response.status_code == 200
+        results = response.json()
+        assert [result["status"] for result in results] == ["created", "created", "duplicate", "duplicate", "invalid"]
+        assert results[0]["user"]["email"] == new_email
+        assert "id" in results[0]["user"]
+
+        login_response = client.post("/auth/login", json={"email": new_email, "password": "testpass123"})
+        assert login_response.status_code == 200
+
+    def test_register_batch_too_large(self, monkeypatch, batch_admin_headers):
+        """Test de límite de tamaño del lote"""
+        import main
+        monkeypatch.setattr(main, "REGISTER_BATCH_MAX", 1)
+        batch = [
+            {"name": "A", "email": unique_email("big"), "password": "testpass123"},
+            {"name": "B", "email": unique_email("big"), "password": "testpass123"},
+        ]
+        response = client.post("/auth/register/batch", json=batch, headers=batch_admin_headers)
+        assert response.status_code == 400
+
+    def test_register_batch_requires_admin_and_is_throttled(self, batch_admin_headers):
+        """Test de que el registro por lotes exige administrador y limita los lotes por IP"""
+        batch = [{"name": "A", "email": unique_email("throttle"), "password": "testpass123"}]
+        assert client.post("/auth/register/batch", json=batch).status_code == 403
+        _, token = register_and_login("batch-user")
+        response = client.post("/auth/register/batch", json=batch, headers={"Authorization": f"Bearer {token}"})
+        assert response.status_code == 403
+        statuses = [
+            client.post("/auth/register/batch", json=[], headers=batch_admin_headers).status_code
+            for _ in range(register_batch_limiter.burst + 1)
+        ]
+        assert statuses[-1] == 429
+        assert "Retry-After" in client.post("/auth/register/batch", json=[], headers=batch_admin_headers).headers
+
+class TestHashCost:
+
+    def test_login_rehashes_outdated_hash(self):
+        """Test de rehash en segundo plano de un hash con coste antiguo"""
+        from passlib.hash import bcrypt
+        email = unique_email("rehash")
+        old_hash = bcrypt.using(rounds=4).hash("testpass123")
+        db = TestingSessionLocal()
+        db.add(User(name="Old Hash", email=email, hashed_password=old_hash))
+        db.commit()
+        db.close()
+        assert pwd_context.needs_update(old_hash)
+
+        response = client.post("/auth/login", json={"email": email, "password": "testpass123"})
+        assert response.status_code == 200
+
+        new_hash = old_hash
+        deadline = time.time() + 10
+        while new_hash == old_hash and time.time() < deadline:
+            time.sleep(0.05)
+            db = TestingSessionLocal()
+            new_hash = db.query(User).filter(User.email == email).first().hashed_password
+            db.close()
+        assert new_hash != old_hash
+        assert not pwd_context.needs_update(new_hash)
+        assert pwd_context.verify("testpass123", new_hash)
+
+    def test_sync_authenticate_defers_rehash(self):
+        """Test de authenticate_user síncrono: el rehash se aplaza a BackgroundTasks"""
+        from fastapi import BackgroundTasks
+        from passlib.hash import bcrypt
+        from main import authenticate_user, rehash_password
+        email = unique_email("sync-rehash")
+        old_hash = bcrypt.using(rounds=4).hash("testpass123")
+        with TestingSessionLocal() as db:
+            db.add(User(name="Old Hash", email=email, hashed_password=old_hash))
+            db.commit()
+
+        background_tasks = BackgroundTasks()
+        with TestingSessionLocal() as db:
+            user = authenticate_user(db, email, "testpass123", background_tasks)
+            assert user.email == email
+            assert user.hashed_password == old_hash
+        assert [task.func for task in background_tasks.tasks] == [rehash_password]
+        asyncio.run(background_tasks())
+        with TestingSessionLocal() as db:
+            new_hash = db.query(User).filter(User.email == email).first().hashed_password
+        assert not pwd_context.needs_update(new_hash)
+        assert pwd_context.verify("testpass123", new_hash)
+
+    def test_verify_timings_per_scheme(self, test_user_data, test_login_data):
+        """Test de tiempos de verificación por esquema en /stats"""
+        client.post("/auth/register", json=test_user_data)
+        client.post("/auth/login", json=test_login_data)
+        timings = client.get("/stats", headers=METRICS_HEADERS).json()["verify_timings"]
+        assert timings["bcrypt"]["count"] >= 1
+        assert timings["bcrypt"]["avg_ms"] > 0
+
+    def test_calibrate_bcrypt_respects_floor(self):
+        """Test de calibración: nunca recomienda menos rondas que el mínimo"""
+        rounds, timings = calibrate_bcrypt(target_ms=0, min_rounds=4, max_rounds=6)
+        assert rounds == 4
+        assert list(timings) == [4]
+
+class TestLoginRateLimit:
+
+    def test_login_rejected_before_hashing(self, monkeypatch):
+        """Test de 429 por email sin llegar a verificar la contraseña"""
+        import main
+        monkeypatch.setattr(main, "login_email_limiter", TokenBucketLimiter(1, 2, 100))
+        login_data = {"email": unique_email("limited"), "password": "wrongpassword"}
+        for _ in range(2):
+            assert client.post("/auth/login", json=login_data).status_code == 401
+        verified_before = password_hasher.completed
+        response = client.post("/auth/login", json=login_data)
+        assert response.status_code == 429
+        assert int(response.headers["Retry-After"]) >= 1
+        assert password_hasher.completed == verified_before
+
+    def test_limiter_evicts_oldest_key(self):
+        """Test de memoria acotada: se expulsa la clave menos reciente"""
+        limiter = TokenBucketLimiter(60, 1, 2)
+        assert limiter.hit("a") == 0
+        assert limiter.hit("a") > 0
+        limiter.hit("b")
+        limiter.hit("c")
+        assert limiter.evictions == 1
+        assert limiter.hit("a") == 0
+
+class TestLogout:
+
+    def test_token_has_jti(self):
+        """Test de que los tokens llevan un identificador revocable"""
+        from jose import jwt as jose_jwt
+        _, token = register_and_login("jti")
+        payload = jose_jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        assert len(payload["jti"]) == 32
+
+    def test_logout_revokes_token(self):
+        """Test de logout: el token deja de ser válido"""
+        _, token = register_and_login("logout")
+        headers = {"Authorization": f"Bearer {token}"}
+        assert client.get("/auth/me", headers=headers).status_code == 200
+        response = client.post("/auth/logout", headers=headers)
+        assert response.status_code == 200
+        assert client.get("/auth/me", headers=headers).status_code == 401
+        assert client.post("/auth/logout", headers=headers).status_code == 401
+
+    def test_valid_token_resolved_by_bloom_filter(self):
+        """Test de que un token no revocado se descarta en memoria sin consultar la tabla"""
+        _, token = register_and_login("bloom")
+        negatives_before = revocation_list.bloom_negatives
+        client.get("/auth/me", headers={"Authorization": f"Bearer {token}"})
+        assert revocation_list.bloom_negatives == negatives_before + 1
+        assert "revocation" in client.get("/stats", headers=METRICS_HEADERS).json()
+
+    def test_revocation_sync_single_flight_and_snapshot_mark(self):
+        """Test de la sincronización de revocaciones: una a la vez y la marca de la misma instantánea"""
+        from datetime import datetime, timedelta
+        from main import RevocationList, RevokedToken
+        revocations = RevocationList(1000, 0.01, 0, 0)
+        expires_at = datetime.utcnow() + timedelta(hours=1)
+        with TestingSessionLocal() as db:
+            db.add(RevokedToken(jti=uuid.uuid4().hex, expires_at=expires_at, revoked_at=datetime.utcnow()))
+            db.commit()
+            revocations.sync(db)
+            newest = db.query(RevokedToken).order_by(RevokedToken.revoked_at.desc()).first().revoked_at
+
+            # Con una sincronización en curso, las peticiones siguen sin tocar la base de datos
+            revocations._sync_lock.acquire()
+            try:
+                revocations.sync(None)
+            finally:
+                revocations._sync_lock.release()
+
+            # Una reconstrucción no hereda una marca posterior a su instantánea
+            revocations._last_revoked_at = datetime(2100, 1, 1)
+            revocations.sync(db)
+            assert revocations._last_revoked_at == newest
+
+        # Un logout de este worker mientras se reconstruye el filtro también llega al filtro nuevo
+        local_jti = uuid.uuid4().hex
+
+        class RevokeDuringRebuild:
+            def __init__(self, db):
+                self.db = db
+                self.revoked = False
+
+            def __getattr__(self, name):
+                return getattr(self.db, name)
+
+            def execute(self, statement, *args, **kwargs):
+                if revocations._revoked_during_rebuild is not None and not self.revoked:
+                    self.revoked = True
+                    with TestingSessionLocal() as other:
+                        revocations.revoke(other, local_jti, expires_at)
+                return self.db.execute(statement, *args, **kwargs)
+
+        with TestingSessionLocal() as db:
+            wrapped = RevokeDuringRebuild(db)
+            revocations.sync(wrapped)
+        assert wrapped.revoked
+        assert revocations.might_be_revoked(local_jti)
+
+    def test_bloom_filter_has_no_false_negatives(self):
+        """Test del filtro de Bloom: todo lo añadido se encuentra"""
+        bloom = BloomFilter(1000, 0.01)
+        keys = [uuid.uuid4().hex for _ in range(1000)]
+        for key in keys:
+            bloom.add(key)
+        assert all(key in bloom for key in keys)
+        false_positives = sum(uuid.uuid4().hex in bloom for _ in range(1000))
+        assert false_positives < 50
+
+class TestAsymmetricSigning:
+
+    @pytest.fixture
+    def es256(self, monkeypatch, tmp_path):
+        """Firmar con ES256 usando un directorio de claves temporal"""
+        import main
+        ring = KeyRing("ES256", str(tmp_path), None, reload_seconds=0, publish_seconds=0)
+        monkeypatch.setattr(main, "ALGORITHM", "ES256")
+        monkeypatch.setattr(main, "key_ring", ring)
+        return ring, tmp_path
+
+    def test_token_signed_with_kid(self, es256):
+        """Test de firma ES256 con kid y verificación por kid"""
+        from jose import jwt as jose_jwt
+        ring, keys_dir = es256
+        kid = generate_signing_key(str(keys_dir), "ES256")
+        _, token = register_and_login("es256")
+        assert jose_jwt.get_unverified_header(token)["kid"] == kid
+        response = client.get("/auth/me", headers={"Authorization": f"Bearer {token}"})
+        assert response.status_code == 200
+
+    def test_rotation_keeps_old_tokens_valid(self, es256):
+        """Test de rotación: los tokens firmados con la clave anterior siguen siendo válidos"""
+        import os
+        from jose import jwt as jose_jwt
+        ring, keys_dir = es256
+        old_kid = generate_signing_key(str(keys_dir), "ES256")
+        _, old_token = register_and_login("rotate")
+        os.utime(keys_dir / f"{old_kid}.pem", (0, 0))
+        new_kid = generate_signing_key(str(keys_dir), "ES256")
+        _, new_token = register_and_login("rotate")
+        assert jose_jwt.get_unverified_header(new_token)["kid"] == new_kid
+        for token in (old_token, new_token):
+            assert client.get("/auth/me", headers={"Authorization": f"Bearer {token}"}).status_code == 200
+
+    def test_new_key_takes_over_after_publish_window(self, es256, monkeypatch):
+        """Test de rotación con publish_seconds: la clave nueva firma al cumplir el plazo, sin cambiar ficheros"""
+        import os
+        ring, keys_dir = es256
+        ring.publish_seconds = 300
+        old_kid = generate_signing_key(str(keys_dir), "ES256")
+        os.utime(keys_dir / f"{old_kid}.pem", (0, 0))
+        new_kid = generate_signing_key(str(keys_dir), "ES256")
+        assert ring.signing_key()[0] == old_kid
+        now = time.time()
+        monkeypatch.setattr(time, "time", lambda: now + 301)
+        assert ring.signing_key()[0] == new_kid
+
+    def test_unknown_kid_rejected(self, es256):
+        """Test de token con un kid que no está en el anillo de claves"""
+        ring, keys_dir = es256
+        generate_signing_key(str(keys_dir), "ES256")
+        _, token = register_and_login("kid")
+        for path in keys_dir.iterdir():
+            path.unlink()
+        generate_signing_key(str(keys_dir), "ES256")
+        assert client.get("/auth/me", headers={"Authorization": f"Bearer {token}"}).status_code == 401
+
+    def test_jwks_endpoint(self, es256):
+        """Test del endpoint JWKS con cabeceras de caché"""
+        ring, keys_dir = es256
+        kid = generate_signing_key(str(keys_dir), "ES256")
+        response = client.get("/.well-known/jwks.json")
+        assert response.status_code == 200
+        assert "max-age" in response.headers["Cache-Control"]
+        keys = response.json()["keys"]
+        assert [key["kid"] for key in keys] == [kid]
+        assert keys[0]["kty"] == "EC"
+        assert "d" not in keys[0]
+
+class TestLoadTestHarness:
+
+    def test_percentiles_and_regressions(self):
+        """Test de percentiles y detección de regresiones del benchmark de carga"""
+        from benchmarks.loadtest import percentile, compare_with_baseline, error_rate
+        values = [i / 1000 for i in range(1, 101)]
+        assert percentile(values, 50) == 0.05
+        assert percentile(values, 99) == 0.099
+        def run(rps, p95, errors=0):
+            return {"throughput_rps": rps, "endpoints": {"me": {"count": 100, "errors": errors, "p95_ms": p95, "p99_ms": 20}}}
+        baseline = run(100, 10)
+        assert compare_with_baseline(run(95, 11), baseline, 0.2) == []
+        assert len(compare_with_baseline(run(50, 30), baseline, 0.2)) == 2
+        assert len(compare_with_baseline(run(100, 10, errors=20), baseline, 0.2)) == 1
+        assert error_rate({"total_requests": 100, **run(100, 10, errors=20)}) == 0.2
+
+    def test_thin_endpoints_are_not_compared(self):
+        """Test de que no se comparan endpoints con pocas muestras, ni en la ejecución ni en la línea base"""
+        from benchmarks.loadtest import compare_with_baseline, thin_endpoints
+        def run(count):
+            return {"throughput_rps": 100, "endpoints": {
+                "me": {"count": count, "errors": 0, "p95_ms": 10, "p99_ms": 20},
+                "login": {"count": 500, "errors": 0, "p95_ms": 10, "p99_ms": 20},
+            }}
+        assert thin_endpoints(run(8)) == ["me"]
+        assert compare_with_baseline(run(60), run(60), 0.2) == []
+        with pytest.raises(ValueError, match="me"):
+            compare_with_baseline(run(8), run(60), 0.2)
+        with pytest.raises(ValueError, match="línea base"):
+            compare_with_baseline(run(60), run(8), 0.2)
+
+    def test_run_load_in_process(self, monkeypatch):
+        """Test de humo del driver de carga contra la app ASGI"""
+        import httpx
+        import main
+        from benchmarks.loadtest import ADMIN_EMAIL, admin_headers, seed_users, login_tokens, run_load
+        monkeypatch.setattr(main, "ADMIN_EMAILS", {ADMIN_EMAIL})
+
+        async def scenario():
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench") as bench_client:
+                emails = await seed_users(bench_client, 2, await admin_headers(bench_client))
+                tokens = await login_tokens(bench_client, emails)
+                return await run_load(bench_client, "read-heavy", 0.3, 2, emails, tokens)
+
+        result = asyncio.run(scenario())
+        assert result["total_requests"] > 0
+        assert result["endpoints"]["me"]["count"] > 0
+        assert result["endpoints"]["me"]["errors"] == 0
+
+class TestMetrics:
+
+    def test_metrics_require_token_or_admin(self, monkeypatch):
+        """Test de acceso a /stats y /metrics: token del scraper o administrador, nunca anónimo"""
+        import main
+        user, token = register_and_login("metrics")
+        user_headers = {"Authorization": f"Bearer {token}"}
+        for path in ("/stats", "/metrics"):
+            assert client.get(path).status_code == 401
+            assert client.get(path, headers={"Authorization": "Bearer otro-token"}).status_code == 401
+            assert client.get(path, headers=user_headers).status_code == 403
+            assert client.get(path, headers=METRICS_HEADERS).status_code == 200
+        monkeypatch.setattr(main, "ADMIN_EMAILS", {user["email"]})
+        assert client.get("/metrics", headers=user_headers).status_code == 200
+        # Sin METRICS_TOKEN configurado, un token vacío no abre la puerta
+        monkeypatch.setattr(main, "METRICS_TOKEN", "")
+        assert client.get("/stats", headers={"Authorization": "Bearer "}).status_code in (401, 403)
+
+    def test_metrics_phases_and_queries(self, test_user_data, test_login_data):
+        """Test de /metrics: fases por endpoint, consultas SQL y pool"""
+        client.post("/auth/register", json=test_user_data)
+        client.post("/auth/login", json=test_login_data)
+        response = client.get("/metrics", headers=METRICS_HEADERS)
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain")
+        body = response.text
+        for phase in ("total", "hash", "jwt", "db", "app"):
+            assert f'auth_request_duration_seconds_count{{endpoint="POST /auth/login",phase="{phase}"}}' in body
+        assert 'auth_db_queries_per_request_count{endpoint="POST /auth/login"}' in body
+        assert 'auth_requests_total{endpoint="POST /auth/login",status="200"}' in body
+        assert "auth_hash_queue_depth" in body
+        assert "auth_db_pool_checkedout" in body
+
+    def test_histogram_buckets_are_cumulative(self):
+        """Test del histograma: buckets acumulados, suma y cuenta"""
+        from main import Histogram
+        histogram = Histogram((0.1, 1.0))
+        for value in (0.05, 0.5, 5.0):
+            histogram.observe(("x",), value)
+        lines = histogram.render("m", ("label",))
+        assert 'm_bucket{label="x",le="0.1"} 1' in lines
+        assert 'm_bucket{label="x",le="1.0"} 2' in lines
+        assert 'm_bucket{label="x",le="+Inf"} 3' in lines
+        assert 'm_count{label="x"} 3' in lines
+
+class TestSqliteProductionProfile:
+
+    SCRIPT = """
+import json
+from concurrent.futures import ThreadPoolExecutor
+from fastapi.testclient import TestClient
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+import main
+
+main.migrate()
+client = TestClient(main.app)
+
+def register(i):
+    return client.post("/auth/register", json={"name": "P", "email": f"p{i}@example.com", "password": "secret123"}).status_code
+
+with ThreadPoolExecutor(8) as pool:
+    statuses = list(pool.map(register, range(16)))
+token = client.post("/auth/login", json={"email": "p0@example.com", "password": "secret123"}).json()["access_token"]
+users = client.get("/auth/users", headers={"Authorization": f"Bearer {token}"}).json()
+with main.read_engine.connect() as conn:
+    journal_mode = conn.execute(text("PRAGMA journal_mode")).scalar()
+    query_only = conn.execute(text("PRAGMA query_only")).scalar()
+    try:
+        conn.execute(text("DELETE FROM users"))
+        read_only = False
+    except OperationalError:
+        read_only = True
+print(json.dumps({"statuses": statuses, "users": len(users), "journal_mode": journal_mode,
+                  "query_only": query_only, "read_only": read_only}))
+"""
+
+    def test_wal_and_read_pool(self, tmp_path):
+        """Test del perfil production: WAL, escrituras concurrentes y pool de solo lectura"""
+        import os
+        import subprocess
+        import sys
+        backend_dir = os.path.dirname(os.path.abspath(__import__("main").__file__))
+        env = dict(
+            os.environ, SQLITE_PROFILE="production", DATABASE_URL=f"sqlite:///{tmp_path / 'prod.db'}",
+            BCRYPT_ROUNDS="4", HASH_QUEUE_SIZE="32",
+        )
+        output = subprocess.run(
+            [sys.executable, "-c", self.SCRIPT], cwd=backend_dir, env=env,
+            capture_output=True, text=True, check=True,
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        assert result["statuses"] == [200] * 16
+        assert result["users"] == 16
+        assert result["journal_mode"] == "wal"
+        assert result["query_only"] == 1
+        assert result["read_only"] is True
+
+class TestColdStart:
+
+    # Coste propio de `import main` una vez cargados FastAPI, SQLAlchemy, etc.
+    IMPORT_BUDGET_MS = 150
+
+    SCRIPT = """
+import json, os, time
+import fastapi, fastapi.security, fastapi.middleware.cors, sqlalchemy, sqlalchemy.orm, sqlalchemy.ext.asyncio
+import sqlalchemy.dialects.sqlite, pydantic, email_validator, passlib.context, passlib.handlers.bcrypt, jose.jwt, dotenv
+import concurrent.futures.process
+start = time.perf_counter()
+import main
+elapsed_ms = (time.perf_counter() - start) * 1000
+print(json.dumps({"elapsed_ms": elapsed_ms, "db_exists": os.path.exists(os.environ["DB_PATH"])}))
+"""
+
+    def run_script(self, script, tmp_path, **extra_env):
+        import os
+        import subprocess
+        import sys
+        backend_dir = os.path.dirname(os.path.abspath(__import__("main").__file__))
+        db_path = tmp_path / "cold.db"
+        env = dict(os.environ, DATABASE_URL=f"sqlite:///{db_path}", DB_PATH=str(db_path), **extra_env)
+        return subprocess.run(
+            [sys.executable, *script], cwd=backend_dir, env=env, capture_output=True, text=True, check=True,
+        ).stdout, db_path
+
+    def test_import_budget_without_db(self, tmp_path):
+        """Test de arranque en frío: importar main no toca la base de datos y cabe en el presupuesto"""
+        output, _ = self.run_script(["-c", self.SCRIPT], tmp_path)
+        result = json.loads(output.strip().splitlines()[-1])
+        assert result["db_exists"] is False
+        assert result["elapsed_ms"] < self.IMPORT_BUDGET_MS
+
+    def test_migrate_command_and_lifespan(self, tmp_path):
+        """Test del comando migrate y del arranque con lifespan"""
+        _, db_path = self.run_script(["main.py", "migrate"], tmp_path)
+        assert db_path.exists()
+        script = (
+            "from fastapi.testclient import TestClient\n"
+            "import main\n"
+            "with TestClient(main.app) as client:\n"
+            "    print(client.post('/auth/register', json={'name': 'C', 'email': 'c@example.com', 'password': 'secret123'}).status_code)\n"
+        )
+        output, _ = self.run_script(["-c", script], tmp_path, AUTO_MIGRATE="false", BCRYPT_ROUNDS="4")
+        assert output.strip().splitlines()[-1] == "200"
+
+class TestFastJson:
+
+    @pytest.fixture
+    def fast_json(self, monkeypatch):
+        import main
+        monkeypatch.setattr(main, "FAST_JSON", True)
+
+    def test_same_payloads_as_default_path(self, monkeypatch):
+        """Test de FAST_JSON: mismas respuestas (y cabeceras) que el camino por defecto"""
+        import main
+        _, token = register_and_login("fastjson")
+        headers = {"Authorization": f"Bearer {token}"}
+        register_and_login("fastjson")
+        default = (client.get("/auth/me", headers=headers), client.get("/auth/users?limit=1", headers=headers))
+        monkeypatch.setattr(main, "FAST_JSON", True)
+        fast = (client.get("/auth/me", headers=headers), client.get("/auth/users?limit=1", headers=headers))
+        for default_response, fast_response in zip(default, fast):
+            assert fast_response.status_code == 200
+            assert fast_response.headers["content-type"] == "application/json"
+            assert fast_response.json() == default_response.json()
+        assert fast[1].headers["X-Next-Cursor"] == default[1].headers["X-Next-Cursor"]
+
+    def test_login_and_register(self, fast_json):
+        """Test de FAST_JSON en registro y login"""
+        email = unique_email("fastjson")
+        response = client.post("/auth/register", json={"name": "Fast", "email": email, "password": "secret123"})
+        assert response.status_code == 200
+        assert response.json()["email"] == email
+        response = client.post("/auth/login", json={"email": email, "password": "secret123"})
+        assert response.status_code == 200
+        body = response.json()
+        assert body["token_type"] == "bearer"
+        assert body["user"]["email"] == email
+        assert "hashed_password" not in body["user"]
+
+class TestServe:
+
+    def test_healthcheck_timeout_only_when_supported(self, monkeypatch):
+        """Test de `serve` con uvicorn anterior a 0.37: no se pasa timeout_worker_healthcheck"""
+        import main
+        import uvicorn
+        calls = []
+        monkeypatch.setenv("AUTO_MIGRATE", "true")
+        monkeypatch.setattr(main, "migrate", lambda *args: None)
+        monkeypatch.setattr(uvicorn, "run", lambda app, **options: calls.append(options))
+        main.serve("127.0.0.1", 8000, 2)
+
+        class OldConfig:
+            def __init__(self, app, host="127.0.0.1", port=8000, timeout_graceful_shutdown=None):
+                pass
+
+        monkeypatch.setattr(uvicorn, "Config", OldConfig)
+        main.serve("127.0.0.1", 8000, 2)
+        assert calls[0]["timeout_worker_healthcheck"] == main.SERVER_READY_TIMEOUT
+        assert "timeout_worker_healthcheck" not in calls[1]
+
+    def test_rolling_restart_keeps_serving(self, tmp_path):
+        """Test de `main.py serve`: migra una vez y SIGHUP reemplaza los workers sin cortar el servicio"""
+        import os
+        import signal
+        import subprocess
+        import sys
+        import threading
+        import httpx
+        from benchmarks.loadtest import BACKEND_DIR, free_port
+        port = free_port()
+        env = dict(os.environ, DATABASE_URL=f"sqlite:///{tmp_path / 'serve.db'}", BCRYPT_ROUNDS="4")
+        # Cada worker anuncia en el log el fin de su lifespan: es la señal de que acepta tráfico
+        process = subprocess.Popen(
+            [sys.executable, "main.py", "serve", "--host", "127.0.0.1", "--port", str(port),
+             "--workers", "2", "--log-level", "info"],
+            cwd=BACKEND_DIR, env=env, stderr=subprocess.PIPE, text=True,
+        )
+        started = threading.Semaphore(0)
+
+        def watch_log():
+            for line in process.stderr:
+                if "Application startup complete" in line:
+                    started.release()
+
+        threading.Thread(target=watch_log, daemon=True).start()
+
+        def wait_for_workers(count):
+            return all(started.acquire(timeout=60) for _ in range(count))
+
+        url = f"http://127.0.0.1:{port}"
+        try:
+            assert wait_for_workers(2), "los workers no terminaron de arrancar"
+            response = httpx.post(url + "/auth/register", json={
+                "name": "Serve", "email": unique_email("serve"), "password": "secret123"
+            })
+            assert response.status_code == 200
+            process.send_signal(signal.SIGHUP)
+            # Peticiones continuas hasta que los dos workers nuevos están listos, y alguna más
+            statuses = []
+            replaced = []
+            restarted = threading.Thread(target=lambda: replaced.append(wait_for_workers(2)))
+            restarted.start()
+            while restarted.is_alive():
+                statuses.append(httpx.get(url + "/", timeout=60).status_code)
+            restarted.join()
+            assert replaced == [True], "los workers nuevos no terminaron de arrancar"
+            statuses += [httpx.get(url + "/", timeout=60).status_code for _ in range(5)]
+            assert statuses == [200] * len(statuses)
+        finally:
+            process.terminate()
+            process.wait(timeout=30)
+
+class TestUserSearch:
+
+    def test_search_ranked_paginated_and_synced(self):
+        """Test de /auth/users/search: subcadenas, paginación y sincronía con altas y bajas"""
+        tag = uuid.uuid4().hex[:8]
+        _, token = register_and_login("search")
+        headers = {"Authorization": f"Bearer {token}"}
+        for i in range(3):
+            client.post("/auth/register", json={
+                "name": f"Soporte {tag} {i}", "email": unique_email(f"s{i}"), "password": "secret123"
+            })
+
+        response = client.get(f"/auth/users/search?q={tag[2:7]}&limit=2", headers=headers)
+        assert response.status_code == 200
+        assert len(response.json()) == 2
+        assert response.headers["X-Next-Offset"] == "2"
+        rest = client.get(f"/auth/users/search?q={tag[2:7]}&limit=2&offset=2", headers=headers)
+        assert len(rest.json()) == 1
+        assert "X-Next-Offset" not in rest.headers
+        found = response.json() + rest.json()
+        assert all(tag in user["name"] for user in found)
+        assert all("hashed_password" not in user for user in found)
+
+        # Búsqueda por parte del email y baja del usuario
+        victim = found[0]
+        by_email = client.get(f"/auth/users/search?q={victim['email'].split('@')[0]}", headers=headers).json()
+        assert [user["id"] for user in by_email] == [victim["id"]]
+        victim_token = client.post(
+            "/auth/login", json={"email": victim["email"], "password": "secret123"}
+        ).json()["access_token"]
+        victim_headers = {"Authorization": f"Bearer {victim_token}"}
+        assert client.delete(f"/auth/users/{victim['id']}", headers=victim_headers).status_code == 200
+        remaining = client.get(f"/auth/users/search?q={tag}", headers=headers).json()
+        assert victim["id"] not in [user["id"] for user in remaining]
+        assert len(remaining) == 2
+
+    def test_search_requires_three_characters(self):
+        """Test de longitud mínima de la búsqueda"""
+        _, token = register_and_login("search")
+        response = client.get("/auth/users/search?q=ab", headers={"Authorization": f"Bearer {token}"})
+        assert response.status_code == 422
+
+    def test_search_fallback_query_escapes_wildcards(self):
+        """Test de la consulta LIKE de otros motores: los comodines se buscan literalmente"""
+        from main import search_users_query
+        query = search_users_query("mysql", "50%_x", 10)
+        assert "50\\%\\_x" in str(query.compile(compile_kwargs={"literal_binds": True}))
+
+class TestEmailAvailability:
+
+    def test_email_available_follows_register_and_delete(self):
+        """Test de /auth/email-available: libre, ocupado tras registrarse y libre tras borrarse"""
+        email = unique_email("available")
+        assert client.get(f"/auth/email-available?email={email}").json() == {"email": email, "available": True}
+        user, token = register_and_login("available")
+        taken = client.get(f"/auth/email-available?email={user['email']}").json()
+        assert taken["available"] is False
+        headers = {"Authorization": f"Bearer {token}"}
+        user_id = client.get("/auth/me", headers=headers).json()["id"]
+        assert client.delete(f"/auth/users/{user_id}", headers=headers).status_code == 200
+        assert client.get(f"/auth/email-available?email={user['email']}").json()["available"] is True
+        assert "email_registry" in client.get("/stats", headers=METRICS_HEADERS).json()
+
+    def test_unknown_email_answered_without_query(self):
+        """Test de que un email desconocido se descarta en memoria sin consultar la base de datos"""
+        from sqlalchemy import event
+        client.get(f"/auth/email-available?email={unique_email('warm')}")
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(engine, "before_cursor_execute", listener)
+        try:
+            response = client.get(f"/auth/email-available?email={unique_email('fresh')}")
+        finally:
+            event.remove(engine, "before_cursor_execute", listener)
+        assert response.json()["available"] is True
+        assert statements == []
+
+    def test_requests_only_read_the_filter(self):
+        """Test de que las peticiones no sincronizan el filtro aunque esté desfasado: lo hace la tarea de fondo"""
+        from sqlalchemy import event
+        from main import email_registry
+        client.get(f"/auth/email-available?email={unique_email('warm')}")
+        email_registry._synced_at -= 10 * email_registry.rebuild_seconds
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(engine, "before_cursor_execute", listener)
+        try:
+            response = client.get(f"/auth/email-available?email={unique_email('stale')}")
+        finally:
+            event.remove(engine, "before_cursor_execute", listener)
+        assert response.json()["available"] is True
+        assert statements == []
+
+    def test_background_sync_picks_up_other_workers(self):
+        """Test de la tarea de fondo: las altas de otros workers llegan al filtro sin pasar por peticiones"""
+        registry = EmailRegistry(1000, 0.01, 0.05, 3600)
+        with TestingSessionLocal() as db:
+            registry.sync(db)
+        email = unique_email("other-worker")
+        with TestingSessionLocal() as db:
+            db.add(User(name="Otro worker", email=email, hashed_password=get_password_hash("secret123")))
+            db.commit()
+        assert not registry.might_exist(email)
+
+        async def scenario():
+            registry.start(engine)
+            try:
+                for _ in range(100):
+                    await asyncio.sleep(0.05)
+                    if registry.might_exist(email):
+                        return True
+                return False
+            finally:
+                await registry.stop()
+
+        assert asyncio.run(scenario())
+
+    def test_register_duplicate_after_filter_miss(self, test_user_data, monkeypatch):
+        """Test de que el registro sigue rechazando duplicados que el filtro aún no conoce"""
+        client.post("/auth/register", json=test_user_data)
+        stale = EmailRegistry(1000, 0.01, 3600, 3600)
+        stale._synced_at = stale._rebuilt_at = time.monotonic()
+        import main
+        monkeypatch.setattr(main, "email_registry", stale)
+        response = client.post("/auth/register", json=test_user_data)
+        assert response.status_code == 400
+        assert "ya está registrado" in response.json()["detail"]
+
+    def test_invalid_email_rejected(self):
+        """Test de validación del parámetro email"""
+        assert client.get("/auth/email-available?email=no-es-un-email").status_code == 422
+
+    def test_checks_are_throttled_per_ip(self):
+        """Test del límite por IP de /auth/email-available"""
+        statuses = [
+            client.get(f"/auth/email-available?email={unique_email('enum')}").status_code
+            for _ in range(email_check_limiter.burst + 1)
+        ]
+        assert statuses[:-1] == [200] * email_check_limiter.burst
+        assert statuses[-1] == 429
+        response = client.get(f"/auth/email-available?email={unique_email('enum')}")
+        assert response.status_code == 429
+        assert "Retry-After" in response.headers
+
+class TestConditionalGet:
+
+    def test_me_not_modified(self):
+        """Test de ETag en /auth/me: 304 sin cuerpo con If-None-Match"""
+        _, token = register_and_login("etag")
+        headers = {"Authorization": f"Bearer {token}"}
+        response = client.get("/auth/me", headers=headers)
+        etag = response.headers["ETag"]
+        assert etag.startswith('"') and "version" not in response.json()
+        cached = client.get("/auth/me", headers={**headers, "If-None-Match": etag})
+        assert cached.status_code == 304
+        assert cached.content == b""
+        weak = client.get("/auth/me", headers={**headers, "If-None-Match": f'"otro", W/{etag}'})
+        assert weak.status_code == 304
+        assert client.get("/auth/me", headers={**headers, "If-None-Match": '"otro"'}).status_code == 200
+
+    def test_me_etag_differs_for_recreated_id(self):
+        """Test de ETag en /auth/me: una cuenta que reutiliza el id de una borrada no da 304"""
+        old_user, old_token = register_and_login("etag-old")
+        old_headers = {"Authorization": f"Bearer {old_token}"}
+        old_me = client.get("/auth/me", headers=old_headers)
+        etag = old_me.headers["ETag"]
+        assert client.delete(f"/auth/users/{old_me.json()['id']}", headers=old_headers).status_code == 200
+
+        # SQLite sin AUTOINCREMENT reutiliza el id más alto tras borrarlo
+        new_user, new_token = register_and_login("etag-new")
+        new_headers = {"Authorization": f"Bearer {new_token}"}
+        response = client.get("/auth/me", headers={**new_headers, "If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.json()["id"] == old_me.json()["id"]
+        assert response.json()["email"] == new_user["email"]
+        assert response.headers["ETag"] != etag
+
+    def test_users_etag_changes_with_table(self):
+        """Test de ETag en /auth/users: cambia al registrar o borrar usuarios"""
+        _, token = register_and_login("etag")
+        headers = {"Authorization": f"Bearer {token}"}
+        etag = client.get("/auth/users", headers=headers).headers["ETag"]
+        assert client.get("/auth/users", headers={**headers, "If-None-Match": etag}).status_code == 304
+        client.post("/auth/register", json={"name": "Nuevo", "email": unique_email("etag"), "password": "secret123"})
+        response = client.get("/auth/users", headers={**headers, "If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.headers["ETag"] != etag
+
+    def test_migrate_adds_version_column(self, tmp_path):
+        """Test de migrate sobre una tabla users anterior a la columna version"""
+        from sqlalchemy import inspect
+        from main import migrate
+        legacy = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+        with legacy.begin() as connection:
+            connection.exec_driver_sql(
+                "CREATE TABLE users (id INTEGER PRIMARY KEY, name VARCHAR, email VARCHAR UNIQUE, "
+                "hashed_password VARCHAR, created_at DATETIME)"
+            )
+            connection.exec_driver_sql("INSERT INTO users (name, email) VALUES ('Antiguo', 'old@example.com')")
+        migrate(legacy)
+        assert "version" in {column["name"] for column in inspect(legacy).get_columns("users")}
+        with legacy.connect() as connection:
+            assert connection.exec_driver_sql("SELECT version FROM users").scalar() == 1
+            assert connection.exec_driver_sql("SELECT version FROM table_versions").scalar() == 0
+
+class TestStatelessTokens:
+
+    @pytest.fixture
+    def stateless(self, monkeypatch):
+        import main
+        monkeypatch.setattr(main, "STATELESS_TOKENS", True)
+
+    def login(self, email, password="testpass123"):
+        return client.post("/auth/login", json={"email": email, "password": password}).json()["access_token"]
+
+    def test_token_carries_user_claims(self, stateless):
+        """Test de que el token autocontenido lleva id, nombre y fecha de alta"""
+        from jose import jwt as jose_jwt
+        user, token = register_and_login("stateless")
+        payload = jose_jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        assert payload["name"] == user["name"]
+        assert isinstance(payload["id"], int) and payload["created_at"]
+
+    def test_me_without_database(self, stateless):
+        """Test de /auth/me en modo autocontenido: ninguna consulta a la base de datos"""
+        from sqlalchemy import event
+        user, token = register_and_login("stateless")
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(engine, "before_cursor_execute", listener)
+        try:
+            response = client.get("/auth/me", headers={"Authorization": f"Bearer {token}"})
+        finally:
+            event.remove(engine, "before_cursor_execute", listener)
+        assert response.status_code == 200
+        assert response.json()["email"] == user["email"]
+        assert statements == []
+
+    def test_delete_checks_database(self, stateless):
+        """Test de que los endpoints que modifican datos siguen comprobando el usuario en la base de datos"""
+        user, token = register_and_login("stateless")
+        other_token = self.login(user["email"])
+        user_id = client.get("/auth/me", headers={"Authorization": f"Bearer {token}"}).json()["id"]
+        assert client.delete(f"/auth/users/{user_id}", headers={"Authorization": f"Bearer {token}"}).status_code == 200
+        response = client.delete(f"/auth/users/{user_id}", headers={"Authorization": f"Bearer {other_token}"})
+        assert response.status_code == 401
+
+class TestAuditLog:
+
+    def test_events_buffered_then_flushed_in_batches(self, test_user_data):
+        """Test de auditoría: los handlers solo encolan y el escritor inserta por lotes"""
+        from main import audit_log
+        user, token = register_and_login("audit")
+        client.post("/auth/login", json={"email": user["email"], "password": "incorrecta"})
+        headers = {"Authorization": f"Bearer {token}"}
+        assert client.get("/auth/audit", headers=headers).json() == []
+        assert audit_log.stats()["queue_depth"] >= 3
+
+        audit_log.flush(engine)
+        assert audit_log.stats()["queue_depth"] == 0
+        events = client.get("/auth/audit", headers=headers).json()
+        assert [event["event"] for event in events] == ["login_failed", "login", "register"]
+        assert all(event["email"] == user["email"] for event in events)
+
+        page = client.get("/auth/audit?limit=2", headers=headers)
+        assert len(page.json()) == 2
+        rest = client.get(f"/auth/audit?limit=2&cursor={page.headers['X-Next-Cursor']}", headers=headers)
+        assert [event["event"] for event in rest.json()] == ["register"]
+        assert client.get("/auth/audit?email=otro@example.com", headers=headers).status_code == 403
+
+    def test_ring_buffer_is_bounded(self):
+        """Test del buffer acotado: al llenarse descarta los eventos más antiguos y los cuenta"""
+        from main import AuditLog
+        log = AuditLog(capacity=3, batch_size=2, flush_seconds=1)
+        for i in range(5):
+            log.record("login", f"user{i}@example.com")
+        stats = log.stats()
+        assert stats["queue_depth"] == 3
+        assert stats["dropped"] == 2
+
+    def test_lifespan_flushes_on_shutdown(self, tmp_path):
+        """Test de que al parar el servidor se vuelca lo que queda en el buffer"""
+        import os
+        import subprocess
+        import sys
+        backend_dir = os.path.dirname(os.path.abspath(__import__("main").__file__))
+        db_path = tmp_path / "audit.db"
+        script = (
+            "from fastapi.testclient import TestClient\n"
+            "import main\n"
+            "with TestClient(main.app) as client:\n"
+            "    client.post('/auth/register', json={'name': 'A', 'email': 'a@example.com', 'password': 'secret123'})\n"
+        )
+        env = dict(os.environ, DATABASE_URL=f"sqlite:///{db_path}", BCRYPT_ROUNDS="4", AUDIT_FLUSH_SECONDS="60")
+        subprocess.run([sys.executable, "-c", script], cwd=backend_dir, env=env, check=True)
+        audit_engine = create_engine(f"sqlite:///{db_path}")
+        with audit_engine.connect() as connection:
+            rows = connection.exec_driver_sql("SELECT event, email FROM audit_events").all()
+        assert [tuple(row) for row in rows] == [("register", "a@example.com")]
+
+class TestProfiler:
+
+    @pytest.fixture
+    def admin_headers(self, monkeypatch):
+        import main
+        user, token = register_and_login("admin")
+        monkeypatch.setattr(main, "ADMIN_EMAILS", {user["email"]})
+        yield {"Authorization": f"Bearer {token}"}
+        main.sampling_profiler.stop()
+
+    def test_profile_next_logins(self, admin_headers):
+        """Test del profiler: perfila las próximas N peticiones del endpoint y exporta las pilas"""
+        user, _ = register_and_login("profiled")
+        response = client.post("/admin/profile", headers=admin_headers, json={
+            "requests": 2, "endpoint": "POST /auth/login", "interval_ms": 1
+        })
+        assert response.status_code == 200
+        assert client.post("/admin/profile", headers=admin_headers, json={}).status_code == 409
+
+        client.get("/")  # no encaja: no cuenta
+        for _ in range(2):
+            client.post("/auth/login", json={"email": user["email"], "password": "testpass123"})
+        status = client.get("/admin/profile", headers=admin_headers).json()
+        assert status["active"] is False
+        assert status["matched"] == 2
+        assert status["samples"] > 0
+
+        collapsed = client.get("/admin/profile?format=collapsed", headers=admin_headers).text
+        assert all(line.rsplit(" ", 1)[1].isdigit() for line in collapsed.splitlines())
+        speedscope = client.get("/admin/profile?format=speedscope", headers=admin_headers).json()
+        profile = speedscope["profiles"][0]
+        assert profile["type"] == "sampled"
+        assert len(profile["samples"]) == len(profile["weights"]) == len(collapsed.splitlines())
+
+    def test_profile_samples_only_request_threads(self, admin_headers):
+        """Test de que el profiler solo muestrea los hilos que trabajan para las peticiones seleccionadas"""
+        import os
+        import threading
+        user, _ = register_and_login("threads")
+        stop = threading.Event()
+
+        def unrelated_busy_loop():
+            while not stop.is_set():
+                sum(range(1000))
+
+        busy = threading.Thread(target=unrelated_busy_loop, name="unrelated")
+        busy.start()
+        try:
+            client.post("/admin/profile", headers=admin_headers, json={
+                "requests": 3, "endpoint": "POST /auth/login", "interval_ms": 1
+            })
+            for _ in range(3):
+                client.post("/auth/login", json={"email": user["email"], "password": "testpass123"})
+        finally:
+            stop.set()
+            busy.join()
+        collapsed = client.get("/admin/profile?format=collapsed", headers=admin_headers).text
+        assert collapsed
+        assert "unrelated_busy_loop" not in collapsed
+        assert "verify_password" in collapsed
+        assert client.get("/admin/profile", headers=admin_headers).json()["worker"] == os.getpid()
+
+    def test_profile_by_header_and_stop(self, admin_headers):
+        """Test de selección por cabecera y parada manual"""
+        client.post("/admin/profile", headers=admin_headers, json={"requests": 5, "header": "X-Profile"})
+        client.get("/")
+        client.get("/", headers={"X-Profile": "1"})
+        status = client.delete("/admin/profile", headers=admin_headers).json()
+        assert status["matched"] == 1
+        assert status["active"] is False
+        assert client.delete("/admin/profile", headers=admin_headers).status_code == 404
+
+    def test_profile_requires_admin(self):
+        """Test de que solo los administradores pueden perfilar"""
+        _, token = register_and_login("noadmin")
+        response = client.post("/admin/profile", headers={"Authorization": f"Bearer {token}"}, json={})
+        assert response.status_code == 403
+
+class TestUserExportImport:
+
+    def test_export_import_roundtrip_keeps_hashes(self, tmp_path):
+        """Test de exportación e importación: mismos hashes, sin recalcular, en NDJSON y CSV"""
+        import io
+        from main import migrate, iter_users_export, read_users_import, import_users
+        source = create_engine(f"sqlite:///{tmp_path / 'source.db'}")
+        migrate(source)
+        hashed = get_password_hash("secret123")
+        counts = import_users(source, [
+            {"name": "Ana", "email": "ana@example.com", "hashed_password": hashed},
+            {"name": "Ana bis", "email": "ana@example.com", "hashed_password": hashed},
+            {"name": "Sin hash", "email": "nohash@example.com", "hashed_password": "texto-plano"},
+            {"name": "Luis", "email": "luis@example.com", "hashed_password": hashed, "created_at": "2020-05-01T10:00:00"},
+        ], chunk_size=1)
+        assert (counts["inserted"], counts["skipped"], counts["invalid"]) == (2, 1, 1)
+
+        for fmt in ("ndjson", "csv"):
+            exported = "".join(iter_users_export(source, fmt))
+            target = create_engine(f"sqlite:///{tmp_path / f'target-{fmt}.db'}")
+            migrate(target)
+            records = list(read_users_import(io.StringIO(exported, newline=""), fmt))
+            assert import_users(target, records)["inserted"] == 2
+            with target.connect() as connection:
+                rows = connection.exec_driver_sql("SELECT email, hashed_password, created_at FROM users ORDER BY id").all()
+            assert [row[0] for row in rows] == ["ana@example.com", "luis@example.com"]
+            assert all(row[1] == hashed for row in rows)
+            assert rows[1][2].startswith("2020-05-01")
+
+    def test_import_conflicts(self, tmp_path):
+        """Test de conflictos por email: se omiten o se actualizan nombre y hash"""
+        from main import migrate, import_users
+        target = create_engine(f"sqlite:///{tmp_path / 'conflicts.db'}")
+        migrate(target)
+        old_hash, new_hash = get_password_hash("antigua1"), get_password_hash("nueva123")
+        import_users(target, [{"name": "Eva", "email": "eva@example.com", "hashed_password": old_hash}])
+        again = [{"name": "Eva M.", "email": "eva@example.com", "hashed_password": new_hash}]
+        assert import_users(target, again)["skipped"] == 1
+        assert import_users(target, again, on_conflict="update")["updated"] == 1
+        with target.connect() as connection:
+            row = connection.exec_driver_sql("SELECT name, hashed_password, version FROM users").one()
+        assert tuple(row) == ("Eva M.", new_hash, 2)
+
+class TestShardedStore:
+
+    @pytest.fixture
+    def router(self, tmp_path, monkeypatch):
+        import main
+        from main import ShardRouter, migrate
+        router = ShardRouter([f"sqlite:///{tmp_path / f'shard{i}.db'}" for i in range(2)])
+        for shard_engine in router.engines:
+            migrate(shard_engine)
+        monkeypatch.setattr(main, "shard_router", router)
+        monkeypatch.setattr(main, "email_registry", EmailRegistry(1000, 0.01, 60, 600))
+        yield router
+        router.dispose()
+
+    def test_users_are_spread_and_routed(self, router):
+        """Test de shards: cada usuario vive en el shard de su email y con ids de su rango"""
+        from main import SHARD_ID_BITS
+        tokens = {}
+        for i in range(6):
+            user_data, token = register_and_login(f"shard{i}")
+            tokens[user_data["email"]] = token
+        headers = {"Authorization": f"Bearer {next(iter(tokens.values()))}"}
+        tokens_by_id = {}
+        for email, token in tokens.items():
+            me = client.get("/auth/me", headers={"Authorization": f"Bearer {token}"}).json()
+            assert me["id"] >> SHARD_ID_BITS == router.index_for_email(email)
+            tokens_by_id[me["id"]] = token
+        assert {router.index_for_email(email) for email in tokens} == {0, 1}
+        assert client.get(f"/auth/email-available?email={next(iter(tokens))}").json()["available"] is False
+
+        # La paginación por cursor mezcla los shards en orden de id
+        first = client.get("/auth/users", params={"limit": 4}, headers=headers)
+        second = client.get("/auth/users", params={"cursor": first.headers["X-Next-Cursor"]}, headers=headers)
+        ids = [user["id"] for user in first.json() + second.json()]
+        assert ids == sorted(ids) and len(ids) == 6
+        streamed = client.get("/auth/users", params={"stream": True}, headers=headers).text.splitlines()
+        assert [json.loads(line)["id"] for line in streamed] == ids
+
+        victim = ids[-1]
+        response = client.delete(f"/auth/users/{victim}", headers={"Authorization": f"Bearer {tokens_by_id[victim]}"})
+        assert response.status_code == 200
+        remaining = client.get("/auth/users", headers=headers).json()
+        assert victim not in [user["id"] for user in remaining]
+
+    def test_bulk_insert_is_all_or_nothing(self, router):
+        """Test de alta por lotes con shards: un email repetido en un shard no deja altas a medias en otro"""
+        import main
+        from sqlalchemy.exc import IntegrityError
+        taken = register_and_login("bulk-taken")[0]["email"]
+        fresh = [email for email in (f"bulk-fresh{i}@example.com" for i in range(20))
+                 if router.index_for_email(email) != router.index_for_email(taken)][:2]
+        rows = [{"name": "Bulk", "email": email, "hashed_password": "x"} for email in fresh + [taken]]
+        with TestingSessionLocal() as db, pytest.raises(IntegrityError):
+            main.create_users_bulk(db, rows)
+        with TestingSessionLocal() as db:
+            assert main.get_existing_emails(db, fresh + [taken]) == {taken}
+
+    def test_only_sqlite_shards_and_email_conflicts(self):
+        """Test de que los shards no SQLite se rechazan y solo el índice de email cuenta como duplicado"""
+        from sqlalchemy.exc import IntegrityError
+        from main import ShardRouter, is_duplicate_email
+        with pytest.raises(RuntimeError):
+            ShardRouter(["postgresql://localhost/users0"])
+        assert is_duplicate_email(IntegrityError("INSERT", {}, Exception("UNIQUE constraint failed: users.email")))
+        assert not is_duplicate_email(IntegrityError("INSERT", {}, Exception("UNIQUE constraint failed: users.id")))
+
+    def test_reshard_keeps_logins(self, router, tmp_path, monkeypatch):
+        """Test de reparto a un nuevo juego de shards: mismos usuarios y mismos hashes"""
+        import main
+        from main import ShardRouter, reshard, shard_status
+        emails = [register_and_login(f"reshard{i}")[0]["email"] for i in range(4)]
+        urls = [f"sqlite:///{tmp_path / f'new{i}.db'}" for i in range(3)]
+        assert reshard(urls)["inserted"] == 4
+        assert reshard(urls)["updated"] == 4  # repetir la copia es seguro
+
+        # Una baja durante la ventana de copia se aplica en la siguiente pasada
+        gone = emails.pop()
+        user_id = client.post("/auth/login", json={"email": gone, "password": "testpass123"}).json()["user"]["id"]
+        with router.session(user_id=user_id) as shard_db:
+            main.delete_user_by_id(shard_db, user_id)
+        assert reshard(urls)["deleted"] == 1
+
+        new_router = ShardRouter(urls)
+        monkeypatch.setattr(main, "shard_router", new_router)
+        assert sum(row["users"] for row in shard_status()) == 3
+        for email in emails:
+            response = client.post("/auth/login", json={"email": email, "password": "testpass123"})
+            assert response.status_code == 200
+        assert client.post("/auth/login", json={"email": gone, "password": "testpass123"}).status_code == 401
+        new_router.dispose()
+
+class TestRefreshTokens:
+
+    def login(self, prefix="refresh"):
+        user_data = {"name": "Refresh", "email": unique_email(prefix), "password": "testpass123"}
+        client.post("/auth/register", json=user_data)
+        return client.post("/auth/login", json={"email": user_data["email"], "password": "testpass123"}).json()
+
+    def test_refresh_rotates_without_password(self, monkeypatch):
+        """Test de refresh: token de acceso nuevo y refresh rotado sin verificar la contraseña"""
+        import main
+        from main import RefreshToken, hash_refresh_token
+        tokens = self.login()
+        monkeypatch.setattr(main, "verify_password", lambda *args: pytest.fail("refresh no debe usar bcrypt"))
+        response = client.post("/auth/refresh", json={"refresh_token": tokens["refresh_token"]})
+        assert response.status_code == 200
+        renewed = response.json()
+        assert renewed["refresh_token"] != tokens["refresh_token"]
+        me = client.get("/auth/me", headers={"Authorization": f"Bearer {renewed['access_token']}"})
+        assert me.json()["email"] == tokens["user"]["email"]
+
+        # En la tabla solo hay digests, nunca el token
+        with TestingSessionLocal() as db:
+            stored = db.query(RefreshToken).filter(RefreshToken.email == tokens["user"]["email"]).all()
+        assert {row.token_hash for row in stored} == {
+            hash_refresh_token(tokens["refresh_token"]), hash_refresh_token(renewed["refresh_token"])
+        }
+
+    def test_reuse_revokes_the_family(self):
+        """Test de reutilización: un refresh ya canjeado invalida toda la sesión"""
+        tokens = self.login("reuse")
+        renewed = client.post("/auth/refresh", json={"refresh_token": tokens["refresh_token"]}).json()
+        assert client.post("/auth/refresh", json={"refresh_token": tokens["refresh_token"]}).status_code == 401
+        assert client.post("/auth/refresh", json={"refresh_token": renewed["refresh_token"]}).status_code == 401
+        assert client.post("/auth/refresh", json={"refresh_token": "inventado"}).status_code == 401
+
+    def test_logout_revokes_refresh_token(self):
+        """Test de logout: con el refresh token en el cuerpo se cierra también la sesión larga"""
+        tokens = self.login("logout")
+        other = client.post("/auth/login", json={"email": tokens["user"]["email"], "password": "testpass123"}).json()
+        client.post("/auth/logout", headers={"Authorization": f"Bearer {tokens['access_token']}"},
+                    json={"refresh_token": tokens["refresh_token"]})
+        assert client.post("/auth/refresh", json={"refresh_token": tokens["refresh_token"]}).status_code == 401
+        # Otros dispositivos (otras familias) siguen con sesión
+        assert client.post("/auth/refresh", json={"refresh_token": other["refresh_token"]}).status_code == 200
+
+    def test_login_does_not_query_from_event_loop(self):
+        """Test de login: guardar el refresh token no recarga el usuario desde el event loop"""
+        from sqlalchemy import event
+        user_data = {"name": "Loop", "email": unique_email("loop"), "password": "testpass123"}
+        client.post("/auth/register", json=user_data)
+        on_loop = []
+
+        def record(conn, cursor, statement, *args):
+            try:
+                asyncio.get_running_loop()
+            except RuntimeError:
+                return
+            on_loop.append(statement)
+
+        event.listen(engine, "before_cursor_execute", record)
+        try:
+            response = client.post("/auth/login", json={"email": user_data["email"], "password": "testpass123"})
+        finally:
+            event.remove(engine, "before_cursor_execute", record)
+        assert response.status_code == 200
+        assert response.json()["user"]["email"] == user_data["email"]
+        assert on_loop == []
+
+class TestMicroBenchmarks:
+
+    def test_regressions_against_baseline(self):
+        """Test de la comparación de microbenchmarks con la línea base"""
+        from benchmarks.micro import compare_with_baseline
+        baseline = {"cases": {"verify_password": {"median_us": 1000}, "create_access_token": {"median_us": 40}}}
+        result = {"cases": {
+            "verify_password": {"median_us": 1200},
+            "create_access_token": {"median_us": 60},
+            "nuevo": {"median_us": 5},
+        }}
+        assert compare_with_baseline(result, baseline, 0.25) == ["create_access_token 60 µs > 40 µs (median_us)"]
+
+    def test_comparison_uses_minimum_and_spread(self):
+        """Test de que se compara el mínimo y el margen crece con la dispersión medida"""
+        from benchmarks.micro import compare_with_baseline
+        baseline = {"cases": {
+            "estable": {"median_us": 100, "min_us": 90, "stdev_pct": 2.0},
+            "ruidoso": {"median_us": 100, "min_us": 90, "stdev_pct": 15.0},
+        }}
+        result = {"cases": {
+            # Mediana inflada por una ronda lenta, mínimo igual: no es una regresión
+            "estable": {"median_us": 140, "min_us": 92, "stdev_pct": 3.0},
+            # 40 % más lento pero con un 15 % de dispersión: dentro del margen de 45 %
+            "ruidoso": {"median_us": 140, "min_us": 126, "stdev_pct": 15.0},
+        }}
+        assert compare_with_baseline(result, baseline, 0.25) == []
+        result["cases"]["estable"]["min_us"] = 120
+        assert compare_with_baseline(result, baseline, 0.25) == ["estable 120 µs > 90 µs (min_us)"]
+
+    def test_run_cases_on_small_fixture(self, tmp_path, monkeypatch):
+        """Test de humo: fixture determinista reutilizable y un resultado por caso"""
+        import main
+        from benchmarks.micro import run_benchmarks
+        monkeypatch.setattr(main, "revocation_list", main.RevocationList(1000, 0.01, 3600, 3600))
+        names = ["create_access_token", "decode_access_token", "user_response_fast_json", "get_user_by_email[50]"]
+        result = run_benchmarks(main, names, sizes=(50,), rounds=2, min_time=0.001, fixtures_dir=str(tmp_path))
+        assert list(result["cases"]) == names
+        assert all(case["median_us"] > 0 for case in result["cases"].values())
+        assert (tmp_path / "users-50.db").exists()
+
 # Ejemplos de uso del cliente JavaScript
 class ClientExamples:
     """
@@ -351,15 +1760,15 @@ class DevUtils:
             }
         ]
         
-        for user in test_users:
-            try:
+        try:
+            for user in test_users:
                 response = client.post("/auth/register", json=user)
                 if response.status_code == 200:
                     print(f"Usuario creado: {user['email']}")
                 else:
-                    print(f"Error creando {user['email']}: {response.json()}")
-            except Exception as e:
-                print(f"Error: {e}")
+                    print(f"Error creando {user['email']}: {response.json()['detail']}")
+        except Exception as e:
+            print(f"Error: {e}")
 
     @staticmethod
     def decode_jwt_token(token):